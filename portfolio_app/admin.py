@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Portfolio, Item
+from .models import Portfolio, Item, PortfolioValuation, Ticker
 
 # Register your models here.
 
@@ -14,6 +14,12 @@ class PortfolioAdmin(admin.ModelAdmin):
     list_filter = ('user',)
     inlines = [ItemInline]
 
+class TickerAdmin(admin.ModelAdmin):
+    list_display = ('symbol', 'currency', 'exchange', 'last_verified')
+    search_fields = ('symbol',)
+
 
 admin.site.register(Portfolio, PortfolioAdmin)
-admin.site.register(Item)
\ No newline at end of file
+admin.site.register(Item)
+admin.site.register(PortfolioValuation)
+admin.site.register(Ticker, TickerAdmin)
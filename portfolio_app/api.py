@@ -0,0 +1,166 @@
+import time
+import json
+import hashlib
+import pandas as pd
+
+from django.conf import settings
+from django.core.cache import caches
+from django.shortcuts import get_object_or_404
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+from rest_framework import serializers
+from rest_framework.decorators import api_view
+from rest_framework.exceptions import NotFound
+from rest_framework.response import Response
+
+from .forms import CURRENCY_CHOISES, PERIOD_CHOICES, INTERVAL_CHOICES
+from .models import Portfolio
+from .timing import request_timings
+from .utils import Calculator
+
+
+class ValuationQuerySerializer(serializers.Serializer):
+    base_currency = serializers.ChoiceField(choices=CURRENCY_CHOISES)
+    period = serializers.ChoiceField(choices=PERIOD_CHOICES, default='1y')
+    interval = serializers.ChoiceField(choices=INTERVAL_CHOICES, default='1mo')
+
+
+def columnar(frame):
+    """
+    Converts dataframe to columnar JSON: list of column names and list of values of every column, missing values are
+    null. Index is included when it has a name (dates of history and gain, as YYYY-MM-DD).
+    :param frame: dataframe
+    :return: dictionary with index (optional), columns and data
+    """
+    result = {}
+    if frame.index.name is not None:
+        result['index'] = [label.strftime('%Y-%m-%d') if hasattr(label, 'strftime') else label
+                           for label in frame.index]
+    result['columns'] = [str(column) for column in frame.columns]
+    result['data'] = {str(column): frame[column].astype(object).where(frame[column].notna(), None).tolist()
+                      for column in frame.columns}
+    return result
+
+
+def fingerprint(value):
+    """
+    :param value: dataframe or JSON serializable value
+    :return: JSON serializable value, dataframes are replaced by their column names and hash of their values and index
+    """
+    if isinstance(value, pd.DataFrame):
+        return [[str(column) for column in value.columns],
+                hashlib.sha256(pd.util.hash_pandas_object(value).to_numpy().tobytes()).hexdigest()]
+    return value
+
+
+def snapshot_validators(portfolio, calculator, table, query):
+    """
+    Returns validators of the table derived from the data it is calculated from: holdings of the portfolio, quotes
+    and latest exchange rates (current value and gain), stored valuations or closes and exchange rates of history
+    (history and gain). Market data has to be prefetched, nothing is calculated, so validators change only when the
+    data changes and a client which has the data gets 304 Not Modified without calculating the table. Last-Modified
+    is the time when the data was seen first, kept in the default cache (shared by processes when the cache is).
+    :param portfolio: Portfolio object with prefetched Items
+    :param calculator: Calculator object of the portfolio with prefetched market data
+    :param table: 'current', 'history' or 'gain', string
+    :param query: validated ValuationQuerySerializer data, dictionary
+    :return: ETag (unquoted, string) and Last-Modified (timestamp, integer)
+    """
+    snapshot = calculator.snapshot
+    inputs = [portfolio.pk, table, query['base_currency'], query['period'], query['interval'],
+              sorted((item.ticker, item.quantity) for item in portfolio.stocks.all())]
+    if table != 'history':
+        inputs += [snapshot.quotes, snapshot.exchange_rates]
+    if table != 'current':
+        if calculator.stored_history is not None:
+            inputs.append(calculator.stored_history)
+        else:
+            inputs += [snapshot.currencies, snapshot.closes, snapshot.history_rates]
+    inputs.append(calculator.errors)
+    data = json.dumps([fingerprint(value) for value in inputs], default=str, sort_keys=True)
+    etag = hashlib.sha256(data.encode()).hexdigest()[:32]
+    key = f'api-last-modified:{etag}'
+    caches['default'].add(key, int(time.time()), timeout=getattr(settings, 'API_VALIDATORS_TIMEOUT', 24 * 60 * 60))
+    return etag, caches['default'].get(key) or int(time.time())
+
+
+def cache_headers(response, etag, last_modified):
+    """
+    Sets validators and caching headers of the response. Responses depend on the user, so they are cached only by
+    the client.
+    """
+    response['ETag'] = quote_etag(etag)
+    response['Last-Modified'] = http_date(last_modified)
+    patch_cache_control(response, private=True, max_age=getattr(settings, 'API_CACHE_MAX_AGE', 60))
+    return response
+
+
+def valuation_response(request, pk, table, build):
+    """
+    Calculates the table of the Portfolio of the user and returns it with ETag and Last-Modified headers, or 304 Not
+    Modified response without calculating the table when the client already has the same data.
+    :param request: Request object, GET parameters are base_currency, period and interval
+    :param pk: Portfolio primary key, Integer
+    :param table: 'current', 'history' or 'gain', string
+    :param build: function which takes Calculator and returns JSON serializable payload
+    :return: Response object
+    """
+    portfolio = get_object_or_404(Portfolio.objects.with_stocks(), pk=pk)
+    if portfolio.user_id != request.user.pk:
+        raise NotFound
+    query = ValuationQuerySerializer(data=request.query_params)
+    query.is_valid(raise_exception=True)
+    query = query.validated_data
+
+    calculator = Calculator(portfolio, query['base_currency'], period=query['period'], interval=query['interval'],
+                            timings=request_timings(request))
+    calculator.prefetch(current=table != 'history', history=table != 'current')
+    etag, last_modified = snapshot_validators(portfolio, calculator, table, query)
+    not_modified = get_conditional_response(request, etag=quote_etag(etag), last_modified=last_modified)
+    if not_modified is not None:
+        return cache_headers(not_modified, etag, last_modified)
+
+    payload = {'portfolio': pk, 'base_currency': query['base_currency'], **build(calculator),
+               'errors': calculator.errors}
+    if table != 'current':
+        payload.update(period=query['period'], interval=query['interval'])
+    return cache_headers(Response(payload), etag, last_modified)
+
+
+def current_payload(calculator):
+    _, df_app, portfolio_value, _, _ = calculator.current_portfolio_value()
+    return {'value': portfolio_value, **columnar(df_app)}
+
+
+def history_payload(calculator):
+    return columnar(calculator.get_history()[0])
+
+
+def gain_payload(calculator):
+    data_gain_abs, data_gain, _, _ = calculator.get_gain()
+    return {'absolute': columnar(data_gain_abs), 'percent': columnar(data_gain)}
+
+
+@api_view(['GET'])
+def api_current(request, pk):
+    """
+    Current value of every ticker and of the whole portfolio in the base currency.
+    """
+    return valuation_response(request, pk, 'current', current_payload)
+
+
+@api_view(['GET'])
+def api_history(request, pk):
+    """
+    Historical values of every ticker and their sum in the base currency within period on interval.
+    """
+    return valuation_response(request, pk, 'history', history_payload)
+
+
+@api_view(['GET'])
+def api_gain(request, pk):
+    """
+    Absolute (base currency) and relative (%) gain / loss of every ticker and of the portfolio from every interval
+    within period until now.
+    """
+    return valuation_response(request, pk, 'gain', gain_payload)
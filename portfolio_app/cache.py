@@ -0,0 +1,297 @@
+import time
+import datetime
+import threading
+import pandas as pd
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .fx import FX_BASE, FxMatrix
+from .providers import MarketDataProvider, MarketDataError
+
+
+DEFAULT_TIMEOUTS = {
+    'quote': 60,
+    'currency': 7 * 24 * 60 * 60,
+    'closed_history': 30 * 24 * 60 * 60,
+    'rates': 60 * 60,
+    'past_rates': 30 * 24 * 60 * 60,
+    'miss': 30,
+}
+
+
+def interval_start(date, interval):
+    """
+    Returns start date of history bar which contains the date, bars starting on this date or later are not closed yet.
+    :param date: Timestamp object
+    :param interval: history interval in yfinance notation, string
+    :return: Timestamp object
+    """
+    date = date.normalize()
+    if interval == '1mo':
+        return date.replace(day=1)
+    if interval == '3mo':
+        return date.replace(day=1, month=(date.month - 1) // 3 * 3 + 1)
+    if interval in ('1wk', '5d'):
+        return date - pd.Timedelta(days=date.weekday())
+    return date
+
+
+class CachedMiss:
+    """
+    Cached marker of a key which could not be fetched (ticker does not exist, upstream request failed). It is kept
+    for a short time only, so failures are collapsed into one upstream fetch the same way as fetched values.
+    """
+
+    def __init__(self, error=None):
+        """
+        :param error: error message, string
+        """
+        self.error = error
+
+
+class MarketDataCache:
+    """
+    Cache of market data values on top of Django cache framework (cache alias is set by MARKET_DATA_CACHE setting).
+    Size bound and LRU eviction are done by cache backend (MAX_ENTRIES of LocMemCache, maxmemory-policy of Redis).
+    Concurrent misses of the same key are collapsed into one upstream fetch: threads of one process wait for the
+    thread which fetches the key, other processes wait while lock key of the fetch exists in the cache. Keys which
+    could not be fetched are cached as CachedMiss for miss_timeout seconds.
+    """
+    lock_timeout = 30
+    poll_interval = 0.05
+
+    _inflight = {}
+    _inflight_lock = threading.Lock()
+
+    def __init__(self, alias, miss_timeout=DEFAULT_TIMEOUTS['miss']):
+        """
+        :param alias: name of the cache in CACHES setting, string
+        :param miss_timeout: time to live of CachedMiss markers in seconds
+        """
+        self.alias = alias
+        self.cache = caches[alias]
+        self.miss_timeout = miss_timeout
+
+    def get_many(self, keys, fetch, timeout):
+        """
+        Returns cached values of keys, values which are not cached are fetched with one fetch call and stored.
+        :param keys: list of cache keys, strings
+        :param fetch: function which takes list of missing keys and returns dictionary of fetched values by key, keys
+         which could not be fetched can be left out or given CachedMiss value with error message
+        :param timeout: function which takes key and returns its time to live in seconds
+        :return:    values - dictionary with values of keys which were cached or fetched;
+                    errors - dictionary with keys which could not be fetched as a keys and error messages (None when
+                     fetch gave no message) as a values.
+        """
+        values = self.cache.get_many(keys)
+        missing = [key for key in keys if key not in values]
+        if missing:
+            values.update(self._fetch_missing(missing, fetch, timeout))
+        errors = {key: value.error for key, value in values.items() if isinstance(value, CachedMiss)}
+        return {key: value for key, value in values.items() if key not in errors}, errors
+
+    def get(self, key, fetch, timeout, error):
+        """
+        Returns cached or fetched value of one key.
+        :param key: cache key, string
+        :param fetch: function as in get_many
+        :param timeout: function as in get_many
+        :param error: error message used when fetch gave none, string
+        :return: value of the key
+        :raises MarketDataError: key could not be fetched
+        """
+        values, errors = self.get_many([key], fetch, timeout)
+        if key not in values:
+            raise MarketDataError(errors.get(key) or error)
+        return values[key]
+
+    def _fetch_missing(self, missing, fetch, timeout):
+        """
+        Fetches keys which are not cached, unless they are being fetched by other thread or process.
+        """
+        values = {}
+
+        owned = []
+        waiting = []
+        with self._inflight_lock:
+            for key in missing:
+                event = self._inflight.get(key)
+                if event is None:
+                    self._inflight[key] = threading.Event()
+                    owned.append(key)
+                else:
+                    waiting.append((key, event))
+
+        locked = []
+        try:
+            for key in owned:
+                if self.cache.add(f'lock:{key}', True, self.lock_timeout):
+                    locked.append(key)
+                else:
+                    waiting.append((key, None))
+            if locked:
+                values.update(self._store(locked, fetch, timeout))
+        finally:
+            self.cache.delete_many([f'lock:{key}' for key in locked])
+            with self._inflight_lock:
+                for key in owned:
+                    self._inflight.pop(key).set()
+
+        if waiting:
+            values.update(self._wait(waiting, fetch, timeout))
+        return values
+
+    def _wait(self, waiting, fetch, timeout):
+        """
+        Waits for keys which are being fetched by other thread or process, keys which did not appear in the cache
+        (fetch failed or value does not exist) are fetched directly.
+        """
+        deadline = time.monotonic() + self.lock_timeout
+        for key, event in waiting:
+            if event is not None:
+                event.wait(max(deadline - time.monotonic(), 0))
+        keys = [key for key, _ in waiting]
+        values = self.cache.get_many(keys)
+        while len(values) < len(keys) and time.monotonic() < deadline:
+            pending = [key for key in keys if key not in values]
+            if not any(self.cache.get(f'lock:{key}') for key in pending):
+                break
+            time.sleep(self.poll_interval)
+            values.update(self.cache.get_many(pending))
+        missing = [key for key in keys if key not in values]
+        if missing:
+            values.update(self._store(missing, fetch, timeout))
+        return values
+
+    def _store(self, keys, fetch, timeout):
+        """
+        Fetches keys and caches their values, keys which were not fetched are cached as CachedMiss. When fetch raises,
+        all keys are cached as CachedMiss with the error message and the exception is raised again.
+        """
+        try:
+            fetched = fetch(keys)
+        except Exception as error:
+            self.cache.set_many({key: CachedMiss(str(error)) for key in keys}, self.miss_timeout)
+            raise
+        values = {key: fetched.get(key, CachedMiss()) for key in keys}
+        for key, value in values.items():
+            self.cache.set(key, value, self.miss_timeout if isinstance(value, CachedMiss) else timeout(key))
+        return values
+
+
+class CachedProvider(MarketDataProvider):
+    """
+    Provider which serves quotes, currencies, history and exchange rates of another provider through
+    MarketDataCache. Quotes and latest exchange rates are kept for a short time, currencies, past exchange rates and
+    closed history bars are kept much longer (DEFAULT_TIMEOUTS and MARKET_DATA_CACHE_TIMEOUTS setting). Exchange
+    rates are requested and cached only for EUR, rates of other base currencies are derived from them (FxMatrix).
+    """
+
+    def __init__(self, provider, alias=None, timeouts=None):
+        """
+        :param provider: MarketDataProvider object which is called on cache misses;
+        :param alias: name of the cache in CACHES setting, MARKET_DATA_CACHE setting by default;
+        :param timeouts: dictionary of times to live in seconds which overrides DEFAULT_TIMEOUTS and
+         MARKET_DATA_CACHE_TIMEOUTS setting.
+        """
+        self.provider = provider
+        self.timeouts = {**DEFAULT_TIMEOUTS, **getattr(settings, 'MARKET_DATA_CACHE_TIMEOUTS', {}), **(timeouts or {})}
+        self.cache = MarketDataCache(alias or settings.MARKET_DATA_CACHE, miss_timeout=self.timeouts['miss'])
+
+    def get_quote(self, ticker):
+        quotes, errors = self.get_quotes([ticker])
+        if ticker in errors:
+            raise MarketDataError(errors[ticker])
+        return quotes[ticker]
+
+    def get_quotes(self, tickers):
+        def fetch(keys):
+            quotes, fetch_errors = self.provider.get_quotes([key.split(':', 1)[1] for key in keys])
+            self.cache.cache.set_many({f'currency:{ticker}': quote['currency'] for ticker, quote in quotes.items()},
+                                      self.timeouts['currency'])
+            return {**{f'quote:{ticker}': CachedMiss(error) for ticker, error in fetch_errors.items()},
+                    **{f'quote:{ticker}': quote for ticker, quote in quotes.items()}}
+
+        values, misses = self.cache.get_many([f'quote:{ticker}' for ticker in tickers], fetch,
+                                             lambda key: self.timeouts['quote'])
+        quotes = {ticker: values[f'quote:{ticker}'] for ticker in tickers if f'quote:{ticker}' in values}
+        errors = {ticker: misses.get(f'quote:{ticker}') or f'Ticker "{ticker}" does not exist.'
+                  for ticker in tickers if ticker not in quotes}
+        return quotes, errors
+
+    def get_currency(self, ticker):
+        def fetch(keys):
+            return {keys[0]: self.provider.get_currency(ticker)}
+
+        return self.cache.get(f'currency:{ticker}', fetch, lambda key: self.timeouts['currency'],
+                              f'Ticker "{ticker}" does not exist.')
+
+    def get_history(self, ticker, period='1y', interval='1mo'):
+        closes = self.get_histories([ticker], period=period, interval=interval)
+        if ticker not in closes.columns:
+            raise MarketDataError(f'No {interval} history for ticker "{ticker}".')
+        return closes[[ticker]].dropna().rename(columns={ticker: 'Close'})
+
+    def get_histories(self, tickers, period='1y', interval='1mo', start=None):
+        """
+        Closed bars of the history never change, so they are cached until the current bar is closed. Close of the bar
+        which is not closed yet is the current price, it is taken from cached quotes instead of downloading history
+        again.
+        """
+        bucket = interval_start(pd.Timestamp.today(), interval)
+        fresh = {}
+        span = f'{start}..' if start else period
+
+        def fetch(keys):
+            closes = self.provider.get_histories([key.rsplit(':', 1)[1] for key in keys], period=period,
+                                                 interval=interval, start=start)
+            values = {}
+            for ticker in closes.columns:
+                series = closes[ticker].dropna()
+                opens = bucket.tz_localize(series.index.tz) if series.index.tz is not None else bucket
+                is_open = series.index >= opens
+                values[f'history:{interval}:{span}:{bucket.date()}:{ticker}'] = {
+                    'closed': series[~is_open],
+                    'open': series.index[is_open][-1] if is_open.any() else None,
+                }
+                fresh[ticker] = series
+            return values
+
+        keys = [f'history:{interval}:{span}:{bucket.date()}:{ticker}' for ticker in tickers]
+        values, _ = self.cache.get_many(keys, fetch, lambda key: self.timeouts['closed_history'])
+
+        cached = {ticker: values[key] for ticker, key in zip(tickers, keys) if key in values and ticker not in fresh}
+        quotes, _ = self.get_quotes([ticker for ticker, value in cached.items() if value['open'] is not None])
+        for ticker, value in cached.items():
+            series = value['closed']
+            if value['open'] is not None and ticker in quotes:
+                series = pd.concat([series, pd.Series([quotes[ticker]['currentPrice']], index=[value['open']])])
+            fresh[ticker] = series
+        return pd.DataFrame({ticker: fresh[ticker] for ticker in tickers if ticker in fresh}).rename_axis('Date')
+
+    def get_rates(self, currency):
+        def fetch(keys):
+            return {keys[0]: FxMatrix.from_payload(self.provider.get_rates(FX_BASE))}
+
+        key = f'fx:{FX_BASE}:latest'
+        matrix = self.cache.get(key, fetch, lambda key: self.timeouts['rates'],
+                                f'Exchange rates of currency "{FX_BASE}" are not available.')
+        return matrix.latest_payload(currency)
+
+    def get_rates_by_date(self, currency, start, end):
+        return self.get_rates_matrix(start, end).by_date_payload(currency, start, end)
+
+    def get_rates_matrix(self, start, end):
+        """
+        Rates are cached as FxMatrix, so rates of every base currency are derived from the cached frame.
+        """
+        def fetch(keys):
+            return {keys[0]: self.provider.get_rates_matrix(start, end)}
+
+        def timeout(key):
+            closed = str(end) < datetime.date.today().isoformat()
+            return self.timeouts['past_rates'] if closed else self.timeouts['rates']
+
+        key = f'fx:{FX_BASE}:{start}:{end}'
+        return self.cache.get(key, fetch, timeout, f'Exchange rates of currency "{FX_BASE}" are not available.')
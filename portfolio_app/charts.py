@@ -0,0 +1,268 @@
+import os
+import time
+import uuid
+import hashlib
+import threading
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from matplotlib.figure import Figure
+
+from django.conf import settings
+
+from .timing import record
+
+
+def chart_digest(render, args):
+    """
+    Hashes chart function and chart data, so the same chart of the same data gets the same image name.
+    :param render: chart function
+    :param args: data of the chart, dataframes, series and values with stable repr
+    :return: hex digest, string
+    """
+    digest = hashlib.sha256(render.__name__.encode())
+    for arg in args:
+        if isinstance(arg, (pd.DataFrame, pd.Series)):
+            digest.update(repr(list(arg.columns) if isinstance(arg, pd.DataFrame) else arg.name).encode())
+            digest.update(pd.util.hash_pandas_object(arg, index=True).values.tobytes())
+        else:
+            digest.update(repr(arg).encode())
+        digest.update(b'\0')
+    return digest.hexdigest()[:32]
+
+
+def save_figure(figure, path):
+    """
+    Saves figure to the file and releases it. Figures are created with Figure API and not with pyplot, so they are
+    not kept in pyplot global state and are freed as soon as they are saved.
+    :param figure: Figure object
+    :param path: path of the image file, string
+    """
+    try:
+        figure.savefig(path, format='png')
+    finally:
+        figure.clear()
+
+
+def pie_chart(path, labels, values, portfolio_value, base_currency):
+    """
+    Renders pie chart of current portfolio value.
+    :param path: path of the image file, string
+    :param labels: ticker names, list
+    :param values: values of tickers in base currency, list
+    :param portfolio_value: total portfolio value, float
+    :param base_currency: currency code, string
+    """
+    figure = Figure(figsize=(8, 8))
+    ax = figure.subplots()
+    ax.set_title(f'Total portfolio value: {portfolio_value} {base_currency}')
+    ax.pie(values, labels=labels,
+           autopct=lambda pct: '{:.2f}% ({:.2f} {})'.format(pct, ((pct/100)*portfolio_value), base_currency),
+           pctdistance=1.2, labeldistance=.6, explode=(np.ones(len(values))*0.05), shadow=True)
+    save_figure(figure, path)
+
+
+def stack_chart(path, ticker_values, base_currency):
+    """
+    Renders stackplot of portfolio history.
+    :param path: path of the image file, string
+    :param ticker_values: dataframe with historical values of tickers, tickers as a columns
+    :param base_currency: currency code, string
+    """
+    figure = Figure()
+    ax = figure.subplots()
+    ax.grid(True)
+    ax.stackplot(ticker_values.index, ticker_values.transpose(), labels=list(ticker_values.columns))
+    ax.legend(loc='upper left')
+    ax.set_title('Portfolio total price stacked by Ticker')
+    ax.set_xlabel('Time')
+    ax.set_ylabel(f'Price, {base_currency}')
+    save_figure(figure, path)
+
+
+def line_chart(path, values, title, base_currency):
+    """
+    Renders plot of portfolio total price history.
+    :param path: path of the image file, string
+    :param values: historical total values indexed by dates, Series object
+    :param title: chart title, string
+    :param base_currency: currency code, string
+    """
+    figure = Figure()
+    ax = figure.subplots()
+    ax.plot(values.index, values)
+    ax.grid(True)
+    ax.set_title(title)
+    ax.set_xlabel('Time')
+    ax.set_ylabel(f'Price, {base_currency}')
+    save_figure(figure, path)
+
+
+def bar_chart(path, values, width, title, ylabel):
+    """
+    Renders bar chart of gain / loss, gains are green and losses are red.
+    :param path: path of the image file, string
+    :param values: gain / loss indexed by dates, Series object
+    :param width: width of the bars in days, float
+    :param title: chart title, string
+    :param ylabel: label of y axis, string
+    """
+    figure = Figure()
+    ax = figure.subplots()
+    colors = ['green' if value > 0 else 'red' for value in values]
+    ax.bar(values.index, values, color=colors, width=width)
+    ax.grid(True)
+    ax.set_xlabel('Dates')
+    ax.set_ylabel(ylabel)
+    ax.set_title(title)
+    save_figure(figure, path)
+
+
+class ChartRenderer:
+    """
+    Renders charts to MEDIA_ROOT in a pool of worker threads, so request returns tables without waiting for
+    matplotlib. Pages ask for the state of a chart by its image name (chart_status view) and show it once it is ready.
+
+    Image name is a hash of the chart data, so a chart which was already rendered is served from the existing file
+    and the same chart requested again while it is rendered is not rendered twice. Images are written to a temporary
+    file and renamed when complete, and the least recently used images are removed when the directory grows over
+    CHART_CACHE_MAX_BYTES setting. State of a chart is also kept in marker files next to the image (.<name>.pending,
+    .<name>.failed), so status is known to every process which shares MEDIA_ROOT, not only to the one which renders.
+    """
+    pending_timeout = 300
+
+    def __init__(self, workers=None, media_root=None, max_bytes=None):
+        """
+        :param workers: number of worker threads, CHART_RENDER_WORKERS setting by default;
+        :param media_root: directory of rendered images, MEDIA_ROOT setting by default;
+        :param max_bytes: maximum size of rendered images in bytes, CHART_CACHE_MAX_BYTES setting by default.
+        """
+        self.executor = ThreadPoolExecutor(max_workers=workers or getattr(settings, 'CHART_RENDER_WORKERS', 2),
+                                           thread_name_prefix='chart')
+        self.media_root = media_root or settings.MEDIA_ROOT
+        self.max_bytes = max_bytes or getattr(settings, 'CHART_CACHE_MAX_BYTES', 100 * 1024 * 1024)
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.evict_lock = threading.Lock()
+
+    def path(self, name):
+        return os.path.join(self.media_root, name)
+
+    def marker(self, name, state):
+        return self.path(f'.{name}.{state}')
+
+    def _touch(self, path):
+        with open(path, 'a'):
+            os.utime(path)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def submit(self, prefix, render, *args):
+        """
+        Queues rendering of the chart unless it is already rendered or being rendered.
+        :param prefix: beginning of image file name, string
+        :param render: chart function which takes image path and args
+        :param args: data of the chart, it should not be changed after submit
+        :return: image file name, string
+        """
+        name = f'{prefix}_{chart_digest(render, args)}.png'
+        with self.lock:
+            self.jobs = {job_name: job for job_name, job in self.jobs.items() if not job.done()}
+            if name in self.jobs:
+                return name
+            try:
+                os.utime(self.path(name))
+                return name
+            except FileNotFoundError:
+                pass
+            self._remove(self.marker(name, 'failed'))
+            self._touch(self.marker(name, 'pending'))
+            self.jobs[name] = self.executor.submit(self._render, name, render, args)
+        return name
+
+    def _render(self, name, render, args):
+        started = time.perf_counter()
+        temporary = self.path(f'.{name}.{uuid.uuid4().hex}.tmp')
+        try:
+            render(temporary, *args)
+            os.replace(temporary, self.path(name))
+        except Exception:
+            self._touch(self.marker(name, 'failed'))
+            raise
+        finally:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            self._remove(self.marker(name, 'pending'))
+            record(f'render_{render.__name__}', 'render', time.perf_counter() - started)
+        self.evict()
+
+    def evict(self):
+        """
+        Removes least recently used (oldest modification time) images until their total size is within max_bytes.
+        """
+        with self.evict_lock:
+            images = []
+            for entry in os.scandir(self.media_root):
+                if entry.name.endswith('.png') and not entry.name.startswith('.') and entry.is_file():
+                    stat = entry.stat()
+                    images.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in images)
+            for _, size, path in sorted(images):
+                if total <= self.max_bytes:
+                    break
+                self._remove(path)
+                total -= size
+
+    def status(self, name):
+        """
+        State of the chart from the job of this process or, when chart is rendered by other process, from the image
+        and marker files (pending marker older than pending_timeout is left by a process which stopped).
+        :param name: image file name, string
+        :return: 'pending', 'ready', 'failed' or 'missing'
+        """
+        with self.lock:
+            job = self.jobs.get(name)
+        if job is not None:
+            if not job.done():
+                return 'pending'
+            if job.exception() is not None:
+                return 'failed'
+        if os.path.exists(self.path(name)):
+            return 'ready'
+        try:
+            if time.time() - os.path.getmtime(self.marker(name, 'pending')) < self.pending_timeout:
+                return 'pending'
+        except FileNotFoundError:
+            pass
+        return 'failed' if os.path.exists(self.marker(name, 'failed')) else 'missing'
+
+    def wait(self, name, timeout=None):
+        """
+        Blocks until the chart is rendered, e.g. in management commands and tests.
+        :param name: image file name, string
+        :param timeout: maximum time to wait in seconds, float
+        """
+        with self.lock:
+            job = self.jobs.get(name)
+        if job is not None:
+            job.result(timeout)
+
+
+_renderer = None
+_renderer_lock = threading.Lock()
+
+
+def get_chart_renderer():
+    """
+    Returns chart renderer shared by all requests of the process.
+    :return: ChartRenderer object
+    """
+    global _renderer
+    with _renderer_lock:
+        if _renderer is None:
+            _renderer = ChartRenderer()
+        return _renderer
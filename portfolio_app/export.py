@@ -0,0 +1,94 @@
+import io
+import os
+import csv
+import pandas as pd
+
+from django.conf import settings
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+TABLES = ('current', 'history', 'gain', 'gain_percent')
+
+FORMATS = {'csv': 'text/csv', 'parquet': 'application/vnd.apache.parquet'}
+
+
+class Echo:
+    """
+    File-like object which returns written value instead of storing it, so csv.writer can produce rows for
+    StreamingHttpResponse.
+    """
+
+    def write(self, value):
+        return value
+
+
+def export_frame(calculator, table):
+    """
+    Calculates table which is exported, charts are not rendered and nothing is written to the disk.
+    :param calculator: Calculator object
+    :param table: 'current', 'history', 'gain' (absolute) or 'gain_percent' (relative), string
+    :return: dataframe, with dates as an index for history and gain tables
+    """
+    if table == 'current':
+        return calculator.current_portfolio_value()[1]
+    if table == 'history':
+        return calculator.get_history()[0]
+    data_gain_abs, data_gain, _, _ = calculator.get_gain()
+    return data_gain_abs if table == 'gain' else data_gain
+
+
+def csv_rows(frame):
+    """
+    Yields dataframe as CSV lines one by one, so the whole file is never built in memory.
+    :param frame: dataframe, index is written as a first column when it has a name (dates of history and gain)
+    :return: generator of strings
+    """
+    writer = csv.writer(Echo())
+    if frame.index.name is None:
+        yield writer.writerow(list(frame.columns))
+        for row in frame.itertuples(index=False, name=None):
+            yield writer.writerow(row)
+        return
+
+    yield writer.writerow([frame.index.name] + list(frame.columns))
+    for row in frame_rows(frame):
+        yield writer.writerow(row)
+
+
+def frame_rows(frame):
+    """
+    Converts dataframe rows to plain tuples once (index label first, dates as YYYY-MM-DD), so templates and CSV
+    writer iterate over tuples and not over a Series per row made by iterrows.
+    :param frame: dataframe indexed by labels, e.g. dates of history and gain
+    :return: generator of tuples
+    """
+    index = frame.index
+    if isinstance(index, pd.DatetimeIndex):
+        index = index.strftime('%Y-%m-%d')
+    for label, row in zip(index, frame.itertuples(index=False, name=None)):
+        yield (label,) + row
+
+
+def parquet_bytes(frame):
+    """
+    :param frame: dataframe
+    :return: dataframe in Parquet format, bytes
+    """
+    buffer = io.BytesIO()
+    frame.to_parquet(buffer, engine='pyarrow')
+    return buffer.getvalue()
+
+
+def audit_path(name):
+    """
+    Returns path of CSV audit file in EXPORT_AUDIT_DIR setting directory (current directory when it is not set).
+    :param name: file name, string
+    :return: path, string
+    """
+    directory = getattr(settings, 'EXPORT_AUDIT_DIR', None) or os.getcwd()
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, name)
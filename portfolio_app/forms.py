@@ -34,6 +34,20 @@ CURRENCY_CHOISES = [
     ("USD", "United States Dollar"),
     ("ZAR", "South African Rand")
 ]
+
+PERIOD_CHOICES = [
+    ("1y", "1 year"),
+    ("5y", "5 years"),
+    ("10y", "10 years"),
+    ("max", "Maximum"),
+]
+
+INTERVAL_CHOICES = [
+    ("1mo", "Monthly"),
+    ("1wk", "Weekly"),
+    ("1d", "Daily"),
+]
+
 class PortfolioForm(forms.ModelForm):
     class Meta:
         model = Portfolio
@@ -43,6 +57,8 @@ class PortfolioForm(forms.ModelForm):
 
 class CurrencyForm(forms.Form):
     base_currency = forms.ChoiceField(choices=CURRENCY_CHOISES, label="Select base currency")
+    period = forms.ChoiceField(choices=PERIOD_CHOICES, initial="1y", label="Select history period")
+    interval = forms.ChoiceField(choices=INTERVAL_CHOICES, initial="1mo", label="Select history interval")
     portfolio_id = forms.IntegerField(widget=forms.HiddenInput())
 
 
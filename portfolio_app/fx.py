@@ -0,0 +1,90 @@
+import pandas as pd
+
+from .providers import MarketDataError
+
+
+FX_BASE = 'EUR'
+
+
+class FxMatrix:
+    """
+    Exchange rates of all currencies relatively to one base currency (EUR, as Frankfurter API publishes them) for one
+    or many dates. Rates of any other base currency are derived by triangulation through EUR, so one upstream
+    request serves every base currency.
+    """
+
+    def __init__(self, rates, base=FX_BASE):
+        """
+        :param rates: dataframe indexed by dates with currency codes as a columns, units of currency per one base
+         currency unit
+        :param base: currency code of rates, string
+        """
+        self.base = base
+        self.rates = rates.astype(float).assign(**{base: 1.0}).sort_index(axis=1)
+
+    @classmethod
+    def from_payload(cls, payload):
+        """
+        :param payload: latest rates ('date', 'rates' of currencies) or rates by date ('rates' of dates) dictionary in
+         Frankfurter API format
+        :return: FxMatrix object
+        """
+        rates = payload.get('rates', {})
+        if 'date' in payload:
+            rates = {payload['date']: rates}
+        frame = pd.DataFrame.from_dict(rates, orient='index', dtype=float)
+        frame.index = pd.to_datetime(frame.index)
+        return cls(frame, base=payload.get('base', FX_BASE))
+
+    @property
+    def currencies(self):
+        return list(self.rates.columns)
+
+    def rebased(self, currency):
+        """
+        Returns rates relatively to the currency: rate of quote currency is its rate divided by the rate of the
+        currency (cross rate through the base currency).
+        :param currency: currency code, string
+        :return: dataframe indexed by dates with currency codes (without currency itself) as a columns
+        """
+        if currency not in self.rates.columns:
+            raise MarketDataError(f'Currency "{currency}" is not supported.')
+        return self.rates.div(self.rates[currency], axis=0).drop(columns=currency)
+
+    def latest_payload(self, currency):
+        """
+        :param currency: currency code, string
+        :return: latest rates relatively to the currency, dictionary in Frankfurter API format
+        """
+        if self.rates.empty:
+            return {'amount': 1.0, 'base': currency, 'rates': {}}
+        rates = self.rebased(currency).iloc[-1]
+        return {'amount': 1.0, 'base': currency, 'date': rates.name.strftime('%Y-%m-%d'),
+                'rates': rates.dropna().to_dict()}
+
+    def by_date_payload(self, currency, start, end):
+        """
+        :param currency: currency code, string
+        :param start: start date, string
+        :param end: end date, string
+        :return: rates of every date between start and end relatively to the currency, dictionary in Frankfurter API
+         format
+        """
+        rates = self.rebased(currency).loc[start:end] if not self.rates.empty else pd.DataFrame()
+        return {'amount': 1.0, 'base': currency, 'start_date': str(start), 'end_date': str(end),
+                'rates': {date.strftime('%Y-%m-%d'): row.dropna().to_dict() for date, row in rates.iterrows()}}
+
+
+def rebase_payload(payload, currency):
+    """
+    Converts rates payload of one base currency (EUR) to rates payload of another currency.
+    :param payload: latest rates or rates by date, dictionary in Frankfurter API format
+    :param currency: currency code, string
+    :return: dictionary in Frankfurter API format
+    """
+    if payload.get('base') == currency:
+        return payload
+    matrix = FxMatrix.from_payload(payload)
+    if 'date' in payload:
+        return matrix.latest_payload(currency)
+    return matrix.by_date_payload(currency, payload.get('start_date'), payload.get('end_date'))
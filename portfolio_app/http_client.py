@@ -0,0 +1,140 @@
+import time
+import threading
+import collections
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from django.conf import settings
+
+
+DEFAULT_OPTIONS = {
+    'connect_timeout': 3.05,
+    'read_timeout': 10,
+    'retries': 3,
+    'backoff': 0.5,
+    'pool_size': 10,
+    'validators': 256,
+}
+
+
+class HttpClient:
+    """
+    HTTP client of market data APIs shared by the whole process. Connections are kept alive in urllib3 pools of one
+    requests.Session, every request has connect and read timeouts, failed GET requests (connection errors, 429 and
+    5xx responses) are retried with exponential backoff, and responses with ETag or Last-Modified headers are
+    requested again conditionally, so unchanged data is not downloaded again (304 Not Modified).
+    """
+
+    def __init__(self, options=None):
+        """
+        :param options: dictionary which overrides DEFAULT_OPTIONS and MARKET_DATA_HTTP setting.
+        """
+        self.options = {**DEFAULT_OPTIONS, **getattr(settings, 'MARKET_DATA_HTTP', {}), **(options or {})}
+        retry = Retry(total=self.options['retries'], backoff_factor=self.options['backoff'],
+                      status_forcelist=(429, 500, 502, 503, 504), allowed_methods=frozenset(['GET']),
+                      respect_retry_after_header=True, raise_on_status=False)
+        self.adapter = HTTPAdapter(pool_connections=self.options['pool_size'],
+                                   pool_maxsize=self.options['pool_size'], max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+        self.validators = collections.OrderedDict()
+        self.metrics = collections.Counter()
+        self.latency = collections.defaultdict(lambda: {'count': 0, 'total': 0.0, 'max': 0.0})
+        self.lock = threading.Lock()
+
+    def get_json(self, url, params=None):
+        """
+        Requests URL and returns decoded JSON response.
+        :param url: URL, string
+        :param params: query parameters, dictionary
+        :return: decoded JSON response
+        :raises requests.RequestException: when request fails after retries or response status is an error
+        """
+        key = (url, tuple(sorted((params or {}).items())))
+        with self.lock:
+            validator = self.validators.get(key)
+        headers = {}
+        if validator is not None:
+            if validator['etag']:
+                headers['If-None-Match'] = validator['etag']
+            if validator['last_modified']:
+                headers['If-Modified-Since'] = validator['last_modified']
+
+        started = time.monotonic()
+        try:
+            response = self.session.get(url, params=params, headers=headers,
+                                        timeout=(self.options['connect_timeout'], self.options['read_timeout']))
+        except requests.RequestException:
+            self._record(url, started, 'failed')
+            raise
+
+        if response.status_code == 304 and validator is not None:
+            self._record(url, started, 'not_modified')
+            with self.lock:
+                self.validators.move_to_end(key)
+            return validator['payload']
+        if not response.ok:
+            self._record(url, started, 'failed')
+        response.raise_for_status()
+        self._record(url, started, 'ok')
+
+        payload = response.json()
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if etag or last_modified:
+            with self.lock:
+                self.validators[key] = {'etag': etag, 'last_modified': last_modified, 'payload': payload}
+                self.validators.move_to_end(key)
+                while len(self.validators) > self.options['validators']:
+                    self.validators.popitem(last=False)
+        return payload
+
+    def _record(self, url, started, outcome):
+        elapsed = time.monotonic() - started
+        host = requests.utils.urlparse(url).netloc
+        with self.lock:
+            self.metrics[outcome] += 1
+            latency = self.latency[host]
+            latency['count'] += 1
+            latency['total'] += elapsed
+            latency['max'] = max(latency['max'], elapsed)
+
+    def stats(self):
+        """
+        Returns request counts, latency per host and connection reuse of pools (requests sent over a connection
+        which was already open are reused).
+        :return: dictionary
+        """
+        pools = {}
+        for pool_key in list(self.adapter.poolmanager.pools.keys()):
+            pool = self.adapter.poolmanager.pools.get(pool_key)
+            if pool is None:
+                continue
+            pools[f'{pool.scheme}://{pool.host}'] = {
+                'connections': pool.num_connections,
+                'requests': pool.num_requests,
+                'reused': pool.num_requests - pool.num_connections,
+                'idle': pool.pool.qsize() if pool.pool is not None else 0,
+            }
+        with self.lock:
+            latency = {host: {'count': value['count'], 'mean': value['total'] / value['count'], 'max': value['max']}
+                       for host, value in self.latency.items() if value['count']}
+            return {'requests': dict(self.metrics), 'latency': latency, 'pools': pools}
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_http_client():
+    """
+    Returns HTTP client shared by all requests of the process.
+    :return: HttpClient object
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = HttpClient()
+        return _client
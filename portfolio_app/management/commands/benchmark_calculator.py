@@ -0,0 +1,189 @@
+import sys
+import json
+import time
+import platform
+import statistics
+import tempfile
+import tracemalloc
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from portfolio_app.charts import ChartRenderer
+from portfolio_app.export import TABLES, export_frame, csv_rows
+from portfolio_app.models import Item
+from portfolio_app.providers import FixtureProvider, FIXTURE_PATH, load_fixture
+from portfolio_app.utils import Calculator
+
+
+SIZES = (1, 10, 100, 1000)
+
+PHASES = ('compute', 'render', 'csv')
+
+
+class BenchmarkStocks:
+
+    def __init__(self, items):
+        self.items = items
+
+    def all(self):
+        return self.items
+
+
+class BenchmarkPortfolio:
+    """
+    Portfolio which is not stored in the database, Calculator reads only its Items (and does not look for stored
+    valuations, since it has no primary key).
+    """
+    pk = None
+
+    def __init__(self, holdings):
+        """
+        :param holdings: dictionary with ticker names as a keys and quantities as a values
+        """
+        self.stocks = BenchmarkStocks([Item(ticker=ticker, quantity=quantity) for ticker, quantity in holdings.items()])
+
+
+def synthetic_market_data(data, size, mixed):
+    """
+    Makes recorded market data of any number of tickers: every synthetic ticker copies quote and history of one
+    recorded ticker, scaled, so portfolios of any size are valued with real price and exchange rate movements.
+    :param data: recorded market data, dictionary in FixtureProvider format
+    :param size: number of tickers, integer
+    :param mixed: if True tickers are copied from recorded tickers of all currencies, otherwise only from USD tickers
+    :return:    data - market data dictionary in FixtureProvider format;
+                holdings - dictionary with synthetic ticker names as a keys and quantities as a values.
+    """
+    templates = [ticker for ticker, quote in data['quotes'].items() if mixed or quote['currency'] == 'USD']
+    quotes = {}
+    history = {interval: {'dates': series['dates'], 'closes': {}} for interval, series in data['history'].items()}
+    holdings = {}
+    for number in range(size):
+        template = templates[number % len(templates)]
+        ticker = f'SYN{number:04d}-{template}'
+        scale = 1 + (number % 17) / 10
+        quote = data['quotes'][template]
+        quotes[ticker] = {'currentPrice': round(quote['currentPrice'] * scale, 2), 'currency': quote['currency']}
+        for interval, series in data['history'].items():
+            closes = series['closes'].get(template)
+            if closes is not None:
+                history[interval]['closes'][ticker] = [None if close is None else close * scale for close in closes]
+        holdings[ticker] = 1 + number % 50
+    return {'recorded': data['recorded'], 'quotes': quotes, 'history': history, 'fx': data['fx']}, holdings
+
+
+class Command(BaseCommand):
+    help = ('Measures Calculator hot paths (current_portfolio_value, get_history, get_gain, charts and CSV export) '
+            'on recorded market data without network, for portfolios of several sizes with tickers in one currency '
+            'and in mixed currencies. Results are written as JSON to stdout or to a file.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default=','.join(str(size) for size in SIZES),
+                            help='Comma separated numbers of portfolio tickers.')
+        parser.add_argument('--currencies', choices=['single', 'mixed', 'both'], default='both',
+                            help='Tickers in USD only, in mixed currencies or both cases.')
+        parser.add_argument('--base-currency', default='EUR')
+        parser.add_argument('--period', default='1y')
+        parser.add_argument('--interval', default='1mo')
+        parser.add_argument('--repeat', type=int, default=3,
+                            help='Number of timed runs of every case, medians are reported.')
+        parser.add_argument('--fixture', default=FIXTURE_PATH, help='Recorded market data file.')
+        parser.add_argument('--output', default='-',
+                            help='Path of the JSON results file, - (default) writes JSON to stdout.')
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options['sizes'].split(',')]
+        except ValueError:
+            raise CommandError(f'Sizes "{options["sizes"]}" should be comma separated integers.')
+        mixes = {'single': [False], 'mixed': [True], 'both': [False, True]}[options['currencies']]
+        data = load_fixture(options['fixture'])
+
+        results = []
+        for size in sizes:
+            for mixed in mixes:
+                market_data, holdings = synthetic_market_data(data, size, mixed)
+                result = self.measure(market_data, holdings, options)
+                result.update(size=size, currencies='mixed' if mixed else 'single',
+                              currency_count=len({market_data['quotes'][ticker]['currency'] for ticker in holdings}))
+                results.append(result)
+                self.stderr.write(f'{size:>5} {result["currencies"]:<6} wall {result["wall_s"]:.3f} s, compute '
+                                  f'{result["compute_s"]:.3f} s, render {result["render_s"]:.3f} s, csv '
+                                  f'{result["csv_s"]:.3f} s, {result["upstream_calls_total"]} upstream calls, peak '
+                                  f'{result["peak_memory_bytes"] / 2 ** 20:.1f} MiB')
+
+        report = {
+            'recorded': data['recorded'],
+            'python': platform.python_version(),
+            'base_currency': options['base_currency'],
+            'period': options['period'],
+            'interval': options['interval'],
+            'repeat': options['repeat'],
+            'results': results,
+        }
+        if options['output'] == '-':
+            json.dump(report, sys.stdout, indent=2)
+        else:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2)
+            self.stderr.write(f'Results written to {options["output"]}.')
+
+    def measure(self, market_data, holdings, options):
+        """
+        Runs the case repeat times for timings and once more under tracemalloc for peak memory (tracing slows the
+        run down, so it is not timed).
+        :return: dictionary with median times in seconds, upstream calls and peak memory in bytes
+        """
+        runs = [self.run(market_data, holdings, options) for _ in range(options['repeat'])]
+        tracemalloc.start()
+        try:
+            self.run(market_data, holdings, options)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        result = {f'{name}_s': statistics.median(run[name] for run in runs) for name in ('wall',) + PHASES}
+        result['upstream_calls'] = runs[0]['calls']
+        result['upstream_calls_total'] = sum(runs[0]['calls'].values())
+        result['peak_memory_bytes'] = peak
+        return result
+
+    def run(self, market_data, holdings, options):
+        """
+        Values the portfolio from scratch: calculations without charts, then charts (rendered by a new renderer into
+        a temporary directory, so nothing is served from earlier runs), then CSV export of every table. Charts and
+        audit files are written to a temporary directory which is removed afterwards.
+        :return: dictionary with wall and phase times in seconds and provider calls
+        """
+        provider = FixtureProvider(data=market_data)
+        timings = {}
+        with tempfile.TemporaryDirectory(prefix='benchmark-') as directory, \
+                override_settings(EXPORT_AUDIT_DIR=directory):
+            renderer = ChartRenderer(workers=1, media_root=directory)
+            try:
+                started = time.perf_counter()
+                calculator = Calculator(BenchmarkPortfolio(holdings), options['base_currency'], provider=provider,
+                                        period=options['period'], interval=options['interval'], renderer=renderer)
+                calculator.current_portfolio_value()
+                calculator.get_history()
+                calculator.get_gain()
+                timings['compute'] = time.perf_counter() - started
+
+                phase = time.perf_counter()
+                names = [calculator.current_portfolio_value(charts=True)[4], *calculator.get_history(charts=True)[1:],
+                         *calculator.get_gain(charts=True)[2:]]
+                for name in names:
+                    if name is not None:
+                        renderer.wait(name)
+                timings['render'] = time.perf_counter() - phase
+
+                phase = time.perf_counter()
+                for table in TABLES:
+                    for _ in csv_rows(export_frame(calculator, table)):
+                        pass
+                timings['csv'] = time.perf_counter() - phase
+                timings['wall'] = time.perf_counter() - started
+            finally:
+                renderer.executor.shutdown()
+        timings['calls'] = dict(provider.calls)
+        return timings
@@ -0,0 +1,74 @@
+import time
+import logging
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from portfolio_app.providers import get_default_provider
+from portfolio_app.snapshot import local_now
+from portfolio_app.valuation import (holdings_frame, value_holdings, store_valuations, save_valuations,
+                                     portfolios_without_history, market_snapshot, history_valuations)
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ('Values all portfolios at once and stores results as PortfolioValuation rows, meant to run daily. Quotes '
+            'of the union of all held tickers are requested once, and all portfolios are valued with vectorized math. '
+            'Portfolios with stored history get only the valuation of the new day, history of new portfolios (and of '
+            'portfolios whose items changed) is calculated for the whole history period.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--base-currency', action='append', dest='base_currencies', metavar='CURRENCY',
+                            help='Base currency of valuations (can be repeated, VALUATION_CURRENCIES setting by '
+                                 'default).')
+        parser.add_argument('--history-period', default=getattr(settings, 'VALUATION_HISTORY_PERIOD', '1y'),
+                            help='Period of daily history stored for portfolios without history.')
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='Number of valuations written with one query.')
+
+    def handle(self, *args, **options):
+        base_currencies = options['base_currencies'] or getattr(settings, 'VALUATION_CURRENCIES', ['EUR'])
+        started = time.monotonic()
+        time_of_request = local_now()
+        date = time_of_request.date()
+
+        holdings = holdings_frame()
+        tickers = sorted(holdings['ticker'].unique())
+        provider = get_default_provider()
+        quotes, errors = provider.get_quotes(tickers)
+        logger.info('Read %s holdings of %s portfolios, requested %s tickers in %.1f s.', len(holdings),
+                    holdings['portfolio'].nunique(), len(tickers), time.monotonic() - started)
+
+        backfills = {base_currency: portfolios_without_history(base_currency, date)
+                     for base_currency in base_currencies}
+        backfilled = holdings[holdings['portfolio'].isin(set().union(*backfills.values()))]
+
+        for base_currency in base_currencies:
+            valuations = []
+            portfolios = backfilled[backfilled['portfolio'].isin(backfills[base_currency])]
+            if not portfolios.empty:
+                # History of all tickers is requested once, portfolios are valued from parts of it.
+                market = market_snapshot(sorted(portfolios['ticker'].unique()), base_currency, provider,
+                                         time_of_request, options['history_period'])
+                for portfolio, group in portfolios.groupby('portfolio'):
+                    portfolio_valuations, history_errors = history_valuations(
+                        portfolio, dict(zip(group['ticker'], group['quantity'])), market)
+                    valuations.extend(portfolio_valuations)
+                    errors.update(history_errors)
+                    if len(valuations) >= options['batch_size']:
+                        save_valuations(valuations, options['batch_size'])
+                        valuations = []
+            save_valuations(valuations, options['batch_size'])
+            logger.info('Stored history of %s portfolios in %s.', len(backfills[base_currency]), base_currency)
+
+            exchange_rates = provider.get_rates(base_currency)
+            values, totals, value_errors = value_holdings(holdings, quotes, exchange_rates, base_currency)
+            errors.update(value_errors)
+            stored = store_valuations(values, totals, base_currency, date, options['batch_size'])
+            logger.info('Stored %s valuations in %s.', stored, base_currency)
+
+        for ticker, error in errors.items():
+            logger.warning('%s: %s', ticker, error)
+        logger.info('Valued portfolios in %.1f s.', time.monotonic() - started)
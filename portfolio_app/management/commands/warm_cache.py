@@ -0,0 +1,102 @@
+import time
+import logging
+import datetime
+from asgiref.sync import async_to_sync
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from portfolio_app.fx import FX_BASE
+from portfolio_app.models import Item
+from portfolio_app.providers import get_default_provider, chunks
+from portfolio_app.snapshot import PortfolioSnapshot
+from portfolio_app.tickers import register
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ('Periodically requests quotes, history and exchange rates of all tickers held in portfolios, so they are '
+            'in the market data cache and database before users open their portfolios. Exchange rates are warmed '
+            'for EUR only, rates of every base currency are derived from them. Cache is shared with web processes '
+            'only when MARKET_DATA_CACHE is a shared backend (Redis, Memcached), stored history and ticker '
+            'registry are shared always.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=int, default=getattr(settings, 'WARM_CACHE_INTERVAL', 300),
+                            help='Seconds between refreshes (WARM_CACHE_INTERVAL setting by default).')
+        parser.add_argument('--history', action='append', metavar='PERIOD:INTERVAL',
+                            help='History to warm, e.g. 1y:1mo (can be repeated, 1y:1mo by default).')
+        parser.add_argument('--batch-size', type=int, default=200,
+                            help='Number of tickers requested at once.')
+        parser.add_argument('--timeout', type=int, default=60,
+                            help='Maximum time of one market data request of a batch in seconds.')
+        parser.add_argument('--max-backoff', type=int, default=3600,
+                            help='Maximum pause in seconds after failed refreshes.')
+        parser.add_argument('--once', action='store_true',
+                            help='Refresh once and exit instead of running as a worker.')
+
+    def handle(self, *args, **options):
+        histories = []
+        for value in options['history'] or ['1y:1mo']:
+            period, _, interval = value.partition(':')
+            if not interval:
+                raise CommandError(f'History "{value}" should be given as PERIOD:INTERVAL, e.g. 1y:1mo.')
+            histories.append((period, interval))
+
+        failures = 0
+        while True:
+            try:
+                warmed, errors = self.warm(histories, options['batch_size'], options['timeout'])
+            except Exception:
+                logger.exception('Market data warming failed.')
+                warmed, errors = 0, None
+            if errors is None or (warmed == 0 and errors):
+                failures += 1
+            else:
+                failures = 0
+            if options['once']:
+                return
+
+            pause = options['interval']
+            if failures:
+                # Upstream is failing or rate limiting, back off exponentially instead of retrying at full rate.
+                pause = min(options['max_backoff'], options['interval'] * 2 ** (failures - 1))
+                logger.warning('Refresh failed %s time(s) in a row, next refresh in %s s.', failures, pause)
+            time.sleep(pause)
+
+    def warm(self, histories, batch_size, timeout=60):
+        """
+        Requests market data of all held tickers in batches through the configured provider chain and updates their
+        currency and exchange in the ticker registry.
+        :param histories: list of (period, interval) tuples
+        :param batch_size: number of tickers requested at once, integer
+        :param timeout: maximum time of one market data request in seconds, integer
+        :return:    warmed - number of tickers with quote;
+                    errors - dictionary with ticker names as a keys and error messages as a values.
+        """
+        started = time.monotonic()
+        tickers = list(Item.objects.order_by('ticker').values_list('ticker', flat=True).distinct())
+        provider = get_default_provider()
+        now = datetime.datetime.now(datetime.timezone.utc)
+        warmed = 0
+        errors = {}
+        for batch in chunks(tickers, batch_size):
+            snapshot = PortfolioSnapshot({ticker: 1 for ticker in batch}, FX_BASE, provider, now)
+            async_to_sync(snapshot.aprefetch)(history=False, timeout=timeout)
+            snapshot.fetch('currencies')
+            errors.update(snapshot.errors)
+            register(snapshot.quotes, now)
+            warmed += len(snapshot.quotes)
+            for period, interval in histories:
+                # Quotes and currencies of the batch are reused, only history of every period is requested.
+                history = snapshot.subset(snapshot.holdings, period=period, interval=interval)
+                async_to_sync(history.aprefetch)(current=False, timeout=timeout)
+                errors.update(history.errors)
+        logger.info('Warmed %s of %s tickers, %s history, %s exchange rates in %.1f s.', warmed, len(tickers),
+                    ', '.join(f'{period}:{interval}' for period, interval in histories), FX_BASE,
+                    time.monotonic() - started)
+        for ticker, error in errors.items():
+            logger.warning('%s: %s', ticker, error)
+        return warmed, errors
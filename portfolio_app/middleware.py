@@ -0,0 +1,26 @@
+from asgiref.sync import iscoroutinefunction
+from django.utils.decorators import sync_and_async_middleware
+
+from .timing import Timings
+
+
+@sync_and_async_middleware
+def server_timing_middleware(get_response):
+    """
+    Gives every request Timings object (request.timings), which views pass to Calculator, and adds totals of its
+    spans to the response as Server-Timing header, so browser developer tools show where time of the request went.
+    """
+
+    def finish(request, response):
+        response['Server-Timing'] = request.timings.server_timing()
+        return response
+
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            request.timings = Timings()
+            return finish(request, await get_response(request))
+    else:
+        def middleware(request):
+            request.timings = Timings()
+            return finish(request, get_response(request))
+    return middleware
@@ -0,0 +1,68 @@
+# Generated by Django 5.1 on 2026-10-18 17:57
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio_app', '0006_delete_profile'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RateSeries',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('base', models.CharField(max_length=3, unique=True)),
+                ('start', models.DateField()),
+                ('end', models.DateField()),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'ordering': ['base'],
+            },
+        ),
+        migrations.CreateModel(
+            name='PriceSeries',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ticker', models.CharField(max_length=200)),
+                ('interval', models.CharField(max_length=10)),
+                ('start', models.DateField()),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'ordering': ['ticker', 'interval'],
+                'constraints': [models.UniqueConstraint(fields=('ticker', 'interval'), name='unique_price_series')],
+            },
+        ),
+        migrations.CreateModel(
+            name='PriceBar',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('close', models.FloatField()),
+                ('series', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='bars', to='portfolio_app.priceseries')),
+            ],
+            options={
+                'ordering': ['series', 'date'],
+                'constraints': [models.UniqueConstraint(fields=('series', 'date'), name='unique_price_bar')],
+            },
+        ),
+        migrations.CreateModel(
+            name='Rate',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('currency', models.CharField(max_length=3)),
+                ('rate', models.FloatField()),
+                ('series', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rates', to='portfolio_app.rateseries')),
+            ],
+            options={
+                'ordering': ['series', 'date', 'currency'],
+                'constraints': [models.UniqueConstraint(fields=('series', 'date', 'currency'), name='unique_rate')],
+            },
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.1 on 2026-10-18 21:30
+
+from django.db import migrations
+
+
+def delete_non_eur_rates(apps, schema_editor):
+    """
+    Exchange rates are stored only for EUR since rates of other base currencies are derived from them.
+    """
+    RateSeries = apps.get_model('portfolio_app', 'RateSeries')
+    RateSeries.objects.exclude(base='EUR').delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio_app', '0007_rateseries_priceseries_pricebar_rate'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_non_eur_rates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.1 on 2026-10-18 21:45
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio_app', '0008_delete_non_eur_rateseries'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PortfolioValuation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('base_currency', models.CharField(max_length=3)),
+                ('date', models.DateField()),
+                ('value', models.FloatField()),
+                ('values', models.JSONField(default=dict)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('portfolio', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='valuations', to='portfolio_app.portfolio')),
+            ],
+            options={
+                'ordering': ['portfolio', 'base_currency', 'date'],
+                'constraints': [models.UniqueConstraint(fields=('portfolio', 'base_currency', 'date'), name='unique_portfolio_valuation')],
+            },
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.1 on 2026-10-18 22:00
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def merge_duplicate_items(apps, schema_editor):
+    """
+    Merges Items of the same ticker in a portfolio into the first of them (quantities are added up), so unique
+    constraint can be created without losing holdings.
+    """
+    Item = apps.get_model('portfolio_app', 'Item')
+    duplicates = (Item.objects.values('portfolio_id', 'ticker')
+                  .annotate(first=models.Min('pk'), quantity=models.Sum('quantity'), count=models.Count('pk'))
+                  .filter(count__gt=1))
+    for duplicate in duplicates:
+        Item.objects.filter(pk=duplicate['first']).update(quantity=duplicate['quantity'])
+        (Item.objects.filter(portfolio_id=duplicate['portfolio_id'], ticker=duplicate['ticker'])
+         .exclude(pk=duplicate['first']).delete())
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio_app', '0009_portfoliovaluation'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_items, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='item',
+            constraint=models.UniqueConstraint(fields=('portfolio_id', 'ticker'), name='unique_portfolio_item'),
+        ),
+    ]
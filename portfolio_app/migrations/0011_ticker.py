@@ -0,0 +1,26 @@
+# Generated by Django 5.1 on 2026-10-18 22:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('portfolio_app', '0010_item_unique_portfolio_item'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Ticker',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('symbol', models.CharField(max_length=200, unique=True)),
+                ('currency', models.CharField(max_length=3)),
+                ('exchange', models.CharField(blank=True, max_length=50)),
+                ('last_verified', models.DateTimeField()),
+            ],
+            options={
+                'ordering': ['symbol'],
+            },
+        ),
+    ]
@@ -4,11 +4,34 @@ from django.contrib.auth.models import User
 # Create your models here.
 
 
+class PortfolioQuerySet(models.QuerySet):
+    """
+    Access paths of portfolios used by views, so pages make the same number of queries however many portfolios and
+    items user has.
+    """
+
+    def for_user(self, user):
+        """
+        :param user: User object
+        :return: portfolios of the user
+        """
+        return self.filter(user=user)
+
+    def with_stocks(self):
+        """
+        :return: portfolios with their Items loaded by one additional query (portfolio.stocks.all() does not query the
+         database again)
+        """
+        return self.prefetch_related('stocks')
+
+
 class Portfolio(models.Model):
     title = models.CharField(max_length=150)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     created = models.DateField(auto_now_add=True)
 
+    objects = PortfolioQuerySet.as_manager()
+
     class Meta:
         ordering = ['created']
 
@@ -26,6 +49,105 @@ class Item(models.Model):
 
     class Meta:
         ordering = ['ticker']
+        constraints = [models.UniqueConstraint(fields=['portfolio_id', 'ticker'], name='unique_portfolio_item')]
+
+    def __str__(self):
+        return f'{self.ticker} {self.quantity}'
+
+class PriceSeries(models.Model):
+    """
+    Stored close prices history of one ticker on one interval. start is the first date from which all bars are
+    stored (date(1900, 1, 1) when history was fetched for the whole ticker lifetime).
+    """
+    ticker = models.CharField(max_length=200)
+    interval = models.CharField(max_length=10)
+    start = models.DateField()
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['ticker', 'interval']
+        constraints = [models.UniqueConstraint(fields=['ticker', 'interval'], name='unique_price_series')]
+
+    def __str__(self):
+        return f'{self.ticker} {self.interval}'
+
+
+class PriceBar(models.Model):
+    series = models.ForeignKey(PriceSeries, on_delete=models.CASCADE, related_name='bars')
+    date = models.DateField()
+    close = models.FloatField()
+
+    class Meta:
+        ordering = ['series', 'date']
+        constraints = [models.UniqueConstraint(fields=['series', 'date'], name='unique_price_bar')]
+
+    def __str__(self):
+        return f'{self.series} {self.date} {self.close}'
+
+
+class RateSeries(models.Model):
+    """
+    Stored daily exchange rates relatively to the base currency, all working days from start to end are stored.
+    """
+    base = models.CharField(max_length=3, unique=True)
+    start = models.DateField()
+    end = models.DateField()
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['base']
+
+    def __str__(self):
+        return f'{self.base} {self.start}..{self.end}'
+
+
+class Rate(models.Model):
+    series = models.ForeignKey(RateSeries, on_delete=models.CASCADE, related_name='rates')
+    date = models.DateField()
+    currency = models.CharField(max_length=3)
+    rate = models.FloatField()
+
+    class Meta:
+        ordering = ['series', 'date', 'currency']
+        constraints = [models.UniqueConstraint(fields=['series', 'date', 'currency'], name='unique_rate')]
+
+    def __str__(self):
+        return f'{self.series.base}/{self.currency} {self.date} {self.rate}'
+
+
+class PortfolioValuation(models.Model):
+    """
+    Value of the portfolio in the base currency on one date: total value and value of every ticker (values,
+    dictionary with ticker names as a keys).
+    """
+    portfolio = models.ForeignKey(Portfolio, on_delete=models.CASCADE, related_name='valuations')
+    base_currency = models.CharField(max_length=3)
+    date = models.DateField()
+    value = models.FloatField()
+    values = models.JSONField(default=dict)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['portfolio', 'base_currency', 'date']
+        constraints = [models.UniqueConstraint(fields=['portfolio', 'base_currency', 'date'],
+                                               name='unique_portfolio_valuation')]
+
+    def __str__(self):
+        return f'{self.portfolio} {self.date} {self.value} {self.base_currency}'
+
+
+class Ticker(models.Model):
+    """
+    Metadata of a ticker which was found by the market data provider: currency in which it is traded, exchange and
+    time of the last successful check (registry of tickers used by add item form and Calculator).
+    """
+    symbol = models.CharField(max_length=200, unique=True)
+    currency = models.CharField(max_length=3)
+    exchange = models.CharField(max_length=50, blank=True)
+    last_verified = models.DateTimeField()
+
+    class Meta:
+        ordering = ['symbol']
 
     def __str__(self):
-        return f'{self.ticker} {self.quantity}'
\ No newline at end of file
+        return f'{self.symbol} {self.currency} {self.exchange}'
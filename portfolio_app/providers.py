@@ -0,0 +1,398 @@
+import os
+import json
+import time
+import threading
+import functools
+import collections
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, wait
+import yfinance as yf
+import requests
+from yfinance.data import YfData
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .http_client import get_http_client
+
+
+FIXTURE_PATH = os.path.join(os.path.dirname(__file__), 'data', 'market_data.json')
+
+PERIODS = {'1mo': pd.DateOffset(months=1), '3mo': pd.DateOffset(months=3), '6mo': pd.DateOffset(months=6),
+           '1y': pd.DateOffset(years=1), '2y': pd.DateOffset(years=2), '5y': pd.DateOffset(years=5),
+           '10y': pd.DateOffset(years=10), 'max': None}
+
+INTERVALS = {'1d': pd.DateOffset(days=1), '5d': pd.DateOffset(days=5), '1wk': pd.DateOffset(weeks=1),
+             '1mo': pd.DateOffset(months=1), '3mo': pd.DateOffset(months=3)}
+
+
+class MarketDataError(Exception):
+    """
+    Raised by providers when market data for a ticker or currency can not be found.
+    """
+
+
+def chunks(items, size):
+    """
+    Splits list into consecutive parts of given size.
+    :param items: list
+    :param size: maximum length of one part, integer
+    :return: generator of lists
+    """
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def ticker_executor():
+    """
+    Returns thread pool of per-ticker requests shared by all requests of the process (MARKET_DATA_TICKER_WORKERS
+    setting). It is separate from the pool of snapshot requests (snapshot.fetch_executor), whose threads wait for
+    per-ticker requests.
+    :return: ThreadPoolExecutor object
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=getattr(settings, 'MARKET_DATA_TICKER_WORKERS', 8),
+                                           thread_name_prefix='market-data-ticker')
+        return _executor
+
+
+def fan_out(function, items, timeout=None):
+    """
+    Calls function for every item in the shared pool of threads (ticker_executor). All calls have one deadline, calls
+    which are not finished by then are abandoned (calls which did not start are cancelled) and reported as
+    TimeoutError.
+    :param function: function which takes one item
+    :param items: list of hashable items (ticker names, batches as tuples)
+    :param timeout: deadline of all the calls in seconds, MARKET_DATA_TICKER_TIMEOUT setting by default
+    :return:    results - dictionary with items as a keys and returned values as a values, in the order of items;
+                errors - dictionary with items as a keys and raised exceptions as a values.
+    """
+    items = list(items)
+    timeout = timeout or getattr(settings, 'MARKET_DATA_TICKER_TIMEOUT', 10)
+    results = {}
+    errors = {}
+    if not items:
+        return results, errors
+
+    deadline = time.monotonic() + timeout
+    executor = ticker_executor()
+    futures = {executor.submit(function, item): item for item in items}
+    done, pending = wait(futures, timeout=max(deadline - time.monotonic(), 0))
+    for future in done:
+        try:
+            results[futures[future]] = future.result()
+        except Exception as error:
+            errors[futures[future]] = error
+    for future in pending:
+        future.cancel()
+        errors[futures[future]] = TimeoutError(f'Request did not complete in {timeout} seconds.')
+    return {item: results[item] for item in items if item in results}, errors
+
+
+class MarketDataProvider:
+    """
+    Interface of a market data source used by class Calculator. Provider returns ticker quotes, ticker currency,
+    ticker price history and exchange rates in the same shape as yfinance and Frankfurter API return them, so
+    Calculator does not depend on where the data comes from.
+    """
+
+    def get_quote(self, ticker):
+        """
+        Returns current price and currency of the ticker.
+        :param ticker: ticker name, string
+        :return: dictionary with keys 'currentPrice' (float), 'currency' (currency code, string) and optional
+         'exchange' (exchange code, string)
+        """
+        raise NotImplementedError
+
+    def get_quotes(self, tickers):
+        """
+        Returns current prices and currencies of several tickers. Tickers which can not be found or can not be
+        requested in time are reported in errors dictionary instead of raising, so one bad ticker does not break the
+        whole portfolio. Tickers are requested concurrently (fan_out), quotes keep the order of tickers.
+        :param tickers: list of ticker names
+        :return:    quotes - dictionary with ticker names as a keys and get_quote dictionaries as a values;
+                    errors - dictionary with ticker names as a keys and error messages as a values.
+        """
+        quotes, failures = fan_out(self.get_quote, tickers)
+        errors = {}
+        for ticker, error in failures.items():
+            if isinstance(error, MarketDataError):
+                errors[ticker] = str(error)
+            else:
+                errors[ticker] = f'Quote request for ticker "{ticker}" failed: {error}'
+        return quotes, errors
+
+    def get_currency(self, ticker):
+        """
+        Returns currency in which ticker is traded.
+        :param ticker: ticker name, string
+        :return: currency code, string
+        """
+        return self.get_quote(ticker)['currency']
+
+    def get_history(self, ticker, period='1y', interval='1mo'):
+        """
+        Returns ticker price history.
+        :param ticker: ticker name, string
+        :param period: history period in yfinance notation, string
+        :param interval: history interval in yfinance notation, string
+        :return: dataframe with 'Close' column indexed by dates
+        """
+        raise NotImplementedError
+
+    def get_histories(self, tickers, period='1y', interval='1mo', start=None):
+        """
+        Returns close prices history of several tickers. Tickers without history (or which can not be requested in
+        time) are left out of the result. Tickers are requested concurrently (fan_out), columns keep the order of
+        tickers.
+        :param tickers: list of ticker names
+        :param period: history period in yfinance notation, string
+        :param interval: history interval in yfinance notation, string
+        :param start: when given, history is returned from this date until now instead of period, date object
+        :return: dataframe with ticker names as a columns and close prices indexed by dates
+        """
+        def closes(ticker):
+            history = self.get_history(ticker, period='max' if start else period, interval=interval)['Close']
+            if start:
+                history = history[history.index >= pd.Timestamp(start).tz_localize(history.index.tz)]
+            return history
+
+        histories, _ = fan_out(closes, tickers)
+        return pd.DataFrame(histories)
+
+    def get_rates(self, currency):
+        """
+        Returns latest exchange rates relatively to the currency.
+        :param currency: currency code, string
+        :return: dictionary in Frankfurter API format ('base', 'date', 'rates')
+        """
+        raise NotImplementedError
+
+    def get_rates_by_date(self, currency, start, end):
+        """
+        Returns exchange rates of every working day between start and end dates relatively to the currency.
+        :param currency: currency code, string
+        :param start: start date, string
+        :param end: end date, string
+        :return: dictionary in Frankfurter API format ('base', 'start_date', 'end_date', 'rates')
+        """
+        raise NotImplementedError
+
+    def get_rates_matrix(self, start, end):
+        """
+        Returns exchange rates of every working day between start and end dates relatively to EUR, rates of any base
+        currency are derived from them (FxMatrix.rebased) without converting them to dictionaries.
+        :param start: start date, string
+        :param end: end date, string
+        :return: FxMatrix object
+        """
+        from .fx import FX_BASE, FxMatrix
+
+        return FxMatrix.from_payload(self.get_rates_by_date(FX_BASE, start, end))
+
+
+class YahooFrankfurterProvider(MarketDataProvider):
+    """
+    Provider which takes ticker data from Yahoo Finance (yfinance) and exchange rates from Frankfurter API.
+    """
+    frankfurter_url = 'https://api.frankfurter.app'
+    quote_url = 'https://query1.finance.yahoo.com/v7/finance/quote'
+    batch_size = 50
+
+    def get_quote(self, ticker):
+        quotes, errors = self.get_quotes([ticker])
+        if ticker in errors:
+            raise MarketDataError(errors[ticker])
+        return quotes[ticker]
+
+    def get_quotes(self, tickers):
+        """
+        Requests Yahoo quote endpoint with up to batch_size symbols at once, so number of requests depends on
+        number of batches and not on number of tickers. Batches are requested concurrently (fan_out). Yahoo returns
+        upper case symbols, so results are matched to tickers regardless of case.
+        """
+        def request(batch):
+            response = YfData().get_raw_json(self.quote_url, params={'symbols': ','.join(batch)})
+            return response['quoteResponse']['result'] or []
+
+        responses, failures = fan_out(request, [tuple(batch) for batch in chunks(tickers, self.batch_size)])
+        quotes = {}
+        errors = {}
+        for batch, error in failures.items():
+            for ticker in batch:
+                errors[ticker] = f'Quote request for ticker "{ticker}" failed: {error}'
+        for batch, results in responses.items():
+            received = {result['symbol'].upper(): result for result in results}
+            for ticker in batch:
+                result = received.get(ticker.upper(), {})
+                if result.get('regularMarketPrice') is None or not result.get('currency'):
+                    errors[ticker] = f'Ticker "{ticker}" does not exist.'
+                else:
+                    quotes[ticker] = {'currentPrice': result['regularMarketPrice'], 'currency': result['currency'],
+                                      'exchange': result.get('exchange', '')}
+        return quotes, errors
+
+    def get_history(self, ticker, period='1y', interval='1mo'):
+        return yf.Ticker(ticker).history(period=period, interval=interval)[['Close']]
+
+    def get_histories(self, tickers, period='1y', interval='1mo', start=None):
+        """
+        Downloads history of all tickers with one yf.download call. yf.download returns upper case symbols, so
+        columns are renamed back to the requested tickers.
+        """
+        tickers = list(tickers)
+        if not tickers:
+            return pd.DataFrame()
+        if start:
+            data = yf.download(tickers, start=start, interval=interval, auto_adjust=True, progress=False)
+        else:
+            data = yf.download(tickers, period=period, interval=interval, auto_adjust=True, progress=False)
+        closes = data['Close']
+        if isinstance(closes, pd.Series):
+            closes = closes.to_frame(tickers[0])
+        columns = {str(column).upper(): column for column in closes.columns}
+        closes = pd.DataFrame({ticker: closes[columns[ticker.upper()]] for ticker in tickers
+                               if ticker.upper() in columns}, index=closes.index)
+        return closes.dropna(axis=1, how='all')
+
+    def _frankfurter(self, path, currency):
+        """
+        Requests Frankfurter API through the shared HTTP client (pooled connections, timeouts, retries).
+        """
+        try:
+            return get_http_client().get_json(f'{self.frankfurter_url}/{path}', params={'from': currency})
+        except (requests.RequestException, ValueError) as error:
+            raise MarketDataError(f'Exchange rates of currency "{currency}" are not available: {error}')
+
+    def get_rates(self, currency):
+        return self._frankfurter('latest', currency)
+
+    def get_rates_by_date(self, currency, start, end):
+        return self._frankfurter(f'{start}..{end}', currency)
+
+
+@functools.lru_cache(maxsize=None)
+def load_fixture(path):
+    """
+    Reads recorded market data file once per process.
+    :param path: path to JSON file with recorded market data
+    :return: dictionary with recorded quotes, history and exchange rates
+    """
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+class FixtureProvider(MarketDataProvider):
+    """
+    In-process provider which serves recorded market data (portfolio_app/data/market_data.json by default) without
+    network. Latency of every call can be configured to imitate slow upstream services, and number of calls per
+    method is counted in calls attribute, so it can be used for offline measurements and tests.
+    """
+
+    def __init__(self, data=None, latency=0.0, path=FIXTURE_PATH, batch_size=50):
+        """
+        :param data: dictionary with recorded market data, when not given data is read from path;
+        :param latency: delay of every provider call in seconds, float;
+        :param path: path to JSON file with recorded market data;
+        :param batch_size: maximum number of tickers served by one get_quotes call, integer.
+        """
+        self.data = data if data is not None else load_fixture(path)
+        self.latency = latency
+        self.batch_size = batch_size
+        self.calls = collections.Counter()
+        self.recorded = pd.Timestamp(self.data['recorded'])
+
+    def _call(self, name):
+        self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def get_quote(self, ticker):
+        self._call('get_quote')
+        try:
+            return dict(self.data['quotes'][ticker])
+        except KeyError:
+            raise MarketDataError(f'Ticker "{ticker}" does not exist.')
+
+    def get_quotes(self, tickers):
+        quotes = {}
+        errors = {}
+        for batch in chunks(tickers, self.batch_size):
+            self._call('get_quotes')
+            for ticker in batch:
+                if ticker in self.data['quotes']:
+                    quotes[ticker] = dict(self.data['quotes'][ticker])
+                else:
+                    errors[ticker] = f'Ticker "{ticker}" does not exist.'
+        return quotes, errors
+
+    def _closes(self, tickers, period, interval, start=None):
+        source = '1d' if interval == '1wk' else interval
+        history = self.data['history'].get(source, {'dates': [], 'closes': {}})
+        closes = pd.DataFrame({ticker: history['closes'][ticker] for ticker in tickers if ticker in history['closes']},
+                              index=pd.DatetimeIndex(history['dates'], name='Date'))
+        if interval == '1wk':
+            closes = closes.resample('W-MON', label='left', closed='left').last().dropna(how='all')
+        if start:
+            closes = closes[closes.index >= pd.Timestamp(start)]
+        elif PERIODS.get(period) is not None:
+            closes = closes[closes.index > self.recorded - PERIODS[period]]
+        return closes
+
+    def get_history(self, ticker, period='1y', interval='1mo'):
+        self._call('get_history')
+        closes = self._closes([ticker], period, interval)
+        if ticker not in closes.columns:
+            raise MarketDataError(f'No {interval} history for ticker "{ticker}".')
+        return closes[[ticker]].rename(columns={ticker: 'Close'})
+
+    def get_histories(self, tickers, period='1y', interval='1mo', start=None):
+        self._call('get_histories')
+        return self._closes(tickers, period, interval, start)
+
+    def _eur_rates(self):
+        fx = self.data['fx']
+        return pd.DataFrame(fx['rates'], index=pd.DatetimeIndex(fx['dates']))
+
+    def get_rates(self, currency):
+        from .fx import FxMatrix
+
+        self._call('get_rates')
+        return FxMatrix(self._eur_rates().iloc[[-1]]).latest_payload(currency)
+
+    def get_rates_by_date(self, currency, start, end):
+        from .fx import FxMatrix
+
+        self._call('get_rates_by_date')
+        return FxMatrix(self._eur_rates().loc[start:end]).by_date_payload(currency, start, end)
+
+    def get_rates_matrix(self, start, end):
+        from .fx import FxMatrix
+
+        self._call('get_rates_matrix')
+        return FxMatrix(self._eur_rates().loc[start:end])
+
+
+def get_default_provider():
+    """
+    Creates market data provider configured by MARKET_DATA_PROVIDER setting, wrapped with StoredProvider when
+    MARKET_DATA_STORE setting is True and with CachedProvider when MARKET_DATA_CACHE setting is set.
+    :return: MarketDataProvider object
+    """
+    from .cache import CachedProvider
+    from .store import StoredProvider
+
+    provider = import_string(settings.MARKET_DATA_PROVIDER)()
+    if settings.MARKET_DATA_STORE:
+        provider = StoredProvider(provider)
+    if settings.MARKET_DATA_CACHE:
+        provider = CachedProvider(provider)
+    return provider
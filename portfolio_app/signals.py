@@ -0,0 +1,20 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import Item, PortfolioValuation
+
+
+@receiver(post_save, sender=Item)
+def item_saved(sender, instance, update_fields=None, **kwargs):
+    """
+    Removes stored valuations of the portfolio when its holdings change, they are calculated again by
+    value_portfolios command and history is calculated from market data until then.
+    """
+    if update_fields is not None and not {'ticker', 'quantity', 'portfolio_id'} & set(update_fields):
+        return
+    PortfolioValuation.objects.filter(portfolio_id=instance.portfolio_id_id).delete()
+
+
+@receiver(post_delete, sender=Item)
+def item_deleted(sender, instance, **kwargs):
+    PortfolioValuation.objects.filter(portfolio_id=instance.portfolio_id_id).delete()
@@ -0,0 +1,440 @@
+import asyncio
+import logging
+import datetime
+import threading
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from .timing import Timings
+
+
+logger = logging.getLogger(__name__)
+
+
+RESAMPLE_RULES = {'1d': 'B', '1wk': 'W-FRI', '1mo': 'ME', '3mo': 'QE'}
+
+# Time zone of dates of requests and valuations.
+LOCAL_TIMEZONE = datetime.timezone(datetime.timedelta(hours=3))
+
+
+def local_now():
+    """
+    :return: current date and time in LOCAL_TIMEZONE, datetime object
+    """
+    return datetime.datetime.now(LOCAL_TIMEZONE)
+
+
+def align_closes(closes, interval):
+    """
+    Puts close prices of tickers traded on different calendars on one date axis: every bar is labelled with the last
+    working day of its interval (month end, Friday of the week or the day itself) and a ticker which was not traded
+    on a date (holiday of its exchange) gets its latest earlier close.
+    :param closes: dataframe with close prices indexed by bar dates, tickers as a columns
+    :param interval: history interval in yfinance notation, string
+    :return: dataframe indexed by interval end dates
+    """
+    index = closes.index
+    if index.tz is not None:
+        index = index.tz_localize(None)
+    closes = closes.set_axis(index.normalize().rename('Date'))
+    return closes.resample(RESAMPLE_RULES.get(interval, 'B')).last().ffill().dropna(how='all')
+
+
+class memoized:
+    """
+    Property which is calculated on first use and stored in the object, as functools.cached_property, but without
+    its lock: in Python 3.11 the lock is shared by all objects of the class, so snapshots of concurrent requests would
+    wait for each other's requests to the provider and database. Property of one snapshot is used by one request, so
+    it does not need a lock.
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.__doc__ = func.__doc__
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        value = instance.__dict__[self.name] = self.func(instance)
+        return value
+
+
+def empty_rates():
+    """
+    :return: dataframe of exchange rates without dates and currencies
+    """
+    return pd.DataFrame(index=pd.DatetimeIndex([], name='Date'), dtype=float)
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def fetch_executor():
+    """
+    Returns thread pool of market data requests shared by all requests of the process (MARKET_DATA_FETCH_WORKERS
+    setting). Event loop of a request does not wait for its threads, so a request which timed out does not delay
+    the response.
+    :return: ThreadPoolExecutor object
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=getattr(settings, 'MARKET_DATA_FETCH_WORKERS', 16),
+                                           thread_name_prefix='market-data')
+        return _executor
+
+
+class PortfolioSnapshot:
+    """
+    Market data of one portfolio in one base currency. Quotes, exchange rates and history are requested from the
+    provider only once, on first use, and current value and history are calculated only once, so several Calculator
+    methods within one request reuse the same data.
+    """
+
+    def __init__(self, holdings, base_currency, provider, time_of_request, period='1y', interval='1mo', timings=None,
+                 registry=None):
+        """
+        :param holdings: dictionary with ticker names as a keys and quantities as a values;
+        :param base_currency: currency code, string;
+        :param provider: MarketDataProvider object;
+        :param time_of_request: date and time of request, datetime object;
+        :param period: history period in yfinance notation ('1y', '5y', '10y', 'max'), string;
+        :param interval: history interval in yfinance notation ('1d', '1wk', '1mo'), string;
+        :param timings: Timings object which records requests to the provider and calculations, new one by default;
+        :param registry: function which takes ticker names and returns dictionary of their registered currencies (e.g.
+         tickers.currencies), history is then calculated without quotes of registered tickers.
+        """
+        self.holdings = holdings
+        self.tickers = list(holdings)
+        self.base_currency = base_currency
+        self.provider = provider
+        self.time_of_request = time_of_request
+        self.period = period
+        self.interval = interval
+        self.timings = timings if timings is not None else Timings()
+        self.registry = registry
+        self.errors = {}
+
+    def fetch(self, *names):
+        """
+        Requests data of the properties in the calling thread (synchronous code which does not need timeouts, e.g.
+        management commands), data of other properties they depend on is requested as well.
+        :param names: names of the properties, e.g. 'currencies', 'history_rates'
+        :return: the snapshot
+        """
+        for name in names:
+            getattr(self, name)
+        return self
+
+    def subset(self, holdings, period=None, interval=None):
+        """
+        Returns snapshot of a part of the tickers which reuses market data already requested by this snapshot, so
+        history of many portfolios is calculated from one request of every kind of data. Calculations of the subset
+        are the same as of a snapshot which requested the data itself.
+        :param holdings: dictionary with ticker names (of this snapshot) as a keys and quantities as a values
+        :param period: history period of the subset, period of this snapshot by default
+        :param interval: history interval of the subset, interval of this snapshot by default (history of other
+         period or interval is requested again, quotes, currencies and latest exchange rates are still reused)
+        :return: PortfolioSnapshot object
+        """
+        period = period or self.period
+        interval = interval or self.interval
+        snapshot = PortfolioSnapshot(holdings, self.base_currency, self.provider, self.time_of_request,
+                                     period=period, interval=interval, timings=self.timings, registry=self.registry)
+        for name in ('quotes', 'currencies'):
+            if name in self.__dict__:
+                snapshot.__dict__[name] = {stock: value for stock, value in self.__dict__[name].items()
+                                           if stock in holdings}
+        if 'exchange_rates' in self.__dict__:
+            snapshot.__dict__['exchange_rates'] = self.exchange_rates
+        if (period, interval) == (self.period, self.interval):
+            if 'closes' in self.__dict__:
+                snapshot.__dict__['closes'] = self.closes[[stock for stock in holdings
+                                                           if stock in self.closes.columns]]
+            if 'history_rates' in self.__dict__:
+                snapshot.__dict__['history_rates'] = self.history_rates
+        snapshot.errors = {key: error for key, error in self.errors.items()
+                           if key in holdings or key == self.base_currency}
+        return snapshot
+
+    @memoized
+    def quotes(self):
+        """
+        :return: dictionary with ticker names as a keys and dictionaries with 'currentPrice' and 'currency' as a values
+        """
+        return self._merge('quotes', *self._fetch_quotes())
+
+    @memoized
+    def currencies(self):
+        """
+        :return: dictionary with ticker names as a keys and currency codes as a values, currencies of tickers which
+         are not in the registry are taken from quotes (tickers without quote are left out)
+        """
+        quotes = self.__dict__.get('quotes')
+        if quotes is None and self.registry is None:
+            quotes = self.quotes
+        return self._merge('currencies', *self._fetch_currencies(quotes))
+
+    @memoized
+    def exchange_rates(self):
+        """
+        :return: latest exchange rates relatively to the base currency, dictionary in Frankfurter API format
+        """
+        return self._merge('exchange_rates', *self._fetch_exchange_rates())
+
+    @memoized
+    def closes(self):
+        """
+        :return: dataframe with close prices of portfolio tickers within period on interval, tickers as a columns
+        """
+        return self._merge('closes', *self._fetch_closes())
+
+    # Methods _fetch_* only request and return data and errors, they do not change the snapshot, so aprefetch runs
+    # them in worker threads and keeps their results only when they are in time.
+
+    def _fetch_quotes(self):
+        with self.timings.span('fetch_quotes', 'fetch'):
+            return self.provider.get_quotes(self.tickers)
+
+    def _fetch_currencies(self, quotes=None):
+        """
+        :param quotes: quotes of the tickers when they are already requested, otherwise only tickers which are not in
+         the registry are requested
+        """
+        currencies = {}
+        errors = {}
+        if self.registry is not None:
+            with self.timings.span('load_tickers', 'database'):
+                currencies = self.registry(self.tickers)
+        missing = [stock for stock in self.tickers if stock not in currencies]
+        if missing:
+            if quotes is None:
+                with self.timings.span('fetch_quotes', 'fetch'):
+                    quotes, errors = self.provider.get_quotes(missing)
+            currencies.update({stock: quotes[stock]['currency'] for stock in missing if stock in quotes})
+        return {stock: currencies[stock] for stock in self.tickers if stock in currencies}, errors
+
+    def _fetch_exchange_rates(self):
+        with self.timings.span('fetch_rates', 'fetch'):
+            return self.provider.get_rates(self.base_currency), {}
+
+    def _fetch_closes(self):
+        with self.timings.span('fetch_history', 'fetch'):
+            closes = self.provider.get_histories(self.tickers, period=self.period, interval=self.interval)
+        return closes, {stock: f'Price history for ticker "{stock}" is not available.' for stock in self.tickers
+                        if stock not in closes.columns}
+
+    def _fetch_history_rates(self, closes):
+        """
+        :param closes: aligned closes (aligned_closes)
+        """
+        if closes.empty:
+            return empty_rates(), {}
+        start_date = (closes.index[0] - datetime.timedelta(days=30)).strftime('%Y-%m-%d')
+        end_date = min(closes.index[-1].date(), self.time_of_request.date()).strftime('%Y-%m-%d')
+        with self.timings.span('fetch_history_rates', 'fetch'):
+            matrix = self.provider.get_rates_matrix(start_date, end_date)
+        logger.debug('Exchange rates of %s from %s to %s: %s dates.', self.base_currency, start_date, end_date,
+                     len(matrix.rates))
+        return matrix.rebased(self.base_currency) if not matrix.rates.empty else empty_rates(), {}
+
+    def _merge(self, name, value, errors):
+        """
+        Reports errors of fetched data in errors attribute, errors of quotes replace earlier errors of the tickers.
+        :return: value
+        """
+        if name in ('quotes', 'currencies'):
+            self.errors.update(errors)
+        else:
+            for key, error in errors.items():
+                self.errors.setdefault(key, error)
+        return value
+
+    @memoized
+    def current(self):
+        """
+        Current value of every portfolio ticker. Tickers without quote or exchange rate are left out and reported in
+        errors attribute.
+        :return: dataframe with columns Ticker, Amount, Ticker currency, Current Price, Sum per ticker, Exchange rate,
+         Sum per ticker <base currency>
+        """
+        quotes = self.quotes
+        exchange_rates = self.exchange_rates
+        with self.timings.span('compute_current', 'compute'):
+            rows = []
+            for stock in self.tickers:
+                if stock not in quotes:
+                    continue
+
+                stock_current_price = quotes[stock]['currentPrice']
+                stock_currency = quotes[stock]['currency']
+                if stock_currency == self.base_currency:
+                    exchange_rate = 1.0
+                elif stock_currency in exchange_rates['rates']:
+                    exchange_rate = exchange_rates['rates'][stock_currency]
+                else:
+                    self.errors[stock] = (f'Exchange rate for currency "{stock_currency}" of ticker "{stock}" is not '
+                                          f'available.')
+                    continue
+                amount = self.holdings[stock]
+                sum_per_stock = round(stock_current_price * amount, 2)
+                sum_per_stock_base_currency = round(sum_per_stock / exchange_rate, 2)
+                rows.append([stock, amount, stock_currency, stock_current_price, sum_per_stock, exchange_rate,
+                             sum_per_stock_base_currency])
+
+            return pd.DataFrame(rows, columns=['Ticker', 'Amount', 'Ticker currency', 'Current Price', 'Sum per ticker',
+                                               'Exchange rate', f'Sum per ticker {self.base_currency}'])
+
+    @memoized
+    def portfolio_value(self):
+        """
+        :return: total current portfolio value in base currency, float
+        """
+        return round(sum(self.current[f'Sum per ticker {self.base_currency}']), 2)
+
+    def rates_as_of(self, exchange_rates, dates, tickers):
+        """
+        Aligns daily exchange rates to the dates: every date gets the latest rate published on that date or before it
+        (weekends and holidays get the rate of the previous working day).
+        :param exchange_rates: dataframe indexed by dates with exchange rates relatively to the base currency,
+         currency codes as a columns
+        :param dates: DatetimeIndex object
+        :param tickers: ticker names
+        :return: dataframe indexed by dates with exchange rate of every ticker currency, tickers as a columns
+        """
+        currencies = [self.currencies[stock] for stock in tickers]
+        fx = exchange_rates.reindex(columns=[currency for currency in set(currencies)
+                                             if currency in exchange_rates.columns])
+        fx[self.base_currency] = 1.0
+        fx = fx.sort_index().reindex(dates, method='ffill')
+        return fx.reindex(columns=currencies).set_axis(tickers, axis=1)
+
+    @memoized
+    def aligned_closes(self):
+        """
+        :return: close prices aligned to interval end dates, leading gaps filled with ticker mean price, empty if
+         there is no history
+        """
+        closes = self.closes
+        with self.timings.span('compute_align', 'compute'):
+            closes = closes.dropna(how='all')
+            if closes.empty:
+                return pd.DataFrame()
+            closes = align_closes(closes, self.interval)
+            # Filled in one array operation, fillna with a Series of means makes one block per ticker.
+            values = closes.to_numpy(dtype=float)
+            values = np.where(np.isnan(values), closes.mean().to_numpy(), values)
+            return pd.DataFrame(values, index=closes.index, columns=closes.columns)
+
+    @memoized
+    def history_rates(self):
+        """
+        :return: dataframe indexed by every working day of history (from 30 days before the first date) with exchange
+         rates relatively to the base currency, currency codes as a columns
+        """
+        return self._merge('history_rates', *self._fetch_history_rates(self.aligned_closes))
+
+    @memoized
+    def history(self):
+        """
+        Historical values of every portfolio ticker in base currency within period on interval, plus their total in
+        Sum column. Dates before the first available exchange rate are left out.
+        :return: dataframe indexed by dates with ticker names and Sum as a columns, empty if there is no history
+        """
+        currencies = self.currencies
+        closes = self.aligned_closes
+        portfolio_history = closes[[stock for stock in self.tickers if stock in closes.columns and stock in currencies]]
+        if portfolio_history.empty:
+            return pd.DataFrame()
+        history_rates = self.history_rates
+        with self.timings.span('compute_history', 'compute'):
+            rates = self.rates_as_of(history_rates, portfolio_history.index, portfolio_history.columns)
+            unsupported = rates.columns[rates.isna().all()]
+            for stock in unsupported:
+                self.errors[stock] = (f'Exchange rate for currency "{currencies[stock]}" of ticker "{stock}" is not '
+                                      f'available.')
+            rates = rates.drop(columns=unsupported).dropna()
+            amounts = pd.Series(self.holdings)[rates.columns]
+            portfolio_history = (portfolio_history.loc[rates.index, rates.columns] * amounts / rates).round(2)
+
+            portfolio_history['Sum'] = round(portfolio_history.sum(axis=1), 2)
+            return portfolio_history
+
+    async def aprefetch(self, current=True, history=True, timeout=None, limit=None):
+        """
+        Requests quotes, latest exchange rates and history (with exchange rates of history dates, which depend on
+        history dates) concurrently in worker threads, so valuation takes about as long as the slowest request and
+        not as their sum. Request which fails or takes longer than timeout is reported in errors attribute and its
+        data is left empty, so the rest of the portfolio is still calculated. Results of requests are stored in the
+        snapshot on the event loop only when they are in time, result of a request which finishes later is dropped.
+        :param current: if False quotes and latest exchange rates are not requested (only currencies of tickers
+         which are not in the registry are taken from quotes);
+        :param history: if False history is not requested;
+        :param timeout: maximum time of one request in seconds, MARKET_DATA_FETCH_TIMEOUT setting by default;
+        :param limit: maximum number of concurrent requests, MARKET_DATA_FETCH_CONCURRENCY setting by default.
+        """
+        loop = asyncio.get_running_loop()
+        timeout = timeout or getattr(settings, 'MARKET_DATA_FETCH_TIMEOUT', 10)
+        semaphore = asyncio.Semaphore(limit or getattr(settings, 'MARKET_DATA_FETCH_CONCURRENCY', 4))
+
+        async def fetch(name, function, *args):
+            if name in self.__dict__:
+                return True
+            async with semaphore:
+                try:
+                    value, errors = await asyncio.wait_for(
+                        loop.run_in_executor(fetch_executor(), self._call, function, *args), timeout)
+                except Exception as error:
+                    self._fail(name, error)
+                    return False
+            self.__dict__[name] = self._merge(name, value, errors)
+            return True
+
+        async def fetch_history():
+            if await fetch('closes', self._fetch_closes):
+                await fetch('history_rates', self._fetch_history_rates, self.aligned_closes)
+
+        jobs = []
+        if current:
+            jobs += [fetch('quotes', self._fetch_quotes), fetch('exchange_rates', self._fetch_exchange_rates)]
+        elif history:
+            jobs.append(fetch('currencies', self._fetch_currencies))
+        if history:
+            jobs.append(fetch_history())
+        await asyncio.gather(*jobs)
+
+    @staticmethod
+    def _call(function, *args):
+        """
+        Runs _fetch_* method in a worker thread and closes database connection of the thread afterwards.
+        """
+        try:
+            return function(*args)
+        finally:
+            close_old_connections()
+
+    def _fail(self, name, error):
+        """
+        Sets empty data of failed request and reports it in errors attribute.
+        """
+        reason = 'request timed out' if isinstance(error, TimeoutError) else str(error)
+        if name in ('quotes', 'currencies'):
+            self.__dict__[name] = {}
+            for stock in self.tickers:
+                self.errors.setdefault(stock, f'Quote of ticker "{stock}" is not available: {reason}.')
+        elif name == 'closes':
+            self.__dict__[name] = pd.DataFrame()
+            for stock in self.tickers:
+                self.errors.setdefault(stock, f'Price history for ticker "{stock}" is not available: {reason}.')
+        else:
+            self.__dict__[name] = empty_rates() if name == 'history_rates' else {'base': self.base_currency, 'rates': {}}
+            self.errors.setdefault(self.base_currency,
+                                   f'Exchange rates of currency "{self.base_currency}" are not available: {reason}.')
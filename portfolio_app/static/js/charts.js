@@ -0,0 +1,29 @@
+// Charts are rendered in the background, every chart placeholder polls its status until the image is ready.
+document.querySelectorAll('.chart[data-status-url]').forEach(function (chart) {
+    var image = chart.querySelector('img');
+    var status = chart.querySelector('.chart-status');
+    var attempts = 0;
+
+    function poll() {
+        attempts += 1;
+        fetch(chart.dataset.statusUrl)
+            .then(function (response) { return response.json(); })
+            .then(function (data) {
+                if (data.status === 'ready') {
+                    image.src = data.url;
+                    image.hidden = false;
+                    status.remove();
+                } else if (data.status === 'pending' && attempts < 120) {
+                    setTimeout(poll, 500);
+                } else if (data.status === 'missing' && attempts < 10) {
+                    // Status may come from a process which has not seen the chart yet, retry for a few seconds.
+                    setTimeout(poll, 500);
+                } else {
+                    status.textContent = 'Chart could not be rendered.';
+                }
+            })
+            .catch(function () { status.textContent = 'Chart could not be rendered.'; });
+    }
+
+    poll();
+});
@@ -0,0 +1,26 @@
+// Long tables show their first page, following pages are loaded and appended when Show more is clicked.
+document.querySelectorAll('.paged-table .table-more[data-next-url]').forEach(function (button) {
+    var container = button.closest('.paged-table');
+    var body = container.querySelector('tbody');
+    var shown = container.querySelector('.table-shown');
+
+    button.addEventListener('click', function () {
+        button.disabled = true;
+        fetch(button.dataset.nextUrl)
+            .then(function (response) { return response.json(); })
+            .then(function (data) {
+                body.insertAdjacentHTML('beforeend', data.html);
+                shown.textContent = data.shown + ' of ' + data.count + ' rows shown.';
+                if (data.next_url) {
+                    button.dataset.nextUrl = data.next_url;
+                    button.disabled = false;
+                } else {
+                    button.remove();
+                }
+            })
+            .catch(function () {
+                shown.textContent = 'Rows could not be loaded.';
+                button.disabled = false;
+            });
+    });
+});
@@ -0,0 +1,244 @@
+import time
+import logging
+import datetime
+import pandas as pd
+
+from django.conf import settings
+from django.db import OperationalError, transaction
+from django.db.models import Max
+
+from .fx import FX_BASE, FxMatrix, rebase_payload
+from .models import PriceSeries, PriceBar, RateSeries, Rate
+from .providers import MarketDataProvider, PERIODS, INTERVALS
+
+
+WHOLE_HISTORY = datetime.date(1900, 1, 1)
+
+logger = logging.getLogger(__name__)
+
+
+class StoredProvider(MarketDataProvider):
+    """
+    Provider which keeps history of close prices and exchange rates in the database (PriceSeries, PriceBar,
+    RateSeries and Rate models). Past bars and rates never change, so after the first request only bars and rates
+    after the last stored date are requested from the upstream provider. Quotes are passed through. Exchange rates are
+    requested and stored only for EUR, rates of other base currencies are derived from them (FxMatrix).
+    """
+
+    def __init__(self, provider):
+        """
+        :param provider: MarketDataProvider object from which missing history and rates are requested.
+        """
+        self.provider = provider
+
+    def get_quote(self, ticker):
+        return self.provider.get_quote(ticker)
+
+    def get_quotes(self, tickers):
+        return self.provider.get_quotes(tickers)
+
+    def get_currency(self, ticker):
+        return self.provider.get_currency(ticker)
+
+    def get_rates(self, currency):
+        return rebase_payload(self.provider.get_rates(FX_BASE), currency)
+
+    def get_history(self, ticker, period='1y', interval='1mo'):
+        closes = self.get_histories([ticker], period=period, interval=interval)
+        return closes[[ticker]].dropna().rename(columns={ticker: 'Close'}) if ticker in closes.columns else closes
+
+    def get_histories(self, tickers, period='1y', interval='1mo', start=None):
+        """
+        Tickers which are not stored yet or are stored from later date than requested are downloaded for the whole
+        period, for other tickers only bars from the last stored bar (which could be not closed yet) are downloaded.
+        """
+        tickers = list(tickers)
+        stored = {series.ticker: series for series in PriceSeries.objects.filter(ticker__in=tickers, interval=interval)}
+        last_dates = dict(PriceBar.objects.filter(series__in=stored.values()).values('series__ticker')
+                          .annotate(last=Max('date')).values_list('series__ticker', 'last'))
+
+        full = []
+        tails = {}
+        for ticker in tickers:
+            series = stored.get(ticker)
+            last = last_dates.get(ticker)
+            if series is None or last is None:
+                full.append(ticker)
+                continue
+            first_needed = start or window_start(period, interval, last)
+            if series.start > (first_needed or WHOLE_HISTORY):
+                full.append(ticker)
+            else:
+                tails.setdefault(last, []).append(ticker)
+
+        unstored = {}
+        if full:
+            closes = self.provider.get_histories(full, period=period, interval=interval, start=start)
+            for ticker in closes.columns:
+                series = closes[ticker].dropna()
+                if series.empty:
+                    continue
+                covered = start or window_start(period, interval, to_date(series.index[-1])) or WHOLE_HISTORY
+                if not write(self._store_bars, ticker, interval, series, covered):
+                    unstored[ticker] = series
+        for last, tail_tickers in tails.items():
+            closes = self.provider.get_histories(tail_tickers, interval=interval, start=last)
+            for ticker in closes.columns:
+                series = closes[ticker].dropna()
+                if not write(self._store_bars, ticker, interval, series, None):
+                    unstored[ticker] = series
+
+        closes = self._read_bars(tickers, period, interval, start)
+        if unstored:
+            closes = add_bars(closes, unstored, tickers)
+        return closes
+
+    @transaction.atomic
+    def _store_bars(self, ticker, interval, closes, start):
+        """
+        Stores closes of the ticker, bars which are already stored (e.g. the last not closed bar) are updated.
+        """
+        if start is None:
+            series = PriceSeries.objects.get(ticker=ticker, interval=interval)
+        else:
+            series, _ = PriceSeries.objects.update_or_create(ticker=ticker, interval=interval,
+                                                             defaults={'start': start})
+        if closes.empty:
+            return
+        PriceBar.objects.bulk_create([PriceBar(series=series, date=to_date(date), close=float(close))
+                                      for date, close in closes.items()],
+                                     update_conflicts=True, unique_fields=['series', 'date'], update_fields=['close'])
+        series.save(update_fields=['updated'])
+
+    def _read_bars(self, tickers, period, interval, start):
+        bars = PriceBar.objects.filter(series__ticker__in=tickers, series__interval=interval)
+        last = bars.aggregate(last=Max('date'))['last']
+        if last is None:
+            return pd.DataFrame()
+        first = start or window_start(period, interval, last)
+        if first:
+            bars = bars.filter(date__gte=first)
+        rows = pd.DataFrame(list(bars.values_list('series__ticker', 'date', 'close')),
+                            columns=['ticker', 'date', 'close'])
+        closes = rows.pivot(index='date', columns='ticker', values='close')
+        closes.index = pd.DatetimeIndex(closes.index, name='Date')
+        return closes[[ticker for ticker in tickers if ticker in closes.columns]]
+
+    def get_rates_by_date(self, currency, start, end):
+        return self.get_rates_matrix(start, end).by_date_payload(currency, start, end)
+
+    def get_rates_matrix(self, start, end):
+        """
+        Only the days which are not stored yet are requested from the upstream provider. Days up to yesterday are
+        considered final, today's rates are requested again until the next day.
+        """
+        start_date = datetime.date.fromisoformat(str(start))
+        end_date = datetime.date.fromisoformat(str(end))
+        series = RateSeries.objects.filter(base=FX_BASE).first()
+
+        fetched, stored = {}, True
+        if series is None or series.start > start_date:
+            fetched, stored = self._update_rates(FX_BASE, start_date, end_date)
+        elif series.end < end_date:
+            fetched, stored = self._update_rates(FX_BASE, series.start, end_date,
+                                                 fetch_from=series.end + datetime.timedelta(days=1))
+
+        rows = pd.DataFrame(list(Rate.objects.filter(series__base=FX_BASE, date__range=(start_date, end_date))
+                                 .values_list('date', 'currency', 'rate')), columns=['date', 'currency', 'rate'])
+        rates = rows.pivot(index='date', columns='currency', values='rate')
+        rates.index = pd.DatetimeIndex(rates.index)
+        if not stored:
+            rates = FxMatrix.from_payload(fetched).rates.loc[str(start_date):str(end_date)].combine_first(rates)
+        return FxMatrix(rates)
+
+    def _update_rates(self, currency, start, end, fetch_from=None):
+        """
+        Requests rates from fetch_from (start by default) to end and stores them.
+        :return:    fetched - get_rates_by_date dictionary of the upstream provider;
+                    stored - False when the rates could not be stored.
+        """
+        fetch_from = fetch_from or start
+        fetched = self.provider.get_rates_by_date(currency, fetch_from.isoformat(), end.isoformat())
+        return fetched, write(self._store_rates, currency, start, end, fetched)
+
+    @transaction.atomic
+    def _store_rates(self, currency, start, end, fetched):
+        """
+        Stores fetched rates, stored range becomes start..end (or ..yesterday when end is not in the past).
+        """
+        yesterday = datetime.date.today() - datetime.timedelta(days=1)
+        series, _ = RateSeries.objects.update_or_create(base=currency, defaults={'start': start,
+                                                                                 'end': min(end, yesterday)})
+        Rate.objects.bulk_create([Rate(series=series, date=datetime.date.fromisoformat(date), currency=rate_currency,
+                                       rate=rate)
+                                  for date, day_rates in fetched.get('rates', {}).items()
+                                  for rate_currency, rate in day_rates.items()],
+                                 update_conflicts=True, unique_fields=['series', 'date', 'currency'],
+                                 update_fields=['rate'])
+
+
+def write(function, *args):
+    """
+    Calls the function which writes to the database. SQLite allows only one writer at a time, a write which waited
+    for the lock longer than the database timeout is retried after MARKET_DATA_STORE_RETRY_DELAYS and skipped when
+    the database is still locked, so the data is only not stored this time (and requested upstream again next time).
+    :param function: function writing to the database
+    :param args: arguments of the function
+    :return: True when the data was stored, False when writing was skipped
+    """
+    delays = getattr(settings, 'MARKET_DATA_STORE_RETRY_DELAYS', (0.1, 0.5, 2))
+    for delay in (*delays, None):
+        try:
+            function(*args)
+            return True
+        except OperationalError as error:
+            if 'locked' not in str(error):
+                raise
+            if delay is None:
+                logger.warning('Market data were not stored, %s.', error)
+                return False
+            time.sleep(delay)
+
+
+def add_bars(closes, bars, tickers):
+    """
+    Adds downloaded bars which could not be stored to the stored closes.
+    :param closes: DataFrame with dates as an index and ticker names as a columns
+    :param bars: dictionary with ticker names as a keys and Series of closes (indexed by Timestamps) as a values
+    :param tickers: list of ticker names, order of the columns
+    :return: DataFrame with dates as an index and ticker names as a columns
+    """
+    if closes.empty:
+        closes = pd.DataFrame(index=pd.DatetimeIndex([], name='Date'))
+    for ticker, series in bars.items():
+        series = pd.Series(series.to_numpy(), index=pd.DatetimeIndex([to_date(date) for date in series.index]))
+        if ticker in closes.columns:
+            series = series.combine_first(closes[ticker].dropna())
+        closes = closes.reindex(closes.index.union(series.index))
+        closes[ticker] = series
+    closes.index.name = 'Date'
+    return closes[[ticker for ticker in tickers if ticker in closes.columns]]
+
+
+def to_date(value):
+    """
+    Converts Timestamp (with or without timezone) to the date in its own timezone.
+    :param value: Timestamp object
+    :return: date object
+    """
+    return pd.Timestamp(value).date()
+
+
+def window_start(period, interval, last):
+    """
+    Returns the first date of history period in the same way as yfinance does it: period is counted back from now,
+    or from the end of the last bar when history is older than now.
+    :param period: history period in yfinance notation, string
+    :param interval: history interval in yfinance notation, string
+    :param last: date of the last bar, date object
+    :return: date object, None for the whole history ('max' period)
+    """
+    if PERIODS.get(period) is None:
+        return None
+    reference = min(pd.Timestamp(datetime.date.today()), pd.Timestamp(last) + INTERVALS.get(interval, pd.DateOffset()))
+    return (reference - PERIODS[period]).date()
@@ -1,3 +1,788 @@
-from django.test import TestCase
+import os
+import time
+import datetime
+import tempfile
+import threading
+from unittest import mock
+
+import pandas as pd
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.db.models import Max
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from .cache import CachedProvider
+from .charts import ChartRenderer
+from .fx import FxMatrix, rebase_payload
+from .management.commands.benchmark_calculator import BenchmarkPortfolio
+from .management.commands.warm_cache import Command as WarmCacheCommand
+from .models import Portfolio, Item, PortfolioValuation, PriceBar, Rate, Ticker
+from .providers import FixtureProvider, MarketDataError, fan_out
+from .snapshot import LOCAL_TIMEZONE, PortfolioSnapshot
+from .store import StoredProvider
+from .tickers import currencies, lookup, register
+from .utils import Calculator
+from .valuation import (HISTORY_SLACK, holdings_frame, value_holdings, market_snapshot, history_valuations,
+                        save_valuations, stored_history)
 
 # Create your tests here.
+
+
+class QueryCountTests(TestCase):
+    """
+    Pages make the same number of queries however many portfolios and items user has.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='investor', password='secret')
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def create_portfolio(self, items=0):
+        portfolio = Portfolio.objects.create(title='Portfolio', user=self.user)
+        self.add_items(portfolio, items)
+        return portfolio
+
+    def add_items(self, portfolio, count):
+        start = portfolio.stocks.count()
+        Item.objects.bulk_create([Item(portfolio_id=portfolio, user=self.user, ticker=f'T{number}', quantity=1)
+                                  for number in range(start, start + count)])
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(context)
+
+    def test_portfolio_list(self):
+        self.create_portfolio(items=1)
+        queries = self.count_queries(reverse('myportfolios'))
+        for _ in range(10):
+            self.create_portfolio(items=3)
+        self.assertEqual(self.count_queries(reverse('myportfolios')), queries)
+
+    def test_portfolio_detail(self):
+        portfolio = self.create_portfolio(items=1)
+        queries = self.count_queries(reverse('portfolio_detail', args=[portfolio.pk]))
+        self.add_items(portfolio, 20)
+        self.assertEqual(self.count_queries(reverse('portfolio_detail', args=[portfolio.pk])), queries)
+
+    def test_calculator_uses_prefetched_items(self):
+        portfolio = self.create_portfolio(items=5)
+        portfolio = Portfolio.objects.with_stocks().get(pk=portfolio.pk)
+        with self.assertNumQueries(0):
+            calculator = Calculator(portfolio, 'USD', provider=FixtureProvider())
+        self.assertEqual(len(calculator.data['stocks']), 5)
+
+    def test_ticker_is_unique_in_portfolio(self):
+        portfolio = self.create_portfolio(items=1)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Item.objects.create(portfolio_id=portfolio, user=self.user, ticker='T0', quantity=2)
+        Item.objects.create(portfolio_id=self.create_portfolio(), user=self.user, ticker='T0', quantity=2)
+
+
+class CachedProviderTests(SimpleTestCase):
+    """
+    Concurrent requests of the same tickers are collapsed into one upstream request, also when a ticker can not be
+    fetched.
+    """
+
+    def setUp(self):
+        caches['market_data'].clear()
+        self.upstream = FixtureProvider(latency=0.05)
+        self.provider = CachedProvider(self.upstream, alias='market_data')
+
+    def concurrently(self, function, count=20):
+        results = []
+        barrier = threading.Barrier(count)
+
+        def run():
+            barrier.wait()
+            results.append(function())
+
+        threads = [threading.Thread(target=run) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_quotes_are_fetched_once(self):
+        results = self.concurrently(lambda: self.provider.get_quotes(['AAPL', 'SAP.DE']))
+        self.assertEqual(self.upstream.calls['get_quotes'], 1)
+        self.assertTrue(all(set(quotes) == {'AAPL', 'SAP.DE'} and not errors for quotes, errors in results))
+
+    def test_concurrent_misses_are_fetched_once(self):
+        results = self.concurrently(lambda: self.provider.get_quotes(['AAPL', 'NOPE']))
+        self.assertEqual(self.upstream.calls['get_quotes'], 1)
+        for quotes, errors in results:
+            self.assertEqual(set(quotes), {'AAPL'})
+            self.assertEqual(errors, {'NOPE': 'Ticker "NOPE" does not exist.'})
+
+        self.provider.get_quotes(['NOPE'])
+        with self.assertRaises(MarketDataError):
+            self.provider.get_quote('NOPE')
+        self.assertEqual(self.upstream.calls['get_quotes'], 1)
+
+    def test_failed_fetch_is_not_repeated(self):
+        calls = []
+
+        def fetch(keys):
+            calls.append(keys)
+            raise MarketDataError('Upstream is not available.')
+
+        for _ in range(3):
+            with self.assertRaisesMessage(MarketDataError, 'Upstream is not available.'):
+                self.provider.cache.get('rates:EUR:latest', fetch, lambda key: 60, 'Rates are not available.')
+        self.assertEqual(len(calls), 1)
+
+    def test_rates_matrix_serves_every_base_currency(self):
+        usd = self.provider.get_rates_by_date('USD', '2024-06-03', '2024-06-28')
+        gbp = self.provider.get_rates_by_date('GBP', '2024-06-03', '2024-06-28')
+        matrix = self.provider.get_rates_matrix('2024-06-03', '2024-06-28')
+
+        self.assertEqual(self.upstream.calls, {'get_rates_matrix': 1})
+        self.assertEqual(usd, self.upstream.get_rates_by_date('USD', '2024-06-03', '2024-06-28'))
+        self.assertEqual(gbp, matrix.by_date_payload('GBP', '2024-06-03', '2024-06-28'))
+
+
+class PortfolioSnapshotTests(SimpleTestCase):
+    """
+    Snapshots of concurrent requests do not wait for each other.
+    """
+
+    def test_snapshots_fetch_concurrently(self):
+        barrier = threading.Barrier(2, timeout=5)
+
+        class WaitingProvider(FixtureProvider):
+            def get_quotes(self, tickers):
+                barrier.wait()
+                return super().get_quotes(tickers)
+
+        snapshots = [PortfolioSnapshot({'AAPL': 1}, 'EUR', WaitingProvider(), datetime.datetime(2024, 9, 20))
+                     for _ in range(2)]
+        threads = [threading.Thread(target=lambda snapshot=snapshot: snapshot.quotes) for snapshot in snapshots]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([set(snapshot.__dict__.get('quotes', {})) for snapshot in snapshots], [{'AAPL'}, {'AAPL'}])
+
+    def test_late_results_are_dropped(self):
+        finished = threading.Event()
+
+        class SlowProvider(FixtureProvider):
+            def get_histories(self, tickers, period='1y', interval='1mo', start=None):
+                time.sleep(0.2)
+                try:
+                    return super().get_histories(tickers, period=period, interval=interval, start=start)
+                finally:
+                    finished.set()
+
+        snapshot = PortfolioSnapshot({'AAPL': 1, 'SAP.DE': 2}, 'EUR', SlowProvider(), datetime.datetime(2024, 9, 20))
+        async_to_sync(snapshot.aprefetch)(timeout=0.05)
+        errors = dict(snapshot.errors)
+        self.assertTrue(finished.wait(5))
+        time.sleep(0.05)
+
+        self.assertTrue(snapshot.closes.empty)
+        self.assertTrue(snapshot.history.empty)
+        self.assertEqual(snapshot.errors, errors)
+        self.assertIn('request timed out', errors['AAPL'])
+        self.assertEqual(set(snapshot.quotes), {'AAPL', 'SAP.DE'})
+
+
+class FanOutTests(SimpleTestCase):
+    """
+    Per-ticker requests share one deadline.
+    """
+
+    def test_late_calls_time_out(self):
+        def call(delay):
+            time.sleep(abs(delay))
+            if delay < 0:
+                raise MarketDataError('Failed.')
+            return delay
+
+        started = time.monotonic()
+        results, errors = fan_out(call, [0.01, 1.0, -0.01, 0.02], timeout=0.2)
+
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertEqual(results, {0.01: 0.01, 0.02: 0.02})
+        self.assertEqual(set(errors), {1.0, -0.01})
+        self.assertIsInstance(errors[1.0], TimeoutError)
+        self.assertIsInstance(errors[-0.01], MarketDataError)
+
+    def test_deadline_is_shared(self):
+        # Every call is in time, but the third round of calls on the pool would end after the deadline.
+        items = [0.1 + number / 1000 for number in range(3 * settings.MARKET_DATA_TICKER_WORKERS)]
+        started = time.monotonic()
+        results, errors = fan_out(time.sleep, items, timeout=0.15)
+
+        self.assertLess(time.monotonic() - started, 0.25)
+        self.assertEqual(len(results) + len(errors), len(items))
+        self.assertTrue(errors)
+        self.assertTrue(all(isinstance(error, TimeoutError) for error in errors.values()))
+
+
+class FxMatrixTests(SimpleTestCase):
+    """
+    Rates of every base currency are derived from EUR rates by triangulation.
+    """
+
+    def setUp(self):
+        self.payload = {'amount': 1.0, 'base': 'EUR', 'start_date': '2024-01-01', 'end_date': '2024-01-03',
+                        'rates': {'2024-01-02': {'USD': 1.1, 'GBP': 0.85}, '2024-01-03': {'USD': 1.2, 'GBP': 0.8}}}
+
+    def test_cross_rates(self):
+        rates = FxMatrix.from_payload(self.payload).rebased('USD')
+        self.assertEqual(list(rates.columns), ['EUR', 'GBP'])
+        self.assertAlmostEqual(rates.loc['2024-01-02', 'EUR'], 1 / 1.1)
+        self.assertAlmostEqual(rates.loc['2024-01-02', 'GBP'], 0.85 / 1.1)
+        self.assertAlmostEqual(rates.loc['2024-01-03', 'GBP'], 0.8 / 1.2)
+
+    def test_unsupported_currency(self):
+        with self.assertRaises(MarketDataError):
+            FxMatrix.from_payload(self.payload).rebased('CHF')
+
+    def test_rebase_latest_payload(self):
+        payload = rebase_payload({'amount': 1.0, 'base': 'EUR', 'date': '2024-01-03', 'rates': {'USD': 1.2,
+                                                                                               'GBP': 0.8}}, 'GBP')
+        self.assertEqual(payload['base'], 'GBP')
+        self.assertEqual(payload['date'], '2024-01-03')
+        self.assertAlmostEqual(payload['rates']['EUR'], 1 / 0.8)
+        self.assertAlmostEqual(payload['rates']['USD'], 1.2 / 0.8)
+
+    def test_rebase_payload_by_date(self):
+        payload = rebase_payload(self.payload, 'USD')
+        self.assertEqual((payload['base'], payload['start_date'], payload['end_date']), ('USD', '2024-01-01',
+                                                                                          '2024-01-03'))
+        self.assertEqual(sorted(payload['rates']), ['2024-01-02', '2024-01-03'])
+        self.assertAlmostEqual(payload['rates']['2024-01-03']['EUR'], 1 / 1.2)
+        self.assertIs(rebase_payload(self.payload, 'EUR'), self.payload)
+
+
+class RecordingProvider(FixtureProvider):
+    """
+    FixtureProvider which records requested history and exchange rate ranges.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.requests = []
+
+    def get_histories(self, tickers, period='1y', interval='1mo', start=None):
+        self.requests.append(('history', list(tickers), start))
+        return super().get_histories(tickers, period=period, interval=interval, start=start)
+
+    def get_rates_by_date(self, currency, start, end):
+        self.requests.append(('rates', currency, start, end))
+        return super().get_rates_by_date(currency, start, end)
+
+
+class StoredProviderTests(TestCase):
+    """
+    Stored history and exchange rates are not downloaded again, only their tail after the last stored date.
+    """
+
+    def setUp(self):
+        self.upstream = RecordingProvider()
+        self.provider = StoredProvider(self.upstream)
+
+    def test_history_tail_is_fetched(self):
+        first = self.provider.get_histories(['AAPL', 'SAP.DE'], period='1y', interval='1d')
+        last = PriceBar.objects.aggregate(last=Max('date'))['last']
+        second = self.provider.get_histories(['AAPL', 'SAP.DE'], period='1y', interval='1d')
+
+        self.assertEqual(self.upstream.requests, [('history', ['AAPL', 'SAP.DE'], None),
+                                                  ('history', ['AAPL', 'SAP.DE'], last)])
+        pd.testing.assert_frame_equal(first, second)
+
+    def test_new_ticker_is_fetched_whole(self):
+        self.provider.get_histories(['AAPL'], period='1y', interval='1d')
+        self.provider.get_histories(['AAPL', 'SAP.DE'], period='1y', interval='1d')
+        self.assertEqual(self.upstream.requests[1], ('history', ['SAP.DE'], None))
+
+    def test_rates_tail_is_fetched(self):
+        first = self.provider.get_rates_by_date('USD', '2024-06-03', '2024-06-28')
+        self.provider.get_rates_by_date('USD', '2024-06-03', '2024-09-20')
+        second = self.provider.get_rates_by_date('USD', '2024-06-10', '2024-06-28')
+
+        self.assertEqual(self.upstream.requests, [('rates', 'EUR', '2024-06-03', '2024-06-28'),
+                                                  ('rates', 'EUR', '2024-06-29', '2024-09-20')])
+        self.assertEqual(second['base'], 'USD')
+        self.assertEqual(second['rates'], {date: rates for date, rates in first['rates'].items()
+                                           if date >= '2024-06-10'})
+
+    @override_settings(MARKET_DATA_STORE_RETRY_DELAYS=(0,))
+    def test_locked_database_is_skipped(self):
+        expected = self.upstream.get_histories(['AAPL', 'SAP.DE'], period='1y', interval='1d')
+        expected.index = pd.DatetimeIndex(expected.index.date, name='Date')
+        locked = OperationalError('database is locked')
+        with mock.patch.object(PriceBar.objects, 'bulk_create', side_effect=locked) as bulk_create, \
+                mock.patch.object(Rate.objects, 'bulk_create', side_effect=locked), \
+                self.assertLogs('portfolio_app.store', 'WARNING'):
+            closes = self.provider.get_histories(['AAPL', 'SAP.DE'], period='1y', interval='1d')
+            rates = self.provider.get_rates_by_date('USD', '2024-06-03', '2024-06-28')
+
+        self.assertEqual(bulk_create.call_count, 4)
+        self.assertFalse(PriceBar.objects.exists())
+        pd.testing.assert_frame_equal(closes, expected, check_freq=False)
+        self.assertEqual(rates, self.upstream.get_rates_by_date('USD', '2024-06-03', '2024-06-28'))
+
+
+@override_settings(MARKET_DATA_PROVIDER='portfolio_app.providers.FixtureProvider', MARKET_DATA_STORE=False,
+                   MARKET_DATA_CACHE=None)
+class ValuationApiTests(TestCase):
+    """
+    Current value, history and gain API, responses are validated with ETag and Last-Modified. Market data is
+    requested in worker threads, which can not write to the test database while the test transaction is open, so
+    history is not stored.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='investor', password='secret')
+        cls.portfolio = Portfolio.objects.create(title='Portfolio', user=cls.user)
+        Item.objects.bulk_create([Item(portfolio_id=cls.portfolio, user=cls.user, ticker=ticker, quantity=quantity)
+                                  for ticker, quantity in [('AAPL', 10), ('SAP.DE', 5)]])
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def url(self, table, **query):
+        return reverse(f'api_{table}', args=[self.portfolio.pk]) + '?' + '&'.join(
+            f'{key}={value}' for key, value in {'base_currency': 'EUR', **query}.items())
+
+    def test_current(self):
+        response = self.client.get(self.url('current'))
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data['columns'][0], 'Ticker')
+        self.assertEqual(data['data']['Ticker'], ['AAPL', 'SAP.DE'])
+        self.assertAlmostEqual(data['value'], sum(data['data']['Sum per ticker EUR']), places=2)
+        self.assertTrue(response.has_header('ETag'))
+        self.assertTrue(response.has_header('Last-Modified'))
+        self.assertIn('private', response['Cache-Control'])
+
+    def test_history_and_gain(self):
+        history = self.client.get(self.url('history', period='1y', interval='1mo')).json()
+        self.assertEqual(history['columns'], ['AAPL', 'SAP.DE', 'Sum'])
+        self.assertEqual(len(history['index']), len(history['data']['Sum']))
+        gain = self.client.get(self.url('gain')).json()
+        self.assertEqual(set(gain), {'portfolio', 'base_currency', 'absolute', 'percent', 'errors', 'period',
+                                     'interval'})
+
+    def test_not_modified_is_not_calculated(self):
+        response = self.client.get(self.url('history'))
+        with mock.patch('portfolio_app.api.history_payload', side_effect=AssertionError('calculated')):
+            not_modified = self.client.get(self.url('history'), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified['ETag'], response['ETag'])
+        self.assertEqual(not_modified['Last-Modified'], response['Last-Modified'])
+
+        Item.objects.filter(ticker='AAPL').update(quantity=11)
+        self.assertEqual(self.client.get(self.url('history'), HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+
+    def test_changed_quotes_are_modified(self):
+        response = self.client.get(self.url('current'))
+        quotes, errors = FixtureProvider().get_quotes(['AAPL', 'SAP.DE'])
+        quotes['AAPL'] = {**quotes['AAPL'], 'currentPrice': quotes['AAPL']['currentPrice'] + 1}
+        with mock.patch.object(FixtureProvider, 'get_quotes', return_value=(quotes, errors)):
+            modified = self.client.get(self.url('current'), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(modified.status_code, 200)
+        self.assertNotEqual(modified['ETag'], response['ETag'])
+
+    def test_invalid_query(self):
+        response = self.client.get(self.url('current', base_currency='XXX'))
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('base_currency', response.json())
+        self.assertEqual(self.client.get(self.url('history', interval='1h')).status_code, 400)
+
+    def test_portfolio_of_other_user(self):
+        self.client.force_login(User.objects.create_user(username='other', password='secret'))
+        self.assertEqual(self.client.get(self.url('current')).status_code, 404)
+
+
+class StoredHistoryTests(TestCase):
+    """
+    History is read from stored daily valuations when they cover the period and all the holdings, otherwise it is
+    calculated from market data. Valuations are removed when holdings change.
+    """
+    today = datetime.date(2024, 9, 20)
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='investor', password='secret')
+        cls.portfolio = Portfolio.objects.create(title='Portfolio', user=cls.user)
+        Item.objects.bulk_create([Item(portfolio_id=cls.portfolio, user=cls.user, ticker=ticker, quantity=quantity)
+                                  for ticker, quantity in [('AAPL', 10), ('SAP.DE', 5)]])
+        cls.store_valuations()
+
+    @classmethod
+    def store_valuations(cls):
+        holdings = dict(Item.objects.filter(portfolio_id=cls.portfolio).values_list('ticker', 'quantity'))
+        market = market_snapshot(list(holdings), 'EUR', FixtureProvider(), datetime.datetime(2024, 9, 20, 12), '1y')
+        valuations, _ = history_valuations(cls.portfolio.pk, holdings, market)
+        save_valuations(valuations)
+
+    def calculator(self, provider, interval='1d'):
+        portfolio = Portfolio.objects.with_stocks().get(pk=self.portfolio.pk)
+        with mock.patch.object(Calculator, 'get_date_time', return_value=datetime.datetime(2024, 9, 20, 12)):
+            return Calculator(portfolio, 'EUR', provider=provider, interval=interval)
+
+    def stored_history(self, tickers=('AAPL', 'SAP.DE'), today=None):
+        return stored_history(self.portfolio.pk, 'EUR', list(tickers), '1y', '1d', today or self.today)
+
+    def test_history_is_read_from_valuations(self):
+        provider = FixtureProvider()
+        history = self.calculator(provider).get_history()[0]
+
+        self.assertNotIn('get_histories', provider.calls)
+        pd.testing.assert_frame_equal(history, self.calculator(FixtureProvider()).snapshot.history, check_freq=False)
+
+    def test_history_slack(self):
+        last = PortfolioValuation.objects.latest('date').date
+        self.assertIsNotNone(self.stored_history(today=last + HISTORY_SLACK))
+        self.assertIsNone(self.stored_history(today=last + HISTORY_SLACK + datetime.timedelta(days=1)))
+
+        start = (pd.Timestamp(self.today) - pd.DateOffset(years=1)).date()
+        PortfolioValuation.objects.filter(date__lt=start + HISTORY_SLACK).delete()
+        self.assertIsNotNone(self.stored_history())
+        PortfolioValuation.objects.filter(date__lte=start + HISTORY_SLACK).delete()
+        self.assertIsNone(self.stored_history())
+
+    def test_missing_ticker_is_not_read(self):
+        self.assertIsNone(self.stored_history(['AAPL', 'SAP.DE', 'NESN.SW']))
+
+    def test_changed_item_invalidates_history(self):
+        before = self.stored_history()
+        Item.objects.get(ticker='AAPL').save(update_fields=['created'])
+        self.assertTrue(PortfolioValuation.objects.exists())
+
+        item = Item.objects.get(ticker='AAPL')
+        item.quantity = 20
+        item.save()
+        self.assertFalse(PortfolioValuation.objects.exists())
+
+        provider = FixtureProvider()
+        history = self.calculator(provider).get_history()[0]
+        self.assertEqual(provider.calls['get_histories'], 1)
+        pd.testing.assert_series_equal(history['AAPL'], before['AAPL'] * 2, atol=0.011, check_freq=False)
+        pd.testing.assert_series_equal(history['SAP.DE'], before['SAP.DE'], check_freq=False)
+
+        self.store_valuations()
+        pd.testing.assert_frame_equal(self.calculator(FixtureProvider()).stored_history, history, check_freq=False)
+
+    def test_deleted_item_invalidates_history(self):
+        Item.objects.get(ticker='SAP.DE').delete()
+        self.assertFalse(PortfolioValuation.objects.exists())
+        self.assertIsNone(self.calculator(FixtureProvider()).stored_history)
+
+
+@override_settings(MARKET_DATA_PROVIDER='portfolio_app.providers.FixtureProvider', MARKET_DATA_STORE=False,
+                   MARKET_DATA_CACHE=None)
+class ValuePortfoliosTests(TestCase):
+    """
+    Batch valuation gives the same values as valuation of every portfolio on its own.
+    """
+    time_of_request = datetime.datetime(2024, 9, 21, 1, tzinfo=LOCAL_TIMEZONE)
+    holdings = {'first': {'AAPL': 10, 'SAP.DE': 5, '7203.T': 100}, 'second': {'AAPL': 3, 'NESN.SW': 7}}
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='investor', password='secret')
+        cls.portfolios = {}
+        for title, holdings in cls.holdings.items():
+            portfolio = Portfolio.objects.create(title=title, user=cls.user)
+            Item.objects.bulk_create([Item(portfolio_id=portfolio, user=cls.user, ticker=ticker, quantity=quantity)
+                                      for ticker, quantity in holdings.items()])
+            cls.portfolios[title] = portfolio.pk
+
+    def snapshot(self, holdings, base_currency='USD', interval='1mo'):
+        return PortfolioSnapshot(holdings, base_currency, FixtureProvider(), self.time_of_request, interval=interval)
+
+    def test_value_holdings_matches_snapshot(self):
+        provider = FixtureProvider()
+        quotes, _ = provider.get_quotes(['AAPL', 'SAP.DE', '7203.T', 'NESN.SW'])
+        values, totals, errors = value_holdings(holdings_frame(), quotes, provider.get_rates('USD'), 'USD')
+
+        self.assertEqual(errors, {})
+        for title, holdings in self.holdings.items():
+            snapshot = self.snapshot(holdings)
+            portfolio = values[values['portfolio'] == self.portfolios[title]]
+            self.assertEqual(dict(zip(portfolio['ticker'], portfolio['value'])),
+                             dict(zip(snapshot.current['Ticker'], snapshot.current['Sum per ticker USD'])))
+            self.assertEqual(totals[self.portfolios[title]], snapshot.portfolio_value)
+
+    def test_history_of_subset_matches_snapshot(self):
+        provider = FixtureProvider()
+        market = market_snapshot(['7203.T', 'AAPL', 'NESN.SW', 'SAP.DE'], 'USD', provider, self.time_of_request, '1y')
+        for holdings in self.holdings.values():
+            pd.testing.assert_frame_equal(market.subset(holdings).history,
+                                          self.snapshot(holdings, interval='1d').history)
+        self.assertEqual(provider.calls['get_histories'], 1)
+
+    def test_valuations_are_dated_by_local_date(self):
+        with mock.patch('portfolio_app.management.commands.value_portfolios.local_now',
+                        return_value=self.time_of_request), \
+                self.assertLogs('portfolio_app.management.commands.value_portfolios', 'INFO'):
+            call_command('value_portfolios', base_currencies=['USD'])
+
+        for title, holdings in self.holdings.items():
+            valuations = PortfolioValuation.objects.filter(portfolio_id=self.portfolios[title], base_currency='USD')
+            latest = valuations.latest('date')
+            self.assertEqual(latest.date, datetime.date(2024, 9, 21))
+            self.assertEqual(latest.value, self.snapshot(holdings).portfolio_value)
+            history = self.snapshot(holdings, interval='1d').history
+            self.assertEqual(valuations.filter(date__lt=latest.date).count(), len(history))
+
+
+class MixedCurrencyRegressionTests(SimpleTestCase):
+    """
+    Vectorized history and gain of a portfolio in several currencies are the same as when they were calculated
+    ticker by ticker and date by date.
+    """
+    holdings = {'AAPL': 10, 'SAP.DE': 5, '7203.T': 100, 'NESN.SW': 7}
+    time_of_request = datetime.datetime(2024, 9, 20, 12, tzinfo=LOCAL_TIMEZONE)
+
+    def calculator(self, base_currency, interval):
+        with mock.patch.object(Calculator, 'get_date_time', return_value=self.time_of_request):
+            return Calculator(BenchmarkPortfolio(self.holdings), base_currency, provider=FixtureProvider(),
+                              interval=interval)
+
+    def reference_history(self, snapshot):
+        closes = snapshot.aligned_closes
+        end = min(closes.index[-1], pd.Timestamp(self.time_of_request.date()))
+        exchange_rates = FixtureProvider().get_rates_by_date(
+            snapshot.base_currency, (closes.index[0] - datetime.timedelta(days=30)).strftime('%Y-%m-%d'),
+            end.strftime('%Y-%m-%d'))
+        history = pd.DataFrame(index=closes.index)
+        for stock in closes.columns:
+            currency = snapshot.currencies[stock]
+            values = []
+            for date in closes.index:
+                exchange_rate = 1.0
+                if currency != snapshot.base_currency:
+                    day = date
+                    while day.strftime('%Y-%m-%d') not in exchange_rates['rates']:
+                        day -= datetime.timedelta(days=1)
+                    exchange_rate = exchange_rates['rates'][day.strftime('%Y-%m-%d')][currency]
+                values.append(round(closes.loc[date, stock] * snapshot.holdings[stock] / exchange_rate, 2))
+            history[stock] = values
+        history['Sum'] = round(history.sum(axis=1), 2)
+        return history
+
+    def test_history(self):
+        for base_currency in ('EUR', 'USD', 'CHF'):
+            for interval in ('1d', '1wk', '1mo'):
+                with self.subTest(base_currency=base_currency, interval=interval):
+                    calculator = self.calculator(base_currency, interval)
+                    history = calculator.get_history()[0]
+                    self.assertEqual(list(history.columns), [*self.holdings, 'Sum'])
+                    self.assertEqual(calculator.errors, {})
+                    # Python and numpy round halves differently, values may differ by one cent.
+                    pd.testing.assert_frame_equal(history, self.reference_history(calculator.snapshot),
+                                                  check_freq=False, check_exact=False, rtol=0, atol=0.011)
+
+    def test_gain(self):
+        for base_currency in ('EUR', 'USD', 'CHF'):
+            for interval in ('1wk', '1mo'):
+                with self.subTest(base_currency=base_currency, interval=interval):
+                    calculator = self.calculator(base_currency, interval)
+                    data_gain_abs, data_gain, _, _ = calculator.get_gain()
+
+                    current_data = calculator.current_portfolio_value()[0].set_index('Date').T
+                    current_data['Sum'] = current_data.sum(axis=1)
+                    history = calculator.get_history()[0]
+                    reference_abs = history.copy()
+                    reference = history.copy()
+                    for stock in history.columns:
+                        current_price = float(current_data[stock].iloc[0])
+                        for date in history.index:
+                            reference_abs.loc[date, stock] = round(current_price - history.loc[date, stock], 2)
+                            reference.loc[date, stock] = round((current_price - history.loc[date, stock])
+                                                               / history.loc[date, stock] * 100, 1)
+
+                    pd.testing.assert_frame_equal(data_gain_abs, reference_abs, check_freq=False,
+                                                  check_exact=False, rtol=0, atol=0.011)
+                    pd.testing.assert_frame_equal(data_gain, reference, check_freq=False, check_exact=False, rtol=0,
+                                                  atol=0.11)
+
+
+@override_settings(MARKET_DATA_PROVIDER='portfolio_app.providers.FixtureProvider', MARKET_DATA_STORE=False,
+                   MARKET_DATA_CACHE=None)
+class TablePageTests(TestCase):
+    """
+    Following pages of History and Gain tables are sliced from the table calculated for the first page. Daily history
+    of a year has three pages of TABLE_PAGE_SIZE (100) rows.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='investor', password='secret')
+        cls.portfolio = Portfolio.objects.create(title='Portfolio', user=cls.user)
+        Item.objects.bulk_create([Item(portfolio_id=cls.portfolio, user=cls.user, ticker=ticker, quantity=quantity)
+                                  for ticker, quantity in [('AAPL', 10), ('SAP.DE', 5)]])
+
+    def setUp(self):
+        caches['default'].clear()
+        self.client.force_login(self.user)
+
+    def url(self, table):
+        return reverse('portfolio_table', args=[self.portfolio.pk, table]) + (
+            f'?base_currency=EUR&portfolio_id={self.portfolio.pk}&period=1y&interval=1d')
+
+    def test_following_pages_are_not_calculated(self):
+        first = self.client.get(self.url('history') + '&page=1').json()
+        self.assertEqual(first['shown'], 100)
+        self.assertIn('token=', first['next_url'])
+
+        with mock.patch('portfolio_app.views.export_frame', side_effect=AssertionError('calculated')):
+            second = self.client.get(first['next_url']).json()
+            last = self.client.get(second['next_url']).json()
+        self.assertEqual((second['shown'], last['shown'], last['count']), (200, first['count'], first['count']))
+        self.assertIsNone(last['next_url'])
+
+    def test_expired_table_is_calculated_again(self):
+        first = self.client.get(self.url('gain') + '&page=1').json()
+        caches['default'].clear()
+        second = self.client.get(first['next_url']).json()
+        self.assertEqual(second['shown'], 200)
+        self.assertEqual(second['next_url'].split('token=')[1], first['next_url'].split('token=')[1])
+
+    def test_parquet_link_needs_pyarrow(self):
+        data = {'base_currency': 'EUR', 'portfolio_id': self.portfolio.pk, 'period': '1y', 'interval': '1mo',
+                'history': ''}
+        url = reverse('portfolio_detail', args=[self.portfolio.pk])
+        with mock.patch('portfolio_app.utils.get_chart_renderer'):
+            with mock.patch('portfolio_app.views.pyarrow', None):
+                self.assertNotContains(self.client.post(url, data), 'history.parquet')
+            with mock.patch('portfolio_app.views.pyarrow', object()):
+                self.assertContains(self.client.post(url, data), 'history.parquet')
+
+
+class TickerRegistryTests(TestCase):
+    """
+    Tickers are registered from their quotes, registered tickers are not requested again until they are stale.
+    """
+
+    def test_register_updates_registered_ticker(self):
+        verified = datetime.datetime(2024, 9, 20, tzinfo=datetime.timezone.utc)
+        register({'AAPL': {'currentPrice': 1.0, 'currency': 'EUR'}}, verified)
+        register({'AAPL': {'currentPrice': 1.0, 'currency': 'USD', 'exchange': 'NMS'},
+                  'SAP.DE': {'currentPrice': 1.0, 'currency': 'EUR'}}, verified + datetime.timedelta(days=1))
+
+        self.assertEqual(list(Ticker.objects.order_by('symbol').values_list('symbol', 'currency', 'exchange')),
+                         [('AAPL', 'USD', 'NMS'), ('SAP.DE', 'EUR', '')])
+        self.assertEqual(Ticker.objects.get(symbol='AAPL').last_verified, verified + datetime.timedelta(days=1))
+
+    def test_lookup_registers_new_ticker(self):
+        ticker = lookup('AAPL', FixtureProvider())
+        self.assertEqual((ticker.symbol, ticker.currency), ('AAPL', 'USD'))
+        self.assertTrue(Ticker.objects.filter(symbol='AAPL').exists())
+
+        with self.assertRaises(MarketDataError):
+            lookup('NOPE', FixtureProvider())
+        self.assertFalse(Ticker.objects.filter(symbol='NOPE').exists())
+
+    def test_lookup_of_registered_ticker(self):
+        register({'AAPL': {'currentPrice': 1.0, 'currency': 'USD'}})
+        provider = mock.Mock(spec=FixtureProvider)
+        with mock.patch('portfolio_app.tickers.refresh') as refresh:
+            self.assertEqual(lookup('AAPL', provider).currency, 'USD')
+            refresh.assert_not_called()
+            Ticker.objects.update(last_verified=timezone.now() - datetime.timedelta(days=2))
+            self.assertEqual(lookup('AAPL', provider).currency, 'USD')
+            refresh.assert_called_once_with(['AAPL'])
+        provider.get_quotes.assert_not_called()
+
+    def test_unregistered_tickers_fall_back_to_quotes(self):
+        register({'AAPL': {'currentPrice': 1.0, 'currency': 'USD'}})
+        provider = FixtureProvider()
+        snapshot = PortfolioSnapshot({'AAPL': 1, 'SAP.DE': 2, 'NOPE': 3}, 'EUR', provider,
+                                     datetime.datetime(2024, 9, 20), registry=currencies)
+        with mock.patch.object(provider, 'get_quotes', wraps=provider.get_quotes) as get_quotes:
+            self.assertEqual(snapshot.currencies, {'AAPL': 'USD', 'SAP.DE': 'EUR'})
+        get_quotes.assert_called_once_with(['SAP.DE', 'NOPE'])
+        self.assertEqual(snapshot.errors, {'NOPE': 'Ticker "NOPE" does not exist.'})
+
+
+
+class WarmCacheTests(TestCase):
+    """
+    Quotes are requested once per batch of tickers, however many histories are warmed.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create_user(username='investor', password='secret')
+        portfolio = Portfolio.objects.create(title='warm', user=user)
+        Item.objects.bulk_create([Item(portfolio_id=portfolio, user=user, ticker=ticker, quantity=1)
+                                  for ticker in ('7203.T', 'AAPL', 'NOPE', 'SAP.DE')])
+
+    def test_quotes_are_requested_once_per_batch(self):
+        provider = FixtureProvider()
+        with mock.patch('portfolio_app.management.commands.warm_cache.get_default_provider', return_value=provider), \
+                self.assertLogs('portfolio_app.management.commands.warm_cache', 'INFO'):
+            warmed, errors = WarmCacheCommand().warm([('1y', '1mo'), ('5y', '1mo'), ('1y', '1d')], 2)
+
+        self.assertEqual(warmed, 3)
+        self.assertEqual(set(Ticker.objects.values_list('symbol', flat=True)), {'7203.T', 'AAPL', 'SAP.DE'})
+        self.assertEqual(set(errors), {'NOPE'})
+        self.assertEqual(provider.calls['get_quotes'], 2)
+        self.assertEqual(provider.calls['get_histories'], 6)
+
+
+class ChartRendererTests(SimpleTestCase):
+    """
+    Rendered charts are served from the existing image and old images are removed over the size limit.
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory(prefix='charts-')
+        self.addCleanup(directory.cleanup)
+        self.renderer = ChartRenderer(workers=1, media_root=directory.name, max_bytes=1000)
+        self.addCleanup(self.renderer.executor.shutdown)
+        self.rendered = []
+
+    def blank_chart(self, path, size, label):
+        self.rendered.append(label)
+        with open(path, 'wb') as f:
+            f.write(b'\0' * size)
+
+    def render(self, label, size=400):
+        name = self.renderer.submit('test', self.blank_chart, size, label)
+        self.renderer.wait(name)
+        return name
+
+    def test_repeated_submit_reuses_image(self):
+        name = self.render('a')
+        self.assertEqual(self.renderer.status(name), 'ready')
+        self.assertEqual(self.render('a'), name)
+        self.assertEqual(self.rendered, ['a'])
+        self.assertNotEqual(self.render('b'), name)
+        self.assertEqual(self.rendered, ['a', 'b'])
+
+    def test_eviction_keeps_images_within_max_bytes(self):
+        first, second = self.render('a'), self.render('b')
+        now = time.time()
+        os.utime(self.renderer.path(first), (now - 20, now - 20))
+        os.utime(self.renderer.path(second), (now - 10, now - 10))
+        self.render('a')
+        third = self.render('c')
+
+        self.assertEqual(self.rendered, ['a', 'b', 'c'])
+        self.assertEqual([self.renderer.status(name) for name in (first, second, third)],
+                         ['ready', 'missing', 'ready'])
+        total = sum(entry.stat().st_size for entry in os.scandir(self.renderer.media_root))
+        self.assertLessEqual(total, self.renderer.max_bytes)
@@ -0,0 +1,120 @@
+import logging
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from .models import Ticker
+from .providers import MarketDataError, get_default_provider
+
+
+logger = logging.getLogger(__name__)
+
+
+def register(quotes, verified=None):
+    """
+    Stores metadata of tickers from their quotes, tickers which are already registered are updated.
+    :param quotes: dictionary with ticker names as a keys and get_quote dictionaries ('currency' and optional
+     'exchange') as a values
+    :param verified: time of the check, datetime object, now by default
+    :return: dictionary with ticker names as a keys and Ticker objects as a values
+    """
+    verified = verified or timezone.now()
+    tickers = [Ticker(symbol=symbol, currency=quote['currency'], exchange=quote.get('exchange') or '',
+                      last_verified=verified)
+               for symbol, quote in quotes.items()]
+    Ticker.objects.bulk_create(tickers, update_conflicts=True, unique_fields=['symbol'],
+                               update_fields=['currency', 'exchange', 'last_verified'])
+    return {ticker.symbol: ticker for ticker in tickers}
+
+
+def verify(symbols, provider=None):
+    """
+    Requests quotes of tickers and registers tickers which were found.
+    :param symbols: list of ticker names
+    :param provider: MarketDataProvider object, provider configured by MARKET_DATA_PROVIDER setting by default
+    :return:    tickers - dictionary with ticker names as a keys and Ticker objects as a values;
+                errors - dictionary with ticker names as a keys and error messages as a values (tickers which do not
+                 exist and tickers which could not be requested).
+    """
+    provider = provider if provider is not None else get_default_provider()
+    quotes, errors = provider.get_quotes(list(symbols))
+    return register(quotes), errors
+
+
+def is_stale(ticker, now=None):
+    """
+    :param ticker: Ticker object
+    :param now: datetime object, now by default
+    :return: True when ticker was verified more than TICKER_REFRESH_AGE seconds ago
+    """
+    age = datetime.timedelta(seconds=getattr(settings, 'TICKER_REFRESH_AGE', 24 * 60 * 60))
+    return ticker.last_verified < (now or timezone.now()) - age
+
+
+def lookup(symbol, provider=None):
+    """
+    Returns metadata of the ticker from the registry. Ticker which is not registered yet is checked by the provider
+    and registered, registered ticker which is stale is returned at once and checked again in the background.
+    :param symbol: ticker name, string
+    :param provider: MarketDataProvider object used for tickers which are not registered
+    :return: Ticker object
+    :raises MarketDataError: ticker does not exist or could not be requested
+    """
+    ticker = Ticker.objects.filter(symbol=symbol).first()
+    if ticker is None:
+        tickers, errors = verify([symbol], provider)
+        if symbol not in tickers:
+            raise MarketDataError(errors.get(symbol, f'Ticker "{symbol}" does not exist.'))
+        return tickers[symbol]
+    if is_stale(ticker):
+        refresh([symbol])
+    return ticker
+
+
+def currencies(symbols):
+    """
+    :param symbols: list of ticker names
+    :return: dictionary with registered ticker names as a keys and their currencies as a values
+    """
+    return dict(Ticker.objects.filter(symbol__in=list(symbols)).values_list('symbol', 'currency'))
+
+
+_executor = None
+_refreshing = set()
+_lock = threading.Lock()
+
+
+def refresh(symbols):
+    """
+    Checks tickers again in a background thread (TICKER_REFRESH_WORKERS setting), tickers which are already being
+    checked are skipped.
+    :param symbols: list of ticker names
+    :return: Future object, None when there is nothing to check
+    """
+    global _executor
+    with _lock:
+        symbols = [symbol for symbol in symbols if symbol not in _refreshing]
+        if not symbols:
+            return None
+        _refreshing.update(symbols)
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=getattr(settings, 'TICKER_REFRESH_WORKERS', 2),
+                                           thread_name_prefix='ticker-refresh')
+        return _executor.submit(_refresh, symbols)
+
+
+def _refresh(symbols):
+    try:
+        _, errors = verify(symbols)
+        for symbol, error in errors.items():
+            logger.warning('%s: %s', symbol, error)
+    except Exception:
+        logger.exception('Refresh of tickers %s failed.', ', '.join(symbols))
+    finally:
+        with _lock:
+            _refreshing.difference_update(symbols)
+        close_old_connections()
@@ -0,0 +1,107 @@
+import time
+import threading
+import contextlib
+import collections
+
+
+class Timings:
+    """
+    Timing spans of one request. Spans are recorded from the request thread and from worker threads which fetch
+    market data, and every finished span is also added to process-wide counters (metrics function).
+    """
+
+    def __init__(self):
+        self.spans = []
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name, category):
+        """
+        Measures the block.
+        :param name: name of the phase, token without spaces, e.g. 'fetch_quotes'
+        :param category: 'fetch' (upstream request), 'compute' (pandas), 'render' (charts) or 'export' (CSV)
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, category, time.perf_counter() - started)
+
+    def add(self, name, category, duration):
+        """
+        :param name: name of the phase, string
+        :param category: category of the phase, string
+        :param duration: duration in seconds, float
+        """
+        with self.lock:
+            self.spans.append((name, category, duration))
+        record(name, category, duration)
+
+    def totals(self):
+        """
+        :return: list of dictionaries with name, category, count and duration (ms) of every phase, in order of the
+         first span of the phase
+        """
+        totals = {}
+        with self.lock:
+            spans = list(self.spans)
+        for name, category, duration in spans:
+            total = totals.setdefault(name, {'name': name, 'category': category, 'count': 0, 'duration': 0.0})
+            total['count'] += 1
+            total['duration'] += duration * 1000
+        return list(totals.values())
+
+    @property
+    def elapsed(self):
+        """
+        :return: milliseconds since start of the request, float
+        """
+        return (time.perf_counter() - self.started) * 1000
+
+    def server_timing(self):
+        """
+        :return: value of Server-Timing header with total of every phase and of the whole request
+        """
+        metrics = [f'{total["name"]};desc="{total["category"]}";dur={total["duration"]:.1f}'
+                   for total in self.totals()]
+        metrics.append(f'total;dur={self.elapsed:.1f}')
+        return ', '.join(metrics)
+
+
+def request_timings(request):
+    """
+    :param request: HttpRequest object
+    :return: Timings object of the request (set by server_timing_middleware), new one when request has none
+    """
+    timings = getattr(request, 'timings', None)
+    return timings if timings is not None else Timings()
+
+
+_metrics = collections.defaultdict(lambda: {'category': None, 'count': 0, 'total': 0.0, 'max': 0.0})
+_metrics_lock = threading.Lock()
+
+
+def record(name, category, duration):
+    """
+    Adds span to process-wide counters.
+    :param name: name of the phase, string
+    :param category: category of the phase, string
+    :param duration: duration in seconds, float
+    """
+    with _metrics_lock:
+        metric = _metrics[name]
+        metric['category'] = category
+        metric['count'] += 1
+        metric['total'] += duration
+        metric['max'] = max(metric['max'], duration)
+
+
+def metrics():
+    """
+    :return: dictionary with phase names as a keys and their category, count, total, mean and maximum duration in
+     seconds as a values, counted since start of the process
+    """
+    with _metrics_lock:
+        return {name: {**metric, 'mean': metric['total'] / metric['count']}
+                for name, metric in _metrics.items() if metric['count']}
@@ -1,7 +1,9 @@
 from django.urls import path, include
 
+from .api import api_current, api_history, api_gain
 from .views import (index, register, PortfolioListView, PortfolioUpdateView, PortfolioDeleteView, portfolio_detail,
-                    update_item, delete_item)
+                    update_item, delete_item, chart_status, portfolio_export, portfolio_table,
+                    metrics)
 
 urlpatterns = [
     path('', index, name='index'),
@@ -10,6 +12,13 @@ urlpatterns = [
     path('portfolio/<int:pk>/', portfolio_detail, name='portfolio_detail'),
     path('update_item/<int:pk>/', update_item, name='update_item'),
     path('delete_item/<int:pk>/', delete_item, name='delete_item'),
+    path('portfolio/<int:pk>/export/<str:table>.<str:file_format>', portfolio_export, name='portfolio_export'),
+    path('portfolio/<int:pk>/table/<str:table>/', portfolio_table, name='portfolio_table'),
+    path('api/portfolios/<int:pk>/current/', api_current, name='api_current'),
+    path('api/portfolios/<int:pk>/history/', api_history, name='api_history'),
+    path('api/portfolios/<int:pk>/gain/', api_gain, name='api_gain'),
+    path('charts/<str:name>/status/', chart_status, name='chart_status'),
+    path('metrics/', metrics, name='metrics'),
     path('myportfolios/<int:pk>/update', PortfolioUpdateView.as_view(), name='portfolio_update'),
     path('myportfolios/<int:pk>/delete', PortfolioDeleteView.as_view(), name='portfolio_delete'),
 ]
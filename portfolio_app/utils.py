@@ -1,33 +1,110 @@
-import os
-import numpy as np
-import yfinance as yf
-import requests
 import csv
 import datetime
 import pandas as pd
-import matplotlib.pyplot as plt
+from asgiref.sync import async_to_sync, sync_to_async
 
-from portfolio_project import settings
+from .charts import get_chart_renderer, pie_chart, stack_chart, line_chart, bar_chart
+from .export import audit_path
+from .providers import get_default_provider
+from .snapshot import PortfolioSnapshot, local_now, memoized
+from .tickers import currencies
+from .timing import Timings
+from .valuation import stored_history
+
+
+PERIOD_TITLES = {'1y': '1Y', '5y': '5Y', '10y': '10Y', 'max': 'max'}
+
+INTERVAL_TITLES = {'1d': 'day', '1wk': 'week', '1mo': 'month'}
+
+BAR_WIDTHS = {'1d': 0.8, '1wk': 5, '1mo': 20}
 
 
 class Calculator:
 
-    def __init__(self, portfolio, base_currency):
+    def __init__(self, portfolio, base_currency, provider=None, period='1y', interval='1mo', renderer=None,
+                 timings=None):
         """
         When creating class Calculator object we are initializing data and base currency variables. Data is
          Portfolio item data necessary for calculations. base_currency is a currency in which our results will
           be expressed.
         :param portfolio: dictionary with ticker names as a keys and quantities as a values;
-        :param base_currency: currency code, string.
+        :param base_currency: currency code, string;
+        :param provider: MarketDataProvider object used for quotes, history and exchange rates, when not given
+         provider configured by MARKET_DATA_PROVIDER setting is used;
+        :param period: history period used by get_history and get_gain ('1y', '5y', '10y', 'max'), string;
+        :param interval: history interval used by get_history and get_gain ('1d', '1wk', '1mo'), string;
+        :param renderer: ChartRenderer object which renders charts, shared renderer of the process by default;
+        :param timings: Timings object which records spans of requests to the provider, calculations, charts and CSV
+         files, e.g. Timings of the request (request.timings), new one by default.
         """
         self.portfolio = portfolio
         self.data = self.convert_to_data()
         self.base_currency = base_currency
+        self.provider = provider if provider is not None else get_default_provider()
+        self.renderer = renderer if renderer is not None else get_chart_renderer()
+        self.timings = timings if timings is not None else Timings()
+        holdings = {stock: values['amount'] for stock, values in self.data['stocks'].items()}
+        self.period = period
+        self.interval = interval
+        registry = currencies if getattr(portfolio, 'pk', None) is not None else None
+        self.snapshot = PortfolioSnapshot(holdings, base_currency, self.provider, self.get_date_time(), period=period,
+                                          interval=interval, timings=self.timings, registry=registry)
+
+    @property
+    def errors(self):
+        """
+        :return: dictionary with ticker names which could not be calculated as a keys and error messages as a values
+        """
+        return self.snapshot.errors
+
+    @memoized
+    def stored_history(self):
+        """
+        History of the portfolio read from valuations stored by value_portfolios command.
+        :return: dataframe as PortfolioSnapshot.history, None when portfolio is not stored in the database or its
+         stored valuations do not cover the period
+        """
+        portfolio_id = getattr(self.portfolio, 'pk', None)
+        if portfolio_id is None:
+            return None
+        with self.timings.span('load_valuations', 'database'):
+            return stored_history(portfolio_id, self.base_currency, self.snapshot.tickers, self.period, self.interval,
+                                  self.snapshot.time_of_request.date())
+
+    @property
+    def history(self):
+        """
+        :return: stored history of the portfolio, history calculated from market data when it is not stored
+        """
+        if self.stored_history is not None:
+            return self.stored_history
+        return self.snapshot.history
+
+    async def aprefetch(self, current=True, history=True):
+        """
+        Requests market data of the snapshot concurrently before calculations, used by asynchronous views, so
+        current_portfolio_value, get_history and get_gain do not wait for the provider afterwards. History is not
+        requested when it is stored.
+        :param current: if False data of current value is not requested (for get_history);
+        :param history: if False data of history is not requested (for current_portfolio_value).
+        """
+        if history:
+            history = await sync_to_async(lambda: self.stored_history is None)()
+        await self.snapshot.aprefetch(current=current, history=history)
+
+    def prefetch(self, current=True, history=True):
+        """
+        Synchronous version of aprefetch for synchronous views and management commands.
+        :param current: if False data of current value is not requested (for get_history);
+        :param history: if False data of history is not requested (for current_portfolio_value).
+        """
+        async_to_sync(self.aprefetch)(current=current, history=history)
 
     def convert_to_data(self):
         """
         This method converts selected class Portfolio object from database to the dictionary which is suitable for class for
-        below class Calculator methods:current_portfolio_value, get_history, get_gain
+        below class Calculator methods:current_portfolio_value, get_history, get_gain. Items of portfolio loaded with
+        Portfolio.objects.with_stocks() are not queried again.
         :return: dictionary with ticker names as a keys and quantities as a values.
         """
 
@@ -37,276 +114,136 @@ class Calculator:
             data['stocks'][stock.ticker] = {'amount': stock.quantity}
         return data
 
-    def current_portfolio_value(self):
+    def current_portfolio_value(self, charts=False, export_csv=False):
         """
         Mainly this method is necessary to return a dataframe with information of Portfolio tickers current prices,
         sum prices, total price in base currency, as well as additional important current information.
+        Tickers which could not be valued are skipped and reported in errors attribute.
+        :param charts: if True pie chart is queued for rendering to MEDIA_ROOT;
+        :param export_csv: if True results are written to portfolio_value_<time>.csv audit file in EXPORT_AUDIT_DIR.
         :return:    df - dataframe for method get_gain();
                     df_app - dataframe for current_portfolio_value method;
                     portfolio_value - float, total current portfolio value;
                     time_of_request - date and time of request, datetime object;
-                    image_name - string of image name (pie chart).
+                    image_name - string of image name (pie chart), None if chart was not requested, image could be
+                     not rendered yet when method returns.
         """
-        exchange_rates = self.get_rates(self.base_currency)
-
-        portfolio_ticker_list = []
-        amount_list = []
-        stock_currency_list = []
-        stock_current_price_list = []
-        sum_per_stock_list = []
-        exchange_rate_list = []
-        sum_per_stock_base_currency_list = []
-
-        time_of_request = self.get_date_time()
-        date_time_str = datetime.datetime.strftime(time_of_request, '%Y%m%d_%H%M%S')
-
-        file_name = f'portfolio_value_{date_time_str}.csv'
-
-        with open(file_name, 'a') as f:
-            writer = csv.writer(f, delimiter=',')
-            writer.writerow(['Ticker', 'Quantity', 'Ticker currency', 'Current Price', 'totalPerShare', 'Exchange rate',
-                             f'totalPerShare, {self.base_currency}'])
-
-        for stock in self.data['stocks']:
-            ticker_yahoo = yf.Ticker(stock)
-
-            stock_current_price = ticker_yahoo.info['currentPrice']
-            stock_currency = ticker_yahoo.info['currency']
-            if stock_currency != self.base_currency:
-                exchange_rate = exchange_rates['rates'][stock_currency]
-            else:
-                exchange_rate = 1.0
-            amount = self.data['stocks'][stock]['amount']
-            sum_per_stock = round(stock_current_price * amount, 2)
-            sum_per_stock_base_currency = round(sum_per_stock / exchange_rate, 2)
-
-            portfolio_ticker_list.append(stock)
-            amount_list.append(amount)
-            stock_currency_list.append(stock_currency)
-            stock_current_price_list.append(stock_current_price)
-            sum_per_stock_list.append(sum_per_stock)
-            exchange_rate_list.append(exchange_rate)
-            sum_per_stock_base_currency_list.append(sum_per_stock_base_currency)
-
-            with open(file_name, 'a') as f:
+        df_app = self.snapshot.current
+        portfolio_value = self.snapshot.portfolio_value
+        time_of_request = self.snapshot.time_of_request
+
+        if export_csv:
+            date_time_str = datetime.datetime.strftime(time_of_request, '%Y%m%d_%H%M%S')
+            with self.timings.span('export_csv', 'export'), \
+                    open(audit_path(f'portfolio_value_{date_time_str}.csv'), 'a', newline='') as f:
                 writer = csv.writer(f, delimiter=',')
-                writer.writerow([stock, amount, stock_currency, stock_current_price, sum_per_stock, exchange_rate,
-                                 sum_per_stock_base_currency])
-
-        portfolio_value = round(sum(sum_per_stock_base_currency_list), 2)
-
-        with open(file_name, 'a') as f:
-            writer = csv.writer(f, delimiter=',')
-            writer.writerow([''])
-            writer.writerow(['currentPortfolioValue:', portfolio_value, self.base_currency, 'timeOfRequest:',
-                             time_of_request])
+                writer.writerow(['Ticker', 'Quantity', 'Ticker currency', 'Current Price', 'totalPerShare',
+                                 'Exchange rate', f'totalPerShare, {self.base_currency}'])
+                writer.writerows(df_app.itertuples(index=False))
+                writer.writerow([''])
+                writer.writerow(['currentPortfolioValue:', portfolio_value, self.base_currency, 'timeOfRequest:',
+                                 time_of_request])
 
         date_to_str = time_of_request.strftime('%Y-%m-%d')
         date_datetime = datetime.datetime.strptime(date_to_str, '%Y-%m-%d')
 
         df = pd.DataFrame({
-            'Date': portfolio_ticker_list,
-            f'{date_datetime}': sum_per_stock_base_currency_list
+            'Date': df_app['Ticker'],
+            f'{date_datetime}': df_app[f'Sum per ticker {self.base_currency}']
         })
 
-        df_app = pd.DataFrame({
-            'Ticker': portfolio_ticker_list,
-            'Amount': amount_list,
-            'Ticker currency': stock_currency_list,
-            'Current Price': stock_current_price_list,
-            'Sum per ticker': sum_per_stock_list,
-            'Exchange rate': exchange_rate_list,
-            f'Sum per ticker {self.base_currency}': sum_per_stock_base_currency_list,
-        })
-
-        plt.figure(figsize=(8, 8))
-        plt.title(f'Total portfolio value: {portfolio_value} {self.base_currency} {time_of_request}')
-        plt.pie(df[f'{date_datetime}'], labels=df['Date'],
-                autopct=lambda pct: '{:.2f}% ({:.2f} {})'.format(pct, ((pct/100)*portfolio_value), self.base_currency),
-                pctdistance=1.2, labeldistance=.6, explode=(np.ones(len(portfolio_ticker_list))*0.05), shadow=True)
-        image_name = f'pie_portfolio_value_{date_time_str}.png'
-        image_path = os.path.join(settings.MEDIA_ROOT, image_name)
-        plt.savefig(image_path)
+        image_name = None
+        if charts and not df.empty:
+            with self.timings.span('submit_charts', 'render'):
+                image_name = self.renderer.submit('pie_portfolio_value', pie_chart, list(df['Date']),
+                                                  list(df[f'{date_datetime}']), portfolio_value, self.base_currency)
 
         return df, df_app, portfolio_value, time_of_request, image_name
 
-    def get_history(self):
+    def get_history(self, charts=False, export_csv=False):
         """
         get_history method is necessary to return historical information of ticker sum prices, and total price within
-        previous 1-year period on 1-month interval, all in selected base currency.
+        selected period on selected interval (1-year period on 1-month interval by default), all in selected base
+        currency. History stored by value_portfolios command is used when it covers the period. Tickers without
+        history are skipped and reported in errors attribute.
+        :param charts: if True stackplot and plot are queued for rendering to MEDIA_ROOT;
+        :param export_csv: if True results are written to portfolio_<period>_data_<time>.csv audit file in
+         EXPORT_AUDIT_DIR.
         :return:    portfolio_history - dataframe with historical values of each ticker and historical total values;
-                    image_1_name - string of image name (stackplot);
-                    image_2_name - string of image name (plot).
+                    image_1_name - string of image name (stackplot), None if chart was not requested;
+                    image_2_name - string of image name (plot), None if chart was not requested, images could be not
+                     rendered yet when method returns.
         """
-
-        new_dates_of_period_str = []
-        new_dates_of_period = []
-        start_date = ''
-
-        for stock in self.data['stocks']:
-            ticker_yahoo = yf.Ticker(stock)
-            dates_of_period = ticker_yahoo.history(period='1y', interval='1mo').index.values
-
-            for date in dates_of_period:
-                time_to_datetime = pd.to_datetime(date)
-                if time_to_datetime.day == 1:
-                    time_to_datetime = time_to_datetime - datetime.timedelta(days=1)
-                date_to_str = time_to_datetime.strftime('%Y-%m-%d')
-                new_dates_of_period_str.append(date_to_str)
-                date_datetime = datetime.datetime.strptime(date_to_str, '%Y-%m-%d')
-                new_dates_of_period.append(date_datetime)
-
-            start_datetime = new_dates_of_period[0] - datetime.timedelta(days=30)
-            start_date = start_datetime.strftime('%Y-%m-%d')
-            break
-
-        # start_date = new_dates_of_period_str[0]
-        end_date = new_dates_of_period_str[-1]
-        exchange_rates = self.get_rates_by_date(self.base_currency, start_date, end_date)
-        print(exchange_rates)
-
-        portfolio_history = pd.DataFrame(data=new_dates_of_period, columns=['Date'])
-        portfolio_history.set_index('Date', inplace=True)
-
-        for stock in self.data['stocks']:
-
-            ticker_yahoo = yf.Ticker(stock)
-
-            history_data = ticker_yahoo.history(period='1y', interval='1mo')[['Close']].copy()
-            ticker_dates = ticker_yahoo.history(period='1y', interval='1mo').index.values
-
-            new_ticker_dates = []
-
-            for date in ticker_dates:
-                time_to_datetime = pd.to_datetime(date)
-                if time_to_datetime.day == 1:
-                    time_to_datetime = time_to_datetime - datetime.timedelta(days=1)
-                date_to_str = time_to_datetime.strftime('%Y-%m-%d')
-                date_datetime = datetime.datetime.strptime(date_to_str, '%Y-%m-%d')
-                new_ticker_dates.append(date_datetime)
-
-            history_data['Dates'] = new_ticker_dates
-            history_data.set_index('Dates', inplace=True)
-            portfolio_history[stock] = history_data['Close']
-
-        portfolio_history.fillna(value=portfolio_history.mean(), inplace=True)
-
-        portfolio_history_column_names = portfolio_history.columns
-        portfolio_history_dates = portfolio_history.index
-
-        for stock in portfolio_history_column_names:
-            ticker_yahoo = yf.Ticker(stock)
-            stock_currency = ticker_yahoo.info['currency']
-            amount = self.data['stocks'][stock]['amount']
-            for date in portfolio_history_dates:
-                time_to_datetime = pd.to_datetime(date)
-                if time_to_datetime.day == 1:
-                    time_to_datetime = time_to_datetime - datetime.timedelta(days=1)
-                date_to_str = time_to_datetime.strftime('%Y-%m-%d')
-                print(date_to_str)
-
-                if stock_currency != self.base_currency:
-                    while True:
-                        try:
-                            exchange_rate = exchange_rates['rates'][date_to_str][stock_currency]
-                            break
-                        except KeyError:
-                            time_to_datetime -= datetime.timedelta(days=1)
-                            date_to_str = time_to_datetime.strftime('%Y-%m-%d')
-                else:
-                    exchange_rate = 1.0
-                portfolio_history.loc[date, stock] = round(portfolio_history.loc[date, stock] * amount / exchange_rate, 2)
-
-        ticker_labels = list(portfolio_history_column_names)
-
-        time_of_request = self.get_date_time()
-        date_time_str = datetime.datetime.strftime(time_of_request, '%Y%m%d_%H%M%S')
-
-        plt.figure()
-        plt.grid(True)
-        plt.stackplot(portfolio_history.index, portfolio_history.transpose(), labels=ticker_labels)
-        plt.legend(loc='upper left')
-        plt.title('Portfolio total price stacked by Ticker')
-        plt.xlabel('Time')
-        plt.ylabel(f'Price, {self.base_currency}')
-        image_1_name = f'portfolio_history_stackplot_{date_time_str}.png'
-        image_1_path = os.path.join(settings.MEDIA_ROOT, image_1_name)
-        plt.savefig(image_1_path)
-
-        portfolio_history['Sum'] = round(portfolio_history.sum(axis=1), 2)
-
-        plt.figure()
-        plt.plot(portfolio_history.index, portfolio_history['Sum'])
-        plt.grid(True)
-        plt.title('Portfolio total price, 1Y period')
-        plt.xlabel('Time')
-        plt.ylabel(f'Price, {self.base_currency}')
-        image_2_name = f'portfolio_history_sum_{date_time_str}.png'
-        image_2_path = os.path.join(settings.MEDIA_ROOT, image_2_name)
-        plt.savefig(image_2_path)
-
-        portfolio_history.to_csv(f'portfolio_1Y_data_{date_time_str}.csv', encoding='utf-8')
+        portfolio_history = self.history.copy()
+        if portfolio_history.empty:
+            return portfolio_history, None, None
+
+        period_title = PERIOD_TITLES.get(self.period, self.period)
+
+        image_1_name = None
+        image_2_name = None
+        if charts:
+            with self.timings.span('submit_charts', 'render'):
+                image_1_name = self.renderer.submit('portfolio_history_stackplot', stack_chart,
+                                                    portfolio_history.drop(columns='Sum'), self.base_currency)
+                image_2_name = self.renderer.submit('portfolio_history_sum', line_chart,
+                                                    portfolio_history['Sum'].copy(),
+                                                    f'Portfolio total price, {period_title} period', self.base_currency)
+
+        if export_csv:
+            date_time_str = datetime.datetime.strftime(self.snapshot.time_of_request, '%Y%m%d_%H%M%S')
+            with self.timings.span('export_csv', 'export'):
+                portfolio_history.to_csv(audit_path(f'portfolio_{period_title}_data_{date_time_str}.csv'),
+                                         encoding='utf-8')
 
         return portfolio_history, image_1_name, image_2_name
 
-    def get_gain(self):
+    def get_gain(self, charts=False):
         """
-        get_gain method is for returning the gain/loss of each ticker sums and total sum from each month until now within
-        previous 1-year period, both absolute values in base currency and relative percentage values (calculations
-        are also based on convertion of data into base currency).
+        get_gain method is for returning the gain/loss of each ticker sums and total sum from each interval (month by
+        default) until now within selected period, both absolute values in base currency and relative percentage
+        values (calculations are also based on convertion of data into base currency). Current value and history are
+        taken from the same snapshot, so market data is not requested again.
+            :param charts: if True bar charts are queued for rendering to MEDIA_ROOT.
             :return:    data_gain_abs - dataframe of absolute gain / loss of each ticker and total portfolio from each
-            month within year before now in base currency;
+            interval within period before now in base currency;
                         data_gain - dataframe of relative gain / loss (percentage) of each ticker and total portfolio
-                         from each month within year before now (compares current data with each month data, all
-                          converted to base currency);
-                        image_3_name - string name of image (absolute),
-                        image_4_name - string name of image (relative)
+                         from each interval within period before now (compares current data with each interval data,
+                          all converted to base currency);
+                        image_3_name - string name of image (absolute), None if chart was not requested,
+                        image_4_name - string name of image (relative), None if chart was not requested
         """
-        time_of_request = self.get_date_time()
-        date_time_str = datetime.datetime.strftime(time_of_request, '%Y%m%d_%H%M%S')
-
-        current_data, _, _, _, _ = self.current_portfolio_value()
-        current_data_transposed = current_data.set_index('Date').T
-        current_data_transposed['Sum'] = current_data_transposed.sum(axis=1)
-
-        data_history, _, _ = self.get_history()
-
-        data_gain_abs = data_history.copy()
-        data_gain = data_history.copy()
-
-        column_names = data_gain.columns
-        dates = data_gain.index
-
-        for stock in column_names:
-            stock_current_price = float(current_data_transposed[stock].iloc[0])
-            for date in dates:
-                data_gain_abs.loc[date, stock] = round((stock_current_price - data_gain.loc[date, stock]), 2)
-                data_gain.loc[date, stock] = round(((stock_current_price - data_gain.loc[date, stock]) / data_gain.loc[date, stock] * 100), 1)
-
-        data_gain_abs_reverse = data_gain_abs.iloc[::-1]
-        data_gain_reverse = data_gain.iloc[::-1]
-
-        plt.figure()
-        colors = ['green' if value > 0 else 'red' for value in data_gain_abs_reverse['Sum']]
-        plt.bar(data_gain_abs_reverse.index, data_gain_abs_reverse['Sum'], color=colors, width=20)
-        plt.grid(True)
-        plt.xlabel('Dates')
-        plt.ylabel(f'Absolute Gain / Loss {self.base_currency}')
-        plt.title(f'Absolute Gain/Loss from each month within last year, {self.base_currency}')
-        image_3_name = f'portfolio_gain_absolute_{date_time_str}.png'
-        image_3_path = os.path.join(settings.MEDIA_ROOT, image_3_name)
-        plt.savefig(image_3_path)
-
-        plt.figure()
-        colors = ['green' if value > 0 else 'red' for value in data_gain_reverse['Sum']]
-        plt.bar(data_gain_reverse.index, data_gain_reverse['Sum'], color=colors, width=20)
-        plt.grid(True)
-        plt.xlabel('Dates')
-        plt.ylabel(f'Absolute Gain / Loss, %')
-        plt.title(f'Relative Gain/Loss from each month within last year, %')
-        image_4_name = f'portfolio_gain_percent_{date_time_str}.png'
-        image_4_path = os.path.join(settings.MEDIA_ROOT, image_4_name)
-        plt.savefig(image_4_path)
+        data_history = self.history
+        current = self.snapshot.current
+        with self.timings.span('compute_gain', 'compute'):
+            current_data = current.set_index('Ticker')[f'Sum per ticker {self.base_currency}']
+            tickers = [stock for stock in data_history.columns if stock in current_data.index]
+            if not tickers:
+                return pd.DataFrame(), pd.DataFrame(), None, None
+            data_history = data_history[tickers].assign(Sum=data_history[tickers].sum(axis=1).round(2))
+            current_data = current_data[tickers].copy()
+            current_data['Sum'] = current_data.sum()
+
+            difference = data_history.rsub(current_data, axis=1)
+            data_gain_abs = difference.round(2)
+            data_gain = (difference / data_history * 100).round(1)
+
+        interval_title = INTERVAL_TITLES.get(self.interval, self.interval)
+        period_title = PERIOD_TITLES.get(self.period, self.period)
+        width = BAR_WIDTHS.get(self.interval, 1)
+
+        image_3_name = None
+        image_4_name = None
+        if charts:
+            with self.timings.span('submit_charts', 'render'):
+                image_3_name = self.renderer.submit(
+                    'portfolio_gain_absolute', bar_chart, data_gain_abs['Sum'].iloc[::-1].copy(), width,
+                    f'Absolute Gain/Loss from each {interval_title} within {period_title} period, {self.base_currency}',
+                    f'Absolute Gain / Loss {self.base_currency}')
+                image_4_name = self.renderer.submit(
+                    'portfolio_gain_percent', bar_chart, data_gain['Sum'].iloc[::-1].copy(), width,
+                    f'Relative Gain/Loss from each {interval_title} within {period_title} period, %',
+                    'Absolute Gain / Loss, %')
 
         return data_gain_abs, data_gain, image_3_name, image_4_name
 
@@ -317,9 +254,7 @@ class Calculator:
         :param currency: currency code, string
         :return: latest (today) exchange rate from Frankfurter API, dictionary
         """
-        response = requests.get(f'https://api.frankfurter.app/latest?from={currency}')
-        exchange_rates_dict = response.json()
-        return exchange_rates_dict
+        return self.provider.get_rates(currency)
 
     def get_rates_by_date(self, currency, start, end):
         """
@@ -330,15 +265,11 @@ class Calculator:
         :param end: end date, string
         :return: exchange rates for every working day in period from start to end from Frankfurter API, dictionary
         """
-        response = requests.get(f'https://api.frankfurter.app/{start}..{end}?from={currency}')
-        exchange_rates_dict = response.json()
-        return exchange_rates_dict
+        return self.provider.get_rates_by_date(currency, start, end)
 
     def get_date_time(self):
         """
         This method is for getting current time and date in local timezone
         :return: returns current date and time in datetime format
         """
-        tzinfo = datetime.timezone(datetime.timedelta(hours=3))
-        time_of_request = datetime.datetime.now(tzinfo)
-        return time_of_request
+        return local_now()
@@ -0,0 +1,168 @@
+import datetime
+import pandas as pd
+
+from .models import Item, PortfolioValuation
+from .providers import PERIODS
+from .snapshot import PortfolioSnapshot, RESAMPLE_RULES
+from .tickers import currencies
+
+
+# Stored history may start (first trading day after period start) or end (job did not run during a weekend) a few
+# days off the requested period.
+HISTORY_SLACK = datetime.timedelta(days=7)
+
+
+def holdings_frame(items=None):
+    """
+    Reads holdings of portfolios from the database.
+    :param items: Item queryset, all Items by default
+    :return: dataframe with columns portfolio (primary key), ticker and quantity, one row per Item
+    """
+    items = Item.objects.all() if items is None else items
+    rows = items.order_by().values_list('portfolio_id', 'ticker', 'quantity').iterator(chunk_size=10000)
+    return pd.DataFrame.from_records(rows, columns=['portfolio', 'ticker', 'quantity'])
+
+
+def value_holdings(holdings, quotes, exchange_rates, base_currency):
+    """
+    Values holdings of many portfolios at once: price of every ticker is converted to the base currency once and
+    multiplied by the (portfolio x ticker) holdings, kept in long form (one row per held ticker), so memory depends
+    on the number of Items and not on portfolios x tickers. Rounding is the same as in PortfolioSnapshot.current.
+    :param holdings: dataframe from holdings_frame
+    :param quotes: dictionary with ticker names as a keys and dictionaries with 'currentPrice' and 'currency' as a
+     values
+    :param exchange_rates: latest exchange rates relatively to the base currency, dictionary in Frankfurter API format
+    :param base_currency: currency code, string
+    :return:    values - holdings dataframe with value column (value of the ticker in the base currency), tickers
+                 without quote or exchange rate are left out;
+                totals - total value of every portfolio, Series indexed by portfolio primary key;
+                errors - dictionary with ticker names as a keys and error messages as a values.
+    """
+    errors = {}
+    prices = pd.DataFrame.from_dict(quotes, orient='index', columns=['currentPrice', 'currency'])
+    rates = pd.Series(exchange_rates.get('rates', {}), dtype=float)
+    rates[base_currency] = 1.0
+    prices['rate'] = prices['currency'].map(rates)
+    for ticker, currency in prices.loc[prices['rate'].isna(), 'currency'].items():
+        errors[ticker] = f'Exchange rate for currency "{currency}" of ticker "{ticker}" is not available.'
+    for ticker in holdings['ticker'].unique():
+        if ticker not in quotes:
+            errors[ticker] = f'Ticker "{ticker}" does not exist.'
+
+    values = holdings.join(prices.dropna(subset=['rate']), on='ticker', how='inner')
+    values['value'] = ((values['quantity'] * values['currentPrice']).round(2) / values['rate']).round(2)
+    totals = values.groupby('portfolio')['value'].sum().round(2)
+    return values[['portfolio', 'ticker', 'value']], totals, errors
+
+
+def store_valuations(values, totals, base_currency, date, batch_size=5000):
+    """
+    Stores (or replaces) valuations of portfolios on the date.
+    :param values: values dataframe from value_holdings
+    :param totals: totals Series from value_holdings
+    :param base_currency: currency code, string
+    :param date: date object
+    :param batch_size: number of rows written with one query, integer
+    :return: number of stored valuations
+    """
+    ticker_values = {}
+    for portfolio, ticker, value in values.itertuples(index=False, name=None):
+        ticker_values.setdefault(portfolio, {})[ticker] = value
+    valuations = [PortfolioValuation(portfolio_id=portfolio, base_currency=base_currency, date=date, value=value,
+                                     values=ticker_values.get(portfolio, {}))
+                  for portfolio, value in totals.items()]
+    return save_valuations(valuations, batch_size)
+
+
+def save_valuations(valuations, batch_size=5000):
+    """
+    Inserts valuations, valuations of the same portfolio, base currency and date which are already stored are replaced.
+    :param valuations: list of PortfolioValuation objects
+    :param batch_size: number of rows written with one query, integer
+    :return: number of stored valuations
+    """
+    PortfolioValuation.objects.bulk_create(valuations, batch_size=batch_size, update_conflicts=True,
+                                           unique_fields=['portfolio', 'base_currency', 'date'],
+                                           update_fields=['value', 'values', 'updated'])
+    return len(valuations)
+
+
+def portfolios_without_history(base_currency, date):
+    """
+    :param base_currency: currency code, string
+    :param date: date object
+    :return: set of primary keys of portfolios which have no stored valuation before the date (new portfolios and
+     portfolios whose valuations were invalidated)
+    """
+    stored = (PortfolioValuation.objects.filter(base_currency=base_currency, date__lt=date)
+              .values_list('portfolio_id', flat=True).distinct())
+    return set(Item.objects.exclude(portfolio_id__in=stored).values_list('portfolio_id', flat=True).distinct())
+
+
+def market_snapshot(tickers, base_currency, provider, time_of_request, period):
+    """
+    Requests daily history of all the tickers, exchange rates of its dates and currencies of the tickers at once,
+    history of single portfolios is then calculated from parts of it (history_valuations).
+    :param tickers: list of ticker names
+    :param base_currency: currency code, string
+    :param provider: MarketDataProvider object
+    :param time_of_request: date and time of valuation, datetime object
+    :param period: history period in yfinance notation, string
+    :return: PortfolioSnapshot object
+    """
+    snapshot = PortfolioSnapshot({ticker: 1 for ticker in tickers}, base_currency, provider, time_of_request,
+                                 period=period, interval='1d', registry=currencies)
+    return snapshot.fetch('currencies', 'history_rates')
+
+
+def history_valuations(portfolio_id, holdings, market):
+    """
+    Values portfolio on every trading day of the period, the same way as history of the portfolio page is calculated.
+    :param portfolio_id: primary key of the portfolio
+    :param holdings: dictionary with ticker names as a keys and quantities as a values
+    :param market: PortfolioSnapshot from market_snapshot with all the tickers of holdings
+    :return:    valuations - list of PortfolioValuation objects (not saved);
+                errors - dictionary with ticker names as a keys and error messages as a values.
+    """
+    snapshot = market.subset(holdings)
+    history = snapshot.history
+    if history.empty:
+        return [], snapshot.errors
+    totals = history.pop('Sum')
+    valuations = [PortfolioValuation(portfolio_id=portfolio_id, base_currency=snapshot.base_currency,
+                                     date=date.date(), value=totals[date], values=values)
+                  for date, values in history.to_dict('index').items()]
+    return valuations, snapshot.errors
+
+
+def stored_history(portfolio_id, base_currency, tickers, period, interval, today):
+    """
+    Reads history of portfolio values from stored daily valuations and resamples it to the interval.
+    :param portfolio_id: primary key of the portfolio
+    :param base_currency: currency code, string
+    :param tickers: ticker names of the portfolio, list
+    :param period: history period in yfinance notation, string
+    :param interval: history interval in yfinance notation, string
+    :param today: date object
+    :return: dataframe indexed by dates with ticker names and Sum as a columns (as PortfolioSnapshot.history), None
+     when stored valuations do not cover the whole period or all the tickers
+    """
+    offset = PERIODS.get(period)
+    if offset is None:
+        return None
+    start = (pd.Timestamp(today) - offset).date()
+    valuations = PortfolioValuation.objects.filter(portfolio_id=portfolio_id, base_currency=base_currency,
+                                                   date__gte=start, date__lte=today)
+    rows = list(valuations.order_by('date').values_list('date', 'values'))
+    if not rows or rows[0][0] > start + HISTORY_SLACK or rows[-1][0] < today - HISTORY_SLACK:
+        return None
+
+    history = pd.DataFrame([values for _, values in rows], index=pd.DatetimeIndex([date for date, _ in rows],
+                                                                                   name='Date'))
+    if not tickers or any(stock not in history.columns for stock in tickers):
+        # Holding without stored values would be left out of Sum, history is calculated from market data instead.
+        return None
+    history = history[list(tickers)]
+    history = history.resample(RESAMPLE_RULES.get(interval, 'B')).last().dropna(how='all')
+    history['Sum'] = round(history.sum(axis=1), 2)
+    return history
@@ -1,19 +1,32 @@
-import os
+import uuid
+from urllib.parse import urlencode
+from asgiref.sync import sync_to_async
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
+from django.core.cache import caches
 from django.core.exceptions import PermissionDenied
-from django.shortcuts import render, get_object_or_404, redirect
-from django.urls import reverse_lazy
+from django.db import IntegrityError
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, JsonResponse, StreamingHttpResponse
+from django.core.paginator import Paginator
+from django.shortcuts import render, get_object_or_404, aget_object_or_404, redirect
+from django.template.loader import render_to_string
+from django.urls import reverse, reverse_lazy
 from django.views import generic
 from portfolio_project import settings
 from .models import Portfolio, Item
-from .forms import CurrencyForm, ItemForm, PortfolioForm, ItemUpdateForm
+from .forms import CurrencyForm, ItemForm, PortfolioForm, ItemUpdateForm, PERIOD_CHOICES, INTERVAL_CHOICES
 from .utils import Calculator
+from .charts import get_chart_renderer
+from .http_client import get_http_client
+from .providers import MarketDataError
+from .tickers import lookup
+from .timing import request_timings, metrics as timing_metrics
+from .export import TABLES, FORMATS, export_frame, csv_rows, frame_rows, parquet_bytes, pyarrow
 from django.contrib.auth.forms import User
 from django.views.decorators.csrf import csrf_protect
 from django.contrib import messages
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
 from django.views.generic.edit import FormView
-import yfinance as yf
 
 
 # Create your views here.
@@ -33,7 +46,7 @@ class PortfolioListView(LoginRequiredMixin, generic.ListView, FormView):
         Method returns all portfolio objects which belong to current user
         :return: returns objects filtered by user
         """
-        return Portfolio.objects.filter(user=self.request.user)
+        return Portfolio.objects.for_user(self.request.user)
 
     def form_valid(self, form):
         """
@@ -80,7 +93,7 @@ class PortfolioUpdateView(LoginRequiredMixin, UserPassesTestMixin, generic.Updat
         :return: boolean True or False
         """
         portfolio = self.get_object()
-        return self.request.user == portfolio.user
+        return portfolio.user_id == self.request.user.pk
 
 
 class PortfolioDeleteView(LoginRequiredMixin, UserPassesTestMixin, generic.DeleteView):
@@ -97,22 +110,114 @@ class PortfolioDeleteView(LoginRequiredMixin, UserPassesTestMixin, generic.Delet
         :return: boolean True or False
         """
         portfolio = self.get_object()
-        return self.request.user == portfolio.user
+        return portfolio.user_id == self.request.user.pk
+
+def add_item(request, portfolio):
+    """
+    Function adding Item from submitted ItemForm to the Portfolio, ticker is looked up in the ticker registry (market
+    data provider is requested only for tickers which are not registered yet)
+    :param request: HttpRequest object that contains metadata about the request
+    :param portfolio: Portfolio object with prefetched Items
+    :return: returns redirect to Portfolio details when Item is added (None otherwise) and ItemForm with errors
+    """
+    item_form = ItemForm(request.POST)
+    if item_form.is_valid():
+        ticker = item_form.cleaned_data['ticker']
+        try:
+            if any(stock.ticker == ticker for stock in portfolio.stocks.all()):
+                messages.error(request, 'Item with this ticker already exists in your portfolio.')
+            else:
+                with request_timings(request).span('lookup_ticker', 'database'):
+                    lookup(ticker)
+                new_item = item_form.save(commit=False)
+                new_item.portfolio_id = portfolio
+                new_item.user = request.user
+                new_item.save()
+                messages.success(request, 'Item added to your portfolio successfully.')
+                return redirect('portfolio_detail', pk=portfolio.pk), item_form
+        except IntegrityError:
+            messages.error(request, 'Item with this ticker already exists in your portfolio.')
+        except MarketDataError as error:
+            messages.error(request, str(error))
+    return None, item_form
+
+def table_key(pk, table, token):
+    """
+    Function returning cache key of the calculated table whose pages are loaded on demand
+    :param pk: Portfolio primary key, Integer
+    :param table: 'history', 'gain' or 'gain_percent', string
+    :param token: token of the calculation, string
+    :return: string
+    """
+    return f'table:{pk}:{table}:{token}'
+
+def table_page(frame, pk, table, query, number=1, token=None):
+    """
+    Function returning one page (TABLE_PAGE_SIZE rows) of calculated table, only rows of the page are converted for
+    the template, so pages of long daily histories render as fast as short ones. Table with more pages is kept in the
+    default cache (TABLE_CACHE_TIMEOUT setting) under a token passed in url of the next page, so following pages are
+    sliced from the same table and not calculated again
+    :param frame: dataframe indexed by dates
+    :param pk: Portfolio primary key, Integer
+    :param table: 'history', 'gain' or 'gain_percent', string
+    :param query: url encoded CurrencyForm fields, string
+    :param number: page number, Integer
+    :param token: token of the table which is already cached, new token by default
+    :return: dictionary with columns, rows (tuples), number of shown and all rows, and url of the next page (None on
+     the last page)
+    """
+    page = Paginator(frame, getattr(settings, 'TABLE_PAGE_SIZE', 100)).get_page(number)
+    next_url = None
+    if page.has_next():
+        if token is None:
+            token = uuid.uuid4().hex
+            caches['default'].set(table_key(pk, table, token), frame, getattr(settings, 'TABLE_CACHE_TIMEOUT', 600))
+        next_url = (f"{reverse('portfolio_table', args=[pk, table])}?{query}&page={page.next_page_number()}"
+                    f"&token={token}")
+    return {
+        'columns': [frame.index.name or 'Date'] + list(frame.columns),
+        'rows': list(frame_rows(page.object_list)),
+        'shown': page.end_index(),
+        'count': page.paginator.count,
+        'next_url': next_url,
+    }
+
+def query_calculator(request, pk):
+    """
+    Function returning Calculator of the Portfolio for GET parameters of export and table requests
+    :param request: HttpRequest object that contains metadata about the request, GET parameters are the same as
+     CurrencyForm fields
+    :param pk: Portfolio primary key, Integer
+    :return: returns Calculator (None when parameters are not valid) and cleaned GET parameters (response with errors
+     when parameters are not valid)
+    """
+    portfolio = get_object_or_404(Portfolio.objects.with_stocks(), pk=pk)
+    if portfolio.user_id != request.user.pk:
+        raise PermissionDenied
+    form = CurrencyForm(request.GET)
+    if not form.is_valid():
+        return None, HttpResponseBadRequest(form.errors.as_text(), content_type='text/plain')
+    calculator = Calculator(portfolio, form.cleaned_data['base_currency'], period=form.cleaned_data['period'],
+                            interval=form.cleaned_data['interval'], timings=request_timings(request))
+    return calculator, form.cleaned_data
 
 @login_required
-def portfolio_detail(request, pk):
+async def portfolio_detail(request, pk):
 
     """
     Returns view where user can see his portfolio details with all possible methods to initiate (add/update/delete
-    Items), perform Current price, history and gain calculations.
+    Items), perform Current price, history and gain calculations. View is asynchronous: quotes, exchange rates and
+    history are requested concurrently (Calculator.aprefetch), database access and rendering run in sync threads.
+    Items are loaded once together with the portfolio and shared by the page and Calculator.
     :param request: HttpRequest object that contains metadata about the request
     :param pk: Portfolio primary key, Integer
     :return: returns view of Portfolio details with opportunities to perform actions.
     """
 
-    portfolio = get_object_or_404(Portfolio, pk=pk)
+    portfolio = await aget_object_or_404(Portfolio.objects.with_stocks(), pk=pk)
+    user = await request.auser()
 
-    if portfolio.user != request.user:
+    if portfolio.user_id != user.pk:
         raise PermissionDenied
 
     form = CurrencyForm(initial={'portfolio_id': pk})
@@ -121,33 +226,30 @@ def portfolio_detail(request, pk):
 
     if request.method == 'POST':
         if 'add_item' in request.POST:
-            item_form = ItemForm(request.POST)
-            if item_form.is_valid():
-                ticker = item_form.cleaned_data['ticker']
-                try:
-                    check_stock_id = yf.Ticker(ticker)
-                    print(check_stock_id.info['currentPrice'])
-                    if Item.objects.filter(ticker=ticker, user=request.user, portfolio_id=portfolio.pk).exists():
-                        messages.error(request, 'Item with this ticker already exists in your portfolio.')
-                    else:
-                        new_item = item_form.save(commit=False)
-                        new_item.portfolio_id = portfolio
-                        new_item.user = request.user
-                        new_item.save()
-                        messages.success(request, 'Item added to your portfolio successfully.')
-                        return redirect('portfolio_detail', pk=pk)
-                except:
-                    messages.error(request, f'Ticker "{ticker}" does not exist.')
+            response, item_form = await sync_to_async(add_item)(request, portfolio)
+            if response is not None:
+                return response
         else:
             form = CurrencyForm(request.POST)
             if form.is_valid():
                 base_currency = form.cleaned_data['base_currency']
                 portfolio_id = form.cleaned_data['portfolio_id']
+                period = form.cleaned_data['period']
+                interval = form.cleaned_data['interval']
                 # data = convert_to_data(portfolio, data)
-                calculator = Calculator(portfolio, base_currency)
+                timings = request_timings(request)
+                calculator = await sync_to_async(Calculator)(portfolio, base_currency, period=period, interval=interval,
+                                                             timings=timings)
+                timings = timings if getattr(settings, 'TIMING_PANEL', False) else None
+                await calculator.aprefetch(current='history' not in request.POST,
+                                           history='current' not in request.POST)
+                export_query = urlencode({'base_currency': base_currency, 'portfolio_id': portfolio_id,
+                                          'period': period, 'interval': interval})
                 if 'current' in request.POST:
-                    df, df_app, portfolio_value, time_of_request, image_name = calculator.current_portfolio_value()
-                    image_url = os.path.join(settings.MEDIA_URL, image_name) if image_name else None
+                    df, df_app, portfolio_value, time_of_request, image_name = await sync_to_async(
+                        calculator.current_portfolio_value)(charts=True, export_csv=bool(settings.EXPORT_AUDIT_DIR))
+                    for error in calculator.errors.values():
+                        messages.error(request, error)
                     context = {
                         'portfolio_id': portfolio_id,
                         'base_currency': base_currency,
@@ -156,45 +258,60 @@ def portfolio_detail(request, pk):
                         'df_app': df_app,
                         'portfolio_value': portfolio_value,
                         'pk': portfolio_id,
-                        'image_url': image_url,
+                        'image_name': image_name,
                         'time_of_request': time_of_request,
-                        'df_app_any': df_app.any().any()
+                        'df_app_any': df_app.any().any(),
+                        'export_query': export_query,
+                        'parquet': pyarrow is not None,
+                        'timings': timings,
                     }
-                    return render(request, 'current.html', context)
+                    return await sync_to_async(render)(request, 'current.html', context)
 
                 elif 'history' in request.POST:
-                    portfolio_history, image_1_name, image_2_name = calculator.get_history()
-                    image_1_url = os.path.join(settings.MEDIA_URL, image_1_name) if image_1_name else None
-                    image_2_url = os.path.join(settings.MEDIA_URL, image_2_name) if image_2_name else None
+                    portfolio_history, image_1_name, image_2_name = await sync_to_async(calculator.get_history)(
+                        charts=True, export_csv=bool(settings.EXPORT_AUDIT_DIR))
+                    for error in calculator.errors.values():
+                        messages.error(request, error)
                     context = {
-                        'portfolio_history': portfolio_history,
+                        'history_table': table_page(portfolio_history, portfolio_id, 'history', export_query),
                         'base_currency': base_currency,
+                        'period': dict(PERIOD_CHOICES)[period],
+                        'interval': dict(INTERVAL_CHOICES)[interval],
                         'pk': portfolio_id,
                         'portfolio': portfolio.title,
                         'portfolio_history_any': portfolio_history.any().any(),
-                        'image_1_url': image_1_url,
-                        'image_2_url': image_2_url,
+                        'image_1_name': image_1_name,
+                        'image_2_name': image_2_name,
+                        'export_query': export_query,
+                        'parquet': pyarrow is not None,
+                        'timings': timings,
                     }
-                    return render(request, 'history.html', context)
+                    return await sync_to_async(render)(request, 'history.html', context)
 
                 elif 'gain' in request.POST:
-                    data_gain_abs, data_gain, image_3_name, image_4_name = calculator.get_gain()
-                    image_3_url = os.path.join(settings.MEDIA_URL, image_3_name) if image_3_name else None
-                    image_4_url = os.path.join(settings.MEDIA_URL, image_4_name) if image_4_name else None
-                    context = {'data_gain': data_gain,
+                    data_gain_abs, data_gain, image_3_name, image_4_name = await sync_to_async(calculator.get_gain)(
+                        charts=True)
+                    for error in calculator.errors.values():
+                        messages.error(request, error)
+                    context = {'gain_percent_table': table_page(data_gain, portfolio_id, 'gain_percent', export_query),
                                'data_gain_any': data_gain.any().any(),
-                               'data_gain_abs': data_gain_abs,
+                               'gain_table': table_page(data_gain_abs, portfolio_id, 'gain', export_query),
                                'data_gain_abs_any': data_gain_abs.any().any(),
                                'base_currency': base_currency,
+                               'period': dict(PERIOD_CHOICES)[period],
+                               'interval': dict(INTERVAL_CHOICES)[interval],
                                'pk': portfolio_id,
                                'portfolio': portfolio.title,
-                               'image_3_url': image_3_url,
-                               'image_4_url': image_4_url,
+                               'image_3_name': image_3_name,
+                               'image_4_name': image_4_name,
+                               'export_query': export_query,
+                               'parquet': pyarrow is not None,
+                               'timings': timings,
                                }
-                    return render(request, 'gain.html', context)
+                    return await sync_to_async(render)(request, 'gain.html', context)
 
-    return render(request, 'portfolio_detail.html',
-                  {'portfolio': portfolio, 'form': form, 'item_form': item_form})
+    return await sync_to_async(render)(request, 'portfolio_detail.html',
+                                       {'portfolio': portfolio, 'form': form, 'item_form': item_form})
 
 @login_required
 def update_item(request, pk):
@@ -209,7 +326,7 @@ def update_item(request, pk):
         form = ItemUpdateForm(request.POST, instance=item)
         if form.is_valid():
             form.save()
-            return redirect('portfolio_detail', pk=item.portfolio_id.pk)
+            return redirect('portfolio_detail', pk=item.portfolio_id_id)
     else:
         form = ItemUpdateForm(instance=item)
     return render(request, 'update_item.html', {'form': form})
@@ -223,12 +340,97 @@ def delete_item(request, pk):
     :return: returns view for deleting Item
     """
     item = get_object_or_404(Item, pk=pk)
-    portfolio_id = item.portfolio_id.pk
+    portfolio_id = item.portfolio_id_id
     if request.method == 'POST':
         item.delete()
         return redirect('portfolio_detail', pk=portfolio_id)
     return render(request, 'delete_item.html', {'item': item, 'portfolio_id': portfolio_id})
 
+@login_required
+def portfolio_export(request, pk, table, file_format):
+    """
+    Function returning calculated Portfolio table as a file download, CSV is streamed row by row and Parquet is
+    available when pyarrow package is installed. Nothing is written to the disk.
+    :param request: HttpRequest object that contains metadata about the request, GET parameters are the same as
+     CurrencyForm fields
+    :param pk: Portfolio primary key, Integer
+    :param table: 'current', 'history', 'gain' or 'gain_percent', string
+    :param file_format: 'csv' or 'parquet', string
+    :return: returns file response
+    """
+    if table not in TABLES or file_format not in FORMATS:
+        raise Http404
+    if file_format == 'parquet' and pyarrow is None:
+        return HttpResponse('Parquet export requires pyarrow package.', status=501, content_type='text/plain')
+    calculator, query = query_calculator(request, pk)
+    if calculator is None:
+        return query
+
+    calculator.prefetch(current=table != 'history', history=table != 'current')
+    frame = export_frame(calculator, table)
+    file_name = (f'portfolio_{pk}_{table}_{query["base_currency"]}_{query["period"]}_{query["interval"]}.'
+                 f'{file_format}')
+
+    if file_format == 'csv':
+        response = StreamingHttpResponse(csv_rows(frame), content_type=FORMATS[file_format])
+    else:
+        response = HttpResponse(parquet_bytes(frame), content_type=FORMATS[file_format])
+    response['Content-Disposition'] = f'attachment; filename="{file_name}"'
+    return response
+
+@login_required
+def portfolio_table(request, pk, table):
+    """
+    Function returning next page of history or gain table, pages load following rows on demand
+    :param request: HttpRequest object that contains metadata about the request, GET parameters are the same as
+     CurrencyForm fields plus page number
+    :param pk: Portfolio primary key, Integer
+    :param table: 'history', 'gain' or 'gain_percent', string
+    :return: JSON with rows of the page as HTML, number of shown and all rows and url of the next page
+    """
+    if table not in TABLES or table == 'current':
+        raise Http404
+    calculator, query = query_calculator(request, pk)
+    if calculator is None:
+        return query
+
+    token = request.GET.get('token') or None
+    frame = caches['default'].get(table_key(pk, table, token)) if token else None
+    if frame is None:
+        # Table expired (or was calculated by another process without shared cache), it is calculated again.
+        calculator.prefetch(current=table != 'history')
+        frame = export_frame(calculator, table)
+        if token:
+            caches['default'].set(table_key(pk, table, token), frame, getattr(settings, 'TABLE_CACHE_TIMEOUT', 600))
+    export_query = urlencode({'base_currency': query['base_currency'], 'portfolio_id': query['portfolio_id'],
+                              'period': query['period'], 'interval': query['interval']})
+    page = table_page(frame, pk, table, export_query, request.GET.get('page', 1), token)
+    return JsonResponse({'html': render_to_string('table_rows.html', {'rows': page['rows']}), 'shown': page['shown'],
+                         'count': page['count'], 'next_url': page['next_url']})
+
+@login_required
+def chart_status(request, name):
+    """
+    Function returning state of the chart which is rendered in the background, pages poll it until chart is ready
+    :param request: HttpRequest object that contains metadata about the request
+    :param name: image file name, string
+    :return: JSON with status ('pending', 'ready', 'failed' or 'missing') and url of the image when it is ready
+    """
+    if name.startswith('.') or not name.endswith('.png'):
+        raise Http404
+    status = get_chart_renderer().status(name)
+    return JsonResponse({'status': status, 'url': settings.MEDIA_URL + name if status == 'ready' else None})
+
+@staff_member_required
+def metrics(request):
+    """
+    Function returning counters of the process: duration of calculation phases (requests to market data providers,
+    calculations, charts rendering, CSV files) and requests of the HTTP client
+    :param request: HttpRequest object that contains metadata about the request
+    :return: JSON with phases and http statistics
+    """
+    return JsonResponse({'phases': timing_metrics(), 'http': get_http_client().stats()})
+
 
 def index(request):
     """
@@ -33,6 +33,7 @@ ALLOWED_HOSTS = []
 INSTALLED_APPS = [
     'portfolio_app',
     'crispy_forms',
+    'rest_framework',
     'django.contrib.admin',
     'django.contrib.auth',
     'django.contrib.contenttypes',
@@ -42,6 +43,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'portfolio_app.middleware.server_timing_middleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -79,6 +81,9 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Writers wait for the SQLite lock instead of failing at once, transactions take the lock when they begin
+        # (a deferred transaction which is upgraded to a write can fail without waiting).
+        'OPTIONS': {'timeout': 20, 'transaction_mode': 'IMMEDIATE'},
     }
 }
 
@@ -136,3 +141,110 @@ EMAIL_HOST_PASSWORD = 'VerySecret'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'portfolio_app/media/')
 
 MEDIA_URL = '/media/'
+
+# Market data source used by portfolio_app.utils.Calculator. Use 'portfolio_app.providers.FixtureProvider' to work
+# with recorded data without network.
+MARKET_DATA_PROVIDER = 'portfolio_app.providers.YahooFrankfurterProvider'
+
+# Quotes, history and exchange rates are cached in MARKET_DATA_CACHE cache (set to None to disable caching). LocMemCache
+# evicts least recently used entries above MAX_ENTRIES; use a shared backend such as
+# 'django.core.cache.backends.redis.RedisCache' (with maxmemory-policy allkeys-lru) to keep the cache between restarts
+# and share it between worker processes.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'market_data': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'market-data',
+        'KEY_PREFIX': 'market_data',
+        'OPTIONS': {'MAX_ENTRIES': 10000, 'CULL_FREQUENCY': 10},
+    },
+}
+
+MARKET_DATA_CACHE = 'market_data'
+
+# Times to live of cached market data in seconds, miss is the time to live of tickers and requests which could not be
+# fetched. Defaults are portfolio_app.cache.DEFAULT_TIMEOUTS, only the times given here override them, e.g.
+# {'quote': 30}.
+MARKET_DATA_CACHE_TIMEOUTS = {}
+
+# Keep downloaded history and exchange rates in the database and request only the missing tail from the provider.
+MARKET_DATA_STORE = True
+
+# Seconds to wait before writing market data to the database again when it is locked, after the last retry the data
+# is not stored (it is requested from the provider again next time). SQLite allows only one writer at a time, so
+# concurrent backfill (value_portfolios, warm_cache and requests storing history in worker threads) needs a database
+# with concurrent writes, e.g. PostgreSQL.
+MARKET_DATA_STORE_RETRY_DELAYS = (0.1, 0.5, 2)
+
+# Number of threads which render charts in the background.
+CHART_RENDER_WORKERS = 2
+
+# Maximum size of rendered charts in MEDIA_ROOT, least recently used charts are removed above it.
+CHART_CACHE_MAX_BYTES = 100 * 1024 * 1024
+
+# Directory of CSV audit files written on every calculation, audit files are not written when it is not set.
+EXPORT_AUDIT_DIR = None
+
+# Maximum time of one market data request in seconds, number of concurrent requests of one asynchronous view and
+# number of threads which run market data requests of all views.
+MARKET_DATA_FETCH_TIMEOUT = 10
+MARKET_DATA_FETCH_CONCURRENCY = 4
+MARKET_DATA_FETCH_WORKERS = 16
+
+# Number of threads of the process which request tickers one by one (or in batches) and deadline in seconds of all
+# ticker requests of one provider call.
+MARKET_DATA_TICKER_WORKERS = 8
+MARKET_DATA_TICKER_TIMEOUT = 10
+
+# HTTP client of market data APIs: timeouts in seconds, number of retries and backoff factor of failed requests,
+# number of kept alive connections per host and number of responses kept for conditional requests. Defaults are
+# portfolio_app.http_client.DEFAULT_OPTIONS, only the options given here override them, e.g. {'read_timeout': 20}.
+MARKET_DATA_HTTP = {}
+
+# Number of rows of History and Gain tables rendered at once, following rows are loaded on demand, and seconds the
+# calculated table is kept in the default cache for the following pages.
+TABLE_PAGE_SIZE = 100
+TABLE_CACHE_TIMEOUT = 10 * 60
+
+REST_FRAMEWORK = {
+    'DEFAULT_PERMISSION_CLASSES': ['rest_framework.permissions.IsAuthenticated'],
+    'DEFAULT_RENDERER_CLASSES': ['rest_framework.renderers.JSONRenderer'],
+}
+
+# Seconds clients may reuse API responses before revalidating them with ETag / Last-Modified, and seconds the time when
+# data of an ETag was seen first (its Last-Modified) is kept in the default cache.
+API_CACHE_MAX_AGE = 60
+API_VALIDATORS_TIMEOUT = 24 * 60 * 60
+
+# Show timings of calculation phases under results of Current price, History and Gain pages.
+TIMING_PANEL = DEBUG
+
+# Base currencies of valuations stored by value_portfolios command.
+VALUATION_CURRENCIES = ['EUR']
+
+# Period of daily valuations stored for new portfolios, history of longer periods is calculated from market data.
+VALUATION_HISTORY_PERIOD = '1y'
+
+# Age in seconds after which registered ticker (currency, exchange) is checked again in the background and number of
+# threads which check tickers.
+TICKER_REFRESH_AGE = 24 * 60 * 60
+TICKER_REFRESH_WORKERS = 2
+
+# Seconds between refreshes of warm_cache worker.
+WARM_CACHE_INTERVAL = 300
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'simple': {'format': '{asctime} {levelname} {name}: {message}', 'style': '{'},
+    },
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler', 'formatter': 'simple'},
+    },
+    'loggers': {
+        'portfolio_app': {'handlers': ['console'], 'level': 'INFO'},
+    },
+}